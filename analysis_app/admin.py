@@ -1,3 +1,44 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import VisionCallLog
+from .services.telemetry import template_summary
+
+
+@admin.register(VisionCallLog)
+class VisionCallLogAdmin(admin.ModelAdmin):
+    """Read-only log of vision requests, with latency and failure rates per equipment template above the list."""
+
+    list_display = (
+        "created_at",
+        "analysis_id",
+        "step_type",
+        "pmt_no",
+        "equipment_no",
+        "model",
+        "image_count",
+        "image_bytes",
+        "prompt_tokens",
+        "completion_tokens",
+        "latency_ms",
+        "queued_ms",
+        "retries",
+        "outcome",
+    )
+    list_filter = ("outcome", "step_type", "model")
+    search_fields = ("pmt_no", "equipment_no", "analysis__original_filename")
+    date_hierarchy = "created_at"
+    change_list_template = "admin/analysis_app/visioncalllog/change_list.html"
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        # the summary follows the filters, search and date drill-down of the list
+        cl = getattr(response, "context_data", {}).get("cl")
+        if cl is not None:
+            response.context_data["template_stats"] = template_summary(cl.queryset)
+        return response
@@ -0,0 +1,28 @@
+# analysis_app/management/commands/backfill_pdf_hashes.py
+from django.core.management.base import BaseCommand
+
+from analysis_app.models import Analysis
+from analysis_app.upload_handlers import sha256_of_file
+
+
+class Command(BaseCommand):
+    help = "Compute file_sha256 for analyses uploaded before PDF hashing, so new uploads can reuse their pages."
+
+    def handle(self, *args, **options):
+        updated = missing = 0
+        for analysis in Analysis.objects.filter(file_sha256__isnull=True).iterator():
+            try:
+                with analysis.file.open("rb") as f:
+                    analysis.file_sha256 = sha256_of_file(f)
+            except (FileNotFoundError, ValueError) as e:
+                missing += 1
+                self.stderr.write(f"Analysis {analysis.id}: {e}")
+                continue
+
+            if analysis.page_count is None and analysis.pages.exists():
+                # pre-lazy uploads rendered every page
+                analysis.page_count = analysis.pages.count()
+            analysis.save(update_fields=["file_sha256", "page_count"])
+            updated += 1
+
+        self.stdout.write(f"Hashed {updated} analysis file(s); {missing} file(s) missing.")
@@ -0,0 +1,164 @@
+# analysis_app/management/commands/bench_extraction.py
+import json
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis_app.models import Analysis
+from analysis_app.services.cropper import crop_region_selections
+from analysis_app.services.extraction import extract_design_and_bom
+from analysis_app.services.masterfile_builder import parse_filename
+from analysis_app.services.text_layer import TextRegion
+
+
+def _flatten(value: Any, prefix: str = "") -> Dict[str, Any]:
+    if isinstance(value, dict):
+        out: Dict[str, Any] = {}
+        for k, v in value.items():
+            out.update(_flatten(v, f"{prefix}.{k}" if prefix else k))
+        return out
+    return {prefix: value}
+
+
+def _same(a: Any, b: Any) -> bool:
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return abs(a - b) <= 1e-3 * max(1.0, abs(b))
+    norm = lambda v: re.sub(r"\s+", " ", str(v or "")).strip().lower()
+    return norm(a) == norm(b)
+
+
+def _score(result: Tuple[Dict, List], reference: Tuple[Dict, List]) -> Tuple[float, float]:
+    """(design field accuracy, BOM item F1) of result against reference."""
+    got, want = _flatten(result[0]), _flatten(reference[0])
+    design = sum(_same(got.get(k), v) for k, v in want.items()) / len(want) if want else 1.0
+
+    key = lambda i: (
+        re.sub(r"\s+", " ", (i.get("part_label") or "")).strip().lower(),
+        re.sub(r"[\s\-]", "", (i.get("material_raw") or "")).upper(),
+    )
+    got_items = [key(i) for i in result[1]]
+    want_items = [key(i) for i in reference[1]]
+    if not got_items and not want_items:
+        return design, 1.0
+    remaining = list(want_items)
+    hits = 0
+    for item in got_items:
+        if item in remaining:
+            remaining.remove(item)
+            hits += 1
+    precision = hits / len(got_items) if got_items else 0.0
+    recall = hits / len(want_items) if want_items else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return design, f1
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare split (one request per region) and combined (one request for all "
+        "crops) extraction: wall time per analysis and accuracy against --truth, or "
+        "agreement with split mode when no truth file is given. Always calls the API "
+        "(the vision cache is bypassed)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("analysis_ids", nargs="*", type=int, help="Analyses to run (default: latest with regions).")
+        parser.add_argument("--limit", type=int, default=5, help="How many analyses when none are given.")
+        parser.add_argument("--modes", default="split,combined", help="Comma separated modes to compare.")
+        parser.add_argument("--repeat", type=int, default=1, help="Runs per analysis and mode.")
+        parser.add_argument(
+            "--truth",
+            default=None,
+            help='JSON file {"<analysis_id>": {"design_meta": {...}, "bom_items": [...]}} to score against.',
+        )
+        parser.add_argument("--dump", default=None, help="Write the first run of each mode to this JSON file.")
+        parser.add_argument(
+            "--no-text-layer",
+            action="store_true",
+            help="Don't read regions from the PDF text layer (OCR may still answer if enabled).",
+        )
+
+    def _analyses(self, options) -> List[Analysis]:
+        qs = Analysis.objects.filter(regions__step_type="design_data").filter(regions__step_type="bom").distinct()
+        if options["analysis_ids"]:
+            qs = qs.filter(pk__in=options["analysis_ids"])
+        else:
+            qs = qs.order_by("-created_at")[: options["limit"]]
+        analyses = list(qs)
+        if not analyses:
+            raise CommandError("No analyses with design and BOM regions found.")
+        return analyses
+
+    def _run(self, analysis: Analysis, mode: str, text_layer: bool) -> Tuple[float, Tuple[Dict, List]]:
+        regions = analysis.regions.select_related("page")
+        design_region = regions.filter(step_type="design_data").first()
+        bom_regions = list(regions.filter(step_type="bom"))
+        pmt_no, equipment_no = parse_filename(analysis.original_filename)
+
+        def text_region(r) -> Optional[TextRegion]:
+            if not text_layer:
+                return None
+            return TextRegion(analysis.file.path, r.page.page_number, r.x1, r.y1, r.x2, r.y2)
+
+        crops = crop_region_selections([design_region] + bom_regions)
+        started = time.perf_counter()
+        result = extract_design_and_bom(
+            (crops[design_region.id], text_region(design_region)),
+            [(crops[r.id], text_region(r)) for r in bom_regions],
+            pmt_no=pmt_no,
+            equipment_no=equipment_no,
+            use_cache=False,
+            mode=mode,
+            analysis_id=analysis.id,
+        )
+        return time.perf_counter() - started, result
+
+    def handle(self, *args, **options):
+        modes = [m.strip() for m in options["modes"].split(",") if m.strip()]
+        truth: Dict[str, Any] = {}
+        if options["truth"]:
+            with open(options["truth"], encoding="utf-8") as f:
+                truth = json.load(f)
+
+        analyses = self._analyses(options)
+        totals = {m: {"seconds": 0.0, "runs": 0, "design": 0.0, "bom": 0.0, "scored": 0} for m in modes}
+        dump: Dict[str, Dict[str, Any]] = {m: {} for m in modes}
+
+        self.stdout.write(f"{'analysis':>8} {'mode':>9} {'seconds':>8} {'design':>7} {'bom f1':>7}  file")
+        for analysis in analyses:
+            first: Dict[str, Tuple[Dict, List]] = {}
+            for mode in modes:
+                for _ in range(options["repeat"]):
+                    seconds, result = self._run(analysis, mode, not options["no_text_layer"])
+                    totals[mode]["seconds"] += seconds
+                    totals[mode]["runs"] += 1
+                    first.setdefault(mode, result)
+
+                ref = truth.get(str(analysis.id))
+                reference = (ref["design_meta"], ref["bom_items"]) if ref else first.get(modes[0])
+                design_acc, bom_f1 = _score(first[mode], reference)
+                if ref or mode != modes[0]:
+                    totals[mode]["design"] += design_acc
+                    totals[mode]["bom"] += bom_f1
+                    totals[mode]["scored"] += 1
+                dump[mode][str(analysis.id)] = {"design_meta": first[mode][0], "bom_items": first[mode][1]}
+                self.stdout.write(
+                    f"{analysis.id:>8} {mode:>9} {seconds:>8.2f} {design_acc:>7.0%} {bom_f1:>7.0%}  "
+                    f"{analysis.original_filename}"
+                )
+
+        basis = "truth" if truth else f"{modes[0]} mode"
+        self.stdout.write(f"\nAverages (accuracy against {basis}):")
+        for mode, t in totals.items():
+            avg = t["seconds"] / t["runs"] if t["runs"] else 0.0
+            if t["scored"]:
+                acc = f"design {t['design'] / t['scored']:.0%}, bom f1 {t['bom'] / t['scored']:.0%}"
+            else:
+                acc = "reference"
+            self.stdout.write(f"  {mode:>9}: {avg:.2f} s per analysis, {acc}")
+
+        if options["dump"]:
+            with open(options["dump"], "w", encoding="utf-8") as f:
+                json.dump(dump, f, indent=2, ensure_ascii=False)
+            self.stdout.write(f"Results written to {options['dump']}")
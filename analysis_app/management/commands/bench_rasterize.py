@@ -0,0 +1,90 @@
+# analysis_app/management/commands/bench_rasterize.py
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis_app.services.rasterizer import get_page_count, iter_render_pages_parallel
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark page rasterization throughput (pages/sec) against the number "
+        "of processes, using the PDFs in MEDIA_ROOT/analysis/pdf by default. "
+        "Pages are written to a temporary directory and removed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "pdfs",
+            nargs="*",
+            help="PDF files to render (default: every PDF in MEDIA_ROOT/analysis/pdf).",
+        )
+        parser.add_argument(
+            "--processes",
+            default=None,
+            help="Comma separated process counts, e.g. 1,2,4 (default: 1,2,4,... up to cpu count).",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=1,
+            help="Render each PDF this many times per process count.",
+        )
+
+    def handle(self, *args, **options):
+        pdfs = [Path(p) for p in options["pdfs"]]
+        if not pdfs:
+            pdfs = sorted((Path(settings.MEDIA_ROOT) / "analysis" / "pdf").glob("*.pdf"))
+        if not pdfs:
+            raise CommandError("No PDFs found to benchmark.")
+
+        if options["processes"]:
+            counts = [int(c) for c in options["processes"].split(",") if c.strip()]
+        else:
+            cpu = os.cpu_count() or 1
+            counts = []
+            n = 1
+            while n < cpu:
+                counts.append(n)
+                n *= 2
+            counts.append(cpu)
+
+        page_counts = {pdf: get_page_count(str(pdf)) for pdf in pdfs}
+        total_pages = sum(page_counts.values()) * options["repeat"]
+        self.stdout.write(
+            f"{len(pdfs)} PDF(s), {total_pages} page(s) per run, "
+            f"dpi={getattr(settings, 'ANALYSIS_RASTER_DPI', 200)}, cpu_count={os.cpu_count()}"
+        )
+        self.stdout.write(f"{'processes':>10} {'seconds':>10} {'pages/sec':>10} {'speedup':>8}")
+
+        baseline = None
+        for processes in counts:
+            out_root = tempfile.mkdtemp(prefix="bench_raster_")
+            try:
+                started = time.perf_counter()
+                rendered = 0
+                for _ in range(options["repeat"]):
+                    for pdf in pdfs:
+                        for _page in iter_render_pages_parallel(
+                            str(pdf),
+                            0,
+                            1,
+                            page_counts[pdf],
+                            processes=processes,
+                            media_root=out_root,
+                        ):
+                            rendered += 1
+                elapsed = time.perf_counter() - started
+            finally:
+                shutil.rmtree(out_root, ignore_errors=True)
+
+            rate = rendered / elapsed if elapsed else 0.0
+            if baseline is None:
+                baseline = rate
+            speedup = rate / baseline if baseline else 0.0
+            self.stdout.write(f"{processes:>10} {elapsed:>10.2f} {rate:>10.2f} {speedup:>7.2f}x")
@@ -0,0 +1,111 @@
+# analysis_app/management/commands/convert_page_images.py
+import os
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from analysis_app.models import AnalysisPage
+from analysis_app.services.rasterizer import PAGE_FORMATS, save_page_image
+
+
+def _decode_seconds(path: Path) -> float:
+    # what crop_region_from_page pays: open + full decode
+    started = time.perf_counter()
+    with Image.open(path) as img:
+        img.load()
+    return time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert stored page images to another ANALYSIS_PAGE_FORMAT and report "
+        "the bytes saved and the change in decode time seen when cropping."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format",
+            dest="fmt",
+            default=None,
+            help=f"Target format, one of {sorted(PAGE_FORMATS)} (default: ANALYSIS_PAGE_FORMAT).",
+        )
+        parser.add_argument("--analysis", type=int, default=None, help="Only convert pages of this analysis.")
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Measure the savings without replacing any file.",
+        )
+
+    def handle(self, *args, **options):
+        fmt = options["fmt"] or getattr(settings, "ANALYSIS_PAGE_FORMAT", "png")
+        if fmt not in PAGE_FORMATS:
+            raise CommandError(f"Unknown format {fmt!r}; choose one of {sorted(PAGE_FORMATS)}")
+        ext = PAGE_FORMATS[fmt][0]
+        dry_run = options["dry_run"]
+        media_root = Path(settings.MEDIA_ROOT)
+
+        pages = AnalysisPage.objects.all()
+        if options["analysis"]:
+            pages = pages.filter(analysis_id=options["analysis"])
+        # deduped analyses share page files; convert each file once
+        names = sorted(set(pages.values_list("image", flat=True)))
+
+        converted = skipped = 0
+        old_total = new_total = 0
+        old_decode = new_decode = 0.0
+
+        for name in names:
+            src = media_root / name
+            if not src.exists():
+                self.stderr.write(f"Missing: {name}")
+                skipped += 1
+                continue
+
+            dst_name = str(Path(name).with_suffix(f".{ext}")).replace(os.sep, "/")
+            dst = media_root / dst_name
+            tmp = dst.with_name(dst.name + ".tmp")
+
+            old_size = src.stat().st_size
+            old_time = _decode_seconds(src)
+            with Image.open(src) as img:
+                img.load()
+                save_page_image(img, tmp, fmt)
+            new_size = tmp.stat().st_size
+            new_time = _decode_seconds(tmp)
+
+            old_total += old_size
+            new_total += new_size
+            old_decode += old_time
+            new_decode += new_time
+            converted += 1
+            self.stdout.write(
+                f"{name}: {old_size / 1024:.0f} KB -> {new_size / 1024:.0f} KB, "
+                f"decode {old_time * 1000:.0f} ms -> {new_time * 1000:.0f} ms"
+            )
+
+            if dry_run:
+                tmp.unlink()
+                continue
+
+            os.replace(tmp, dst)
+            if dst_name != name:
+                AnalysisPage.objects.filter(image=name).update(image=dst_name)
+                src.unlink()
+
+        if not converted:
+            self.stdout.write("No page images converted.")
+            return
+
+        saved = old_total - new_total
+        self.stdout.write(
+            f"{'Would convert' if dry_run else 'Converted'} {converted} file(s) to {fmt}"
+            f" ({skipped} missing): {old_total / 1048576:.1f} MB -> {new_total / 1048576:.1f} MB,"
+            f" saved {saved / 1048576:.1f} MB ({saved / old_total * 100:.0f}%)."
+        )
+        self.stdout.write(
+            f"Average decode per page: {old_decode / converted * 1000:.0f} ms -> "
+            f"{new_decode / converted * 1000:.0f} ms"
+        )
@@ -0,0 +1,61 @@
+# analysis_app/management/commands/gc_media.py
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis_app.services.media_gc import collect_media_garbage, media_retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete media files (crops, pages, pdf, ppt, workbooks) that no analysis "
+        "references and that are older than ANALYSIS_MEDIA_RETENTION. Safe to run "
+        "from cron / Task Scheduler; use --dry-run to see what would be removed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report what would be removed without deleting anything.",
+        )
+        parser.add_argument(
+            "--dir",
+            dest="directories",
+            action="append",
+            default=None,
+            help="Only collect this directory, e.g. analysis/crops (repeatable).",
+        )
+        parser.add_argument(
+            "--list",
+            action="store_true",
+            help="Print every file that is (or would be) removed.",
+        )
+
+    def handle(self, *args, **options):
+        retention = media_retention()
+        directories = options["directories"]
+        if directories:
+            unknown = [d for d in directories if d not in retention]
+            if unknown:
+                raise CommandError(f"Unknown directory {unknown}; choose from {sorted(retention)}")
+
+        dry_run = options["dry_run"]
+        reports = collect_media_garbage(dry_run=dry_run, directories=directories)
+
+        verb = "Would remove" if dry_run else "Removed"
+        total_files = total_bytes = 0
+        for r in reports:
+            days = retention[r.directory] / 86400
+            self.stdout.write(
+                f"{r.directory}: scanned {r.scanned}, referenced {r.referenced}, "
+                f"newer than {days:g}d {r.kept_recent}, "
+                f"{verb.lower()} {len(r.removed)} ({r.removed_bytes / 1048576:.1f} MB)"
+            )
+            if options["list"]:
+                for name in r.removed:
+                    self.stdout.write(f"  {name}")
+            for err in r.errors:
+                self.stderr.write(f"  failed: {err}")
+            total_files += len(r.removed) - len(r.errors)
+            total_bytes += r.removed_bytes
+
+        self.stdout.write(f"{verb} {total_files} file(s), {total_bytes / 1048576:.1f} MB.")
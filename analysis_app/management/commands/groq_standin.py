@@ -0,0 +1,66 @@
+# analysis_app/management/commands/groq_standin.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis_app.services.groq_standin import CANNED_RESPONSES, make_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a local stand-in for the Groq chat completions API, answering the "
+        "design and BOM prompts with canned JSON. Point the app at it with "
+        "GROQ_BASE_URL=http://<host>:<port> to run upload -> generate without network."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency-ms", type=float, default=800.0, help="Mean response time.")
+        parser.add_argument("--jitter-ms", type=float, default=200.0, help="Uniform spread around the mean.")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered 500 (0-1).")
+        parser.add_argument(
+            "--rate-limit-rate", type=float, default=0.0, help="Share of requests answered 429 (0-1)."
+        )
+        parser.add_argument("--retry-after", type=int, default=2, help="Retry-After seconds sent with a 429.")
+        parser.add_argument("--seed", type=int, default=0, help="Seed for latency and failure draws.")
+        parser.add_argument(
+            "--responses",
+            default=None,
+            help='JSON file {"design": {...}, "bom": {"items": [...]}} replacing the canned answers.',
+        )
+        parser.add_argument("--verbose", action="store_true", help="Log every request.")
+
+    def handle(self, *args, **options):
+        if options["error_rate"] + options["rate_limit_rate"] > 1:
+            raise CommandError("--error-rate plus --rate-limit-rate must not exceed 1.")
+
+        responses = dict(CANNED_RESPONSES)
+        if options["responses"]:
+            with open(options["responses"], encoding="utf-8") as f:
+                responses.update(json.load(f))
+
+        server = make_server(
+            options["host"],
+            options["port"],
+            {
+                "latency_ms": options["latency_ms"],
+                "jitter_ms": options["jitter_ms"],
+                "error_rate": options["error_rate"],
+                "rate_limit_rate": options["rate_limit_rate"],
+                "retry_after": options["retry_after"],
+                "seed": options["seed"],
+                "responses": responses,
+                "verbose": options["verbose"],
+            },
+        )
+        host, port = server.server_address[:2]
+        self.stdout.write(f"Groq stand-in listening on http://{host}:{port} (GET /stats for counts)")
+        self.stdout.write(f"Set GROQ_BASE_URL=http://{host}:{port} for the app.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Requests served: {json.dumps(server.counts)}")
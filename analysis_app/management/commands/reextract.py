@@ -0,0 +1,175 @@
+# analysis_app/management/commands/reextract.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis_app.models import ReextractRun
+from analysis_app.services.ai_extractor import get_groq_client
+from analysis_app.services.groq_scheduler import status_code
+from analysis_app.services.reextract import (
+    KINDS,
+    affected_analyses,
+    batch_supported,
+    create_run,
+    finish_if_complete,
+    poll_batches,
+    run_local_pass,
+    run_progress,
+    run_queue,
+    submit_batches,
+    write_back,
+)
+
+
+def _parse_rule(value: str):
+    pmt_no, sep, equipment_no = value.rpartition("/")
+    if not sep or not pmt_no.strip() or not equipment_no.strip():
+        raise CommandError(f'Rule key must look like "MLK PMT 10105/V-005", got {value!r}')
+    return pmt_no.strip(), equipment_no.strip()
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-extract the design/BOM regions of already generated analyses, e.g. after "
+        "a template rule changed, and write the answers back into their masterfiles "
+        "and slides. Regions the text layer or OCR can read are done locally; the rest "
+        "go through the Groq batch API, or a low-priority local queue when the batch "
+        "API is not available. Progress is saved per region: an interrupted run "
+        "continues with --resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "rules",
+            nargs="*",
+            help='Template rule keys "PMT/EQUIPMENT" whose analyses to redo, e.g. "MLK PMT 10105/V-005".',
+        )
+        parser.add_argument("--analysis", type=int, action="append", default=[], help="Analysis id (repeatable).")
+        parser.add_argument("--all", action="store_true", help="Every generated analysis.")
+        parser.add_argument("--kinds", default="design,bom", help="Regions to redo: design, bom or both.")
+        parser.add_argument(
+            "--mode",
+            choices=["auto", "batch", "queue"],
+            default="auto",
+            help="batch = Groq batch API, queue = local low-priority calls, auto = batch if available.",
+        )
+        parser.add_argument("--resume", type=int, default=None, help="Continue an earlier run.")
+        parser.add_argument("--status", type=int, default=None, help="Show progress of a run and exit.")
+        parser.add_argument(
+            "--poll-interval", type=float, default=60.0, help="Seconds between batch status checks."
+        )
+        parser.add_argument(
+            "--no-wait",
+            action="store_true",
+            help="Submit batches and exit; collect and write back later with --resume.",
+        )
+        parser.add_argument("--no-local", action="store_true", help="Skip the text layer / OCR pass.")
+        parser.add_argument("--no-write", action="store_true", help="Collect answers but don't touch masterfiles.")
+        parser.add_argument("--dry-run", action="store_true", help="List affected analyses and exit.")
+
+    def _report(self, run: ReextractRun) -> None:
+        counts = ", ".join(f"{n} {status}" for status, n in run_progress(run).items() if n)
+        self.stdout.write(f"Run {run.id} [{run.mode}, {run.status}]: {counts or 'no regions'}")
+
+    def _new_run(self, options) -> ReextractRun:
+        kinds = [k.strip() for k in options["kinds"].replace("both", "design,bom").split(",") if k.strip()]
+        unknown = set(kinds) - set(KINDS)
+        if unknown or not kinds:
+            raise CommandError(f"--kinds takes design, bom or both, got {options['kinds']!r}")
+        rules = [_parse_rule(r) for r in options["rules"]]
+        if not (rules or options["analysis"] or options["all"]):
+            raise CommandError("Give rule keys, --analysis ids or --all.")
+
+        analyses = affected_analyses(rules, options["analysis"])
+        if not analyses:
+            raise CommandError("No generated analyses with design and BOM regions match.")
+        for analysis in analyses:
+            self.stdout.write(f"  {analysis.id:>6}  {analysis.original_filename}")
+        self.stdout.write(f"{len(analyses)} analyses affected")
+        if options["dry_run"]:
+            return None
+
+        description = " ".join(options["rules"]) or (
+            "all" if options["all"] else "ids " + ",".join(map(str, options["analysis"]))
+        )
+        mode = options["mode"] if options["mode"] != "auto" else "batch"
+        return create_run(analyses, kinds, mode, f"{description} ({','.join(kinds)})")
+
+    def _batch(self, run: ReextractRun, client, options) -> bool:
+        """Returns False when the batch API turned out to be unavailable."""
+        while True:
+            if run.items.filter(status="pending").exists():
+                try:
+                    submit_batches(run, client)
+                except Exception as exc:
+                    unsupported = status_code(exc) in (404, 405) or isinstance(exc, AttributeError)
+                    if options["mode"] == "auto" and unsupported:
+                        self.stdout.write(f"Batch API not available ({exc}); using the local queue")
+                        return False
+                    raise
+            finished = poll_batches(run, client)
+            if not options["no_write"]:
+                write_back(run)
+            if finished and not run.items.filter(status="pending").exists():
+                return True
+            if options["no_wait"]:
+                self.stdout.write(f"Batches still running; collect them with --resume {run.id}")
+                return True
+            self._report(run)
+            time.sleep(options["poll_interval"])
+
+    def handle(self, *args, **options):
+        if options["status"] is not None:
+            run = ReextractRun.objects.filter(pk=options["status"]).first()
+            if run is None:
+                raise CommandError(f"No re-extract run {options['status']}")
+            self._report(run)
+            return
+
+        if options["resume"] is not None:
+            run = ReextractRun.objects.filter(pk=options["resume"]).first()
+            if run is None:
+                raise CommandError(f"No re-extract run {options['resume']}")
+            if run.status != "running":
+                self._report(run)
+                return
+        else:
+            run = self._new_run(options)
+            if run is None:
+                return
+        self._report(run)
+
+        try:
+            if not options["no_local"]:
+                done = run_local_pass(run)
+                if done:
+                    self.stdout.write(f"{done} region(s) read locally")
+
+            if run.mode == "batch" and run.items.filter(status__in=("pending", "submitted")).exists():
+                try:
+                    client = get_groq_client()
+                except RuntimeError as exc:
+                    raise CommandError(str(exc))
+                if not batch_supported(client) or not self._batch(run, client, options):
+                    if options["mode"] == "batch":
+                        raise CommandError("The Groq endpoint in use has no batch API; use --mode queue")
+                    run.mode = "queue"
+                    run.save(update_fields=["mode", "updated_at"])
+
+            if run.mode == "queue":
+                run_queue(run)
+                retry = run.items.filter(status="pending").count()
+                if retry:
+                    self.stdout.write(f"{retry} region(s) failed and will be retried with --resume {run.id}")
+
+            if not options["no_write"]:
+                written = write_back(run)
+                if written:
+                    self.stdout.write(f"{written} masterfile block(s) updated")
+        except KeyboardInterrupt:
+            self.stdout.write(f"\nInterrupted; continue with --resume {run.id}")
+            return
+
+        if not options["no_write"]:
+            finish_if_complete(run)
+        self._report(run)
@@ -0,0 +1,86 @@
+# analysis_app/management/commands/run_raster_worker.py
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+
+def _worker_loop(poll_interval: float, burst: bool) -> None:
+    # children started with "spawn" (Windows) need their own app registry
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+    from analysis_app.services.raster_queue import (
+        default_worker_id,
+        requeue_stale_jobs,
+        run_next_job,
+    )
+
+    worker_id = default_worker_id()
+    print(f"Raster worker {worker_id} started")
+
+    while True:
+        close_old_connections()
+        requeue_stale_jobs()
+        if run_next_job(worker_id):
+            continue
+        if burst:
+            break
+        time.sleep(poll_interval)
+
+    print(f"Raster worker {worker_id} finished")
+
+
+class Command(BaseCommand):
+    help = (
+        "Render uploaded PDFs into page images from the RasterJob queue. "
+        "Run one per host (or more with --processes); every worker sharing the "
+        "database and MEDIA_ROOT pulls from the same queue."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of worker processes to start on this host.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds to sleep when the queue is empty.",
+        )
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Exit once the queue is empty instead of polling forever.",
+        )
+
+    def handle(self, *args, **options):
+        processes = max(1, options["processes"])
+        poll_interval = options["poll_interval"]
+        burst = options["burst"]
+
+        if processes == 1:
+            _worker_loop(poll_interval, burst)
+            return
+
+        # forked children must not inherit the parent's DB connection
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(target=_worker_loop, args=(poll_interval, burst))
+            for _ in range(processes)
+        ]
+        for w in workers:
+            w.start()
+        try:
+            for w in workers:
+                w.join()
+        except KeyboardInterrupt:
+            for w in workers:
+                w.terminate()
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-17 03:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis_app', '0003_raster_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='file_sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis_app', '0006_rate_limit_bucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractorBackendStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('backend', models.CharField(max_length=32)),
+                ('kind', models.CharField(max_length=16)),
+                ('calls', models.PositiveIntegerField(default=0)),
+                ('successes', models.PositiveIntegerField(default=0)),
+                ('total_seconds', models.FloatField(default=0.0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('backend', 'kind')},
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis_app', '0007_extractor_backend_stat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReextractRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'Running'), ('done', 'Done'), ('cancelled', 'Cancelled')], default='running', max_length=16)),
+                ('mode', models.CharField(choices=[('batch', 'Batch API'), ('queue', 'Local low-priority queue')], max_length=16)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReextractItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('submitted', 'Submitted'), ('done', 'Done'), ('written', 'Written'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('batch_id', models.CharField(blank=True, db_index=True, max_length=64, null=True)),
+                ('cache_key', models.CharField(blank=True, max_length=64, null=True)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('source', models.CharField(blank=True, max_length=32)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='analysis_app.analysis')),
+                ('region', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='analysis_app.regionselection')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='analysis_app.reextractrun')),
+            ],
+            options={
+                'ordering': ['analysis_id', 'region_id'],
+                'indexes': [models.Index(fields=['run', 'status'], name='analysis_ap_run_id_049b71_idx')],
+            },
+        ),
+    ]
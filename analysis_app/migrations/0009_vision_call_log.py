@@ -0,0 +1,39 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis_app', '0008_reextract_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisionCallLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('step_type', models.CharField(max_length=16)),
+                ('pmt_no', models.CharField(blank=True, max_length=64)),
+                ('equipment_no', models.CharField(blank=True, max_length=32)),
+                ('model', models.CharField(max_length=100)),
+                ('image_count', models.PositiveSmallIntegerField(default=1)),
+                ('image_bytes', models.PositiveIntegerField(default=0)),
+                ('prompt_chars', models.PositiveIntegerField(default=0)),
+                ('prompt_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('completion_tokens', models.PositiveIntegerField(blank=True, null=True)),
+                ('latency_ms', models.PositiveIntegerField(default=0)),
+                ('queued_ms', models.PositiveIntegerField(default=0)),
+                ('retries', models.PositiveSmallIntegerField(default=0)),
+                ('outcome', models.CharField(choices=[('ok', 'OK'), ('repaired', 'OK after JSON repair'), ('parse_failed', 'Unusable answer'), ('request_failed', 'Request failed'), ('circuit_open', 'Skipped, circuit open')], max_length=16)),
+                ('analysis', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='analysis_app.analysis')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['pmt_no', 'equipment_no'], name='analysis_ap_pmt_no_2a5cf8_idx')],
+            },
+        ),
+    ]
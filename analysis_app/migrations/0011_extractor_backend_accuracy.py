@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis_app', '0010_generate_stream_nonce'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractorbackendstat',
+            name='agreed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='extractorbackendstat',
+            name='checked',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
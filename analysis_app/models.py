@@ -28,6 +28,20 @@ class ExternalUser(models.Model):
         return f"{self.provider}:{self.external_id}"
 
 
+class UploadBatch(models.Model):
+    created_by = models.ForeignKey(
+        ExternalUser,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="upload_batches",
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Batch {self.id}"
+
+
 class Analysis(models.Model):
     STATUS_CHOICES = [
         ("pending", "Pending"),
@@ -39,12 +53,14 @@ class Analysis(models.Model):
     ]
 
     file = models.FileField(upload_to="analysis/pdf/")
+    file_sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True)
     original_filename = models.CharField(max_length=255)
     status = models.CharField(
         max_length=32, choices=STATUS_CHOICES, default="awaiting_regions"
     )
     workbook_path = models.CharField(max_length=500, null=True, blank=True)
     pptx_path = models.CharField(max_length=500, null=True, blank=True)
+    page_count = models.PositiveIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     
@@ -55,6 +71,13 @@ class Analysis(models.Model):
         blank=True,
         related_name="analyses",
     )
+    batch = models.ForeignKey(
+        UploadBatch,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="analyses",
+    )
 
     def __str__(self):
         return f"{self.original_filename} ({self.id})"
@@ -106,4 +129,214 @@ class RegionSelection(models.Model):
         ]
 
     def __str__(self):
-        return f"{self.analysis_id} - {self.step_type} - p{self.page.page_number}"
\ No newline at end of file
+        return f"{self.analysis_id} - {self.step_type} - p{self.page.page_number}"
+
+
+class RasterJob(models.Model):
+    STATUS_CHOICES = [
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    analysis = models.ForeignKey(
+        Analysis, on_delete=models.CASCADE, related_name="raster_jobs"
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default="queued")
+    attempts = models.PositiveIntegerField(default=0)
+
+    # hostname:pid of the worker holding the job (workers may run on several hosts)
+    worker_id = models.CharField(max_length=128, null=True, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["status", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"RasterJob {self.id} - analysis {self.analysis_id} ({self.status})"
+
+
+class RateLimitBucket(models.Model):
+    """
+    Shared state for one external API across every process: a GCRA token
+    bucket (tat = theoretical arrival time, epoch seconds) plus a circuit
+    breaker. Rows are locked with select_for_update while being updated.
+    """
+
+    name = models.CharField(max_length=64, unique=True)
+    tat = models.FloatField(default=0.0)
+
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    open_until = models.FloatField(null=True, blank=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"RateLimitBucket {self.name}"
+
+
+class ExtractorBackendStat(models.Model):
+    """
+    Running totals per extractor backend and table kind, used by the
+    backend router to rank backends by expected latency and hit rate.
+    A success is a call that returned usable data for the region; whether
+    that data was right is only known for the sampled calls checked
+    against the vision answer (checked / agreed).
+    """
+
+    backend = models.CharField(max_length=32)
+    kind = models.CharField(max_length=16)  # "design" or "bom"
+
+    calls = models.PositiveIntegerField(default=0)
+    successes = models.PositiveIntegerField(default=0)
+    total_seconds = models.FloatField(default=0.0)
+    checked = models.PositiveIntegerField(default=0)
+    agreed = models.PositiveIntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("backend", "kind")
+
+    def __str__(self):
+        return f"{self.backend}/{self.kind}: {self.successes}/{self.calls}"
+
+
+class ReextractRun(models.Model):
+    """
+    One bulk re-extraction (`manage.py reextract`), e.g. after a template
+    rule changed. Progress lives on its items, so an interrupted run can be
+    resumed with --resume <id>.
+    """
+
+    STATUS_CHOICES = [
+        ("running", "Running"),
+        ("done", "Done"),
+        ("cancelled", "Cancelled"),
+    ]
+    MODE_CHOICES = [
+        ("batch", "Batch API"),
+        ("queue", "Local low-priority queue"),
+    ]
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default="running")
+    mode = models.CharField(max_length=16, choices=MODE_CHOICES)
+    # what was selected, for the log ("MLK PMT 10105/V-005, kinds=design")
+    description = models.CharField(max_length=255, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"ReextractRun {self.id} ({self.mode}, {self.status})"
+
+
+class ReextractItem(models.Model):
+    """One region of one analysis to re-extract; the checkpoint unit of a run."""
+
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("submitted", "Submitted"),  # in a batch job, waiting for its output
+        ("done", "Done"),  # result stored, not yet written to the masterfile
+        ("written", "Written"),
+        ("failed", "Failed"),
+    ]
+
+    run = models.ForeignKey(ReextractRun, on_delete=models.CASCADE, related_name="items")
+    analysis = models.ForeignKey(Analysis, on_delete=models.CASCADE, related_name="+")
+    region = models.ForeignKey(RegionSelection, on_delete=models.CASCADE, related_name="+")
+    kind = models.CharField(max_length=16)  # "design" or "bom"
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default="pending")
+    batch_id = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    cache_key = models.CharField(max_length=64, null=True, blank=True)
+    # normalised design dict or BOM item list
+    result = models.JSONField(null=True, blank=True)
+    source = models.CharField(max_length=32, blank=True)  # backend that produced the result
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["analysis_id", "region_id"]
+        indexes = [
+            models.Index(fields=["run", "status"]),
+        ]
+
+    @property
+    def custom_id(self) -> str:
+        return f"reextract-{self.run_id}-{self.id}"
+
+    def __str__(self):
+        return f"ReextractItem {self.id} - analysis {self.analysis_id} {self.kind} ({self.status})"
+
+
+class VisionCallLog(models.Model):
+    """
+    One Groq vision request made by ai_extractor: what was sent, how long it
+    took and whether a usable answer came back. Cache hits and regions read
+    by the local backends make no request and are not logged.
+    """
+
+    OUTCOME_CHOICES = [
+        ("ok", "OK"),
+        ("repaired", "OK after JSON repair"),
+        ("parse_failed", "Unusable answer"),
+        ("request_failed", "Request failed"),
+        ("circuit_open", "Skipped, circuit open"),
+    ]
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    analysis = models.ForeignKey(Analysis, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    step_type = models.CharField(max_length=16)  # "design", "bom" or "combined"
+    pmt_no = models.CharField(max_length=64, blank=True)
+    equipment_no = models.CharField(max_length=32, blank=True)
+    model = models.CharField(max_length=100)
+
+    image_count = models.PositiveSmallIntegerField(default=1)
+    image_bytes = models.PositiveIntegerField(default=0)  # after preprocessing, before base64
+    prompt_chars = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True)
+
+    latency_ms = models.PositiveIntegerField(default=0)  # time spent in requests, all attempts
+    queued_ms = models.PositiveIntegerField(default=0)  # rate limit queue and retry backoff
+    retries = models.PositiveSmallIntegerField(default=0)
+    outcome = models.CharField(max_length=16, choices=OUTCOME_CHOICES)
+
+    class Meta:
+        ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["pmt_no", "equipment_no"]),
+        ]
+
+    @property
+    def failed(self) -> bool:
+        return self.outcome not in ("ok", "repaired")
+
+    def __str__(self):
+        return f"VisionCallLog {self.id} - {self.step_type} {self.pmt_no}/{self.equipment_no} ({self.outcome})"
+
+
+class GenerateStreamNonce(models.Model):
+    """
+    Nonces of generate stream tokens that were opened. Kept in the database
+    so a token is single-use across every worker process, not just the one
+    that served it. Rows older than the token lifetime are deleted as new
+    ones come in.
+    """
+
+    nonce = models.CharField(max_length=32, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"GenerateStreamNonce {self.nonce}"
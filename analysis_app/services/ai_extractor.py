@@ -2,94 +2,390 @@
 from __future__ import annotations
 
 import base64
-import json
+import hashlib
 import os
 import re
+import threading
+import time
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from .backends import ExtractionCancelled, RegionJob, extract_region
+from .groq_scheduler import CircuitOpenError, run_scheduled
+from .preprocess import preprocess_config, preprocess_for_vision
+from .telemetry import record_vision_call
 from .template_rules import get_design_rule, get_bom_rule
+from .text_layer import TextRegion
+from .vision_cache import cache_enabled, cache_get, cache_put, vision_cache_key
+from .vision_schema import (
+    BOM_SCHEMA,
+    DESIGN_SCHEMA,
+    combined_schema,
+    parse_stats,
+    record_parse,
+    repair_json,
+    validate,
+)
 
 
 from django.conf import settings
 
 try:
-    from groq import Groq
+    import httpx
+    from groq import DefaultHttpxClient, Groq
 except ImportError:  
     Groq = None  
 
 
+# one client per process: httpx.Client is thread-safe, so every extraction
+# thread shares its keep-alive pool instead of opening a connection per call
+_client_lock = threading.Lock()
+_client: Optional[Tuple[Tuple[Any, ...], Any]] = None  # (identity, client)
 
 
-def _get_groq_client() -> Any:
-    
+def _http_client() -> Any:
+    timeout = httpx.Timeout(
+        float(getattr(settings, "GROQ_TIMEOUT", 60.0)),
+        connect=float(getattr(settings, "GROQ_CONNECT_TIMEOUT", 5.0)),
+    )
+    limits = httpx.Limits(
+        max_connections=int(getattr(settings, "GROQ_HTTP_MAX_CONNECTIONS", 20)),
+        max_keepalive_connections=int(getattr(settings, "GROQ_HTTP_MAX_KEEPALIVE", 10)),
+        keepalive_expiry=float(getattr(settings, "GROQ_HTTP_KEEPALIVE_EXPIRY", 60.0)),
+    )
+    return DefaultHttpxClient(timeout=timeout, limits=limits)
+
+
+def get_groq_client() -> Any:
+    """
+    The shared Groq client, created on first use. A new one is built when
+    the API key or base URL changes, and in a forked child process (a
+    connection pool must not be shared across a fork).
+    """
+    global _client
     if Groq is None:
         raise RuntimeError("groq-python package is not installed")
     api_key = os.environ.get("GROQ_API_KEY")
+    base_url = getattr(settings, "GROQ_BASE_URL", None) or None
     if not api_key:
-        raise RuntimeError("GROQ_API_KEY environment variable is not set")
-    return Groq(api_key=api_key)
+        if not base_url:
+            raise RuntimeError("GROQ_API_KEY environment variable is not set")
+        api_key = "standin"  # a local stand-in (manage.py groq_standin) takes any key
+
+    identity = (os.getpid(), api_key, base_url)
+    current = _client
+    if current is not None and current[0] == identity:
+        return current[1]
+    with _client_lock:
+        if _client is None or _client[0] != identity:
+            # retries and backoff are done by groq_scheduler, shared across processes
+            client = Groq(api_key=api_key, base_url=base_url, max_retries=0, http_client=_http_client())
+            _client = (identity, client)
+        return _client[1]
+
+
+# a crop is either a path relative to MEDIA_ROOT or the encoded PNG bytes
+ImageSource = Union[str, bytes]
+
+
+def _image_bytes(image: ImageSource) -> bytes:
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    abs_path = Path(settings.MEDIA_ROOT) / image
+    with abs_path.open("rb") as f:
+        return f.read()
 
 
-def _image_rel_to_data_url(image_rel_path: str, mime_type: str = "image/png") -> str:
-    
-    abs_path = Path(settings.MEDIA_ROOT) / image_rel_path
-    with abs_path.open("rb") as f:
-        b64 = base64.b64encode(f.read()).decode("ascii")
+def _image_to_data_url(image: ImageSource, mime_type: str = "image/png") -> str:
+
+    b64 = base64.b64encode(_image_bytes(image)).decode("ascii")
     return f"data:{mime_type};base64,{b64}"
 
 
-def _extract_json_from_text(text: str) -> Optional[dict]:
-   
-    if not text:
-        return None
-    start = text.find("{")
-    end = text.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        print("Groq content not JSON-like:", text[:200])
-        return None
-    json_str = text[start : end + 1]
+VISION_SYSTEM_PROMPT = (
+    "You are an OCR/table extraction assistant for engineering drawings.\n"
+    "You MUST return ONLY a single valid JSON object.\n"
+    "Do not include explanations, comments, markdown or any text outside the JSON."
+)
+
+
+def _vision_model() -> str:
+    return getattr(settings, "GROQ_VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
+
+
+def _vision_temperature() -> float:
+    return float(getattr(settings, "GROQ_VISION_TEMPERATURE", 0.0))
+
+
+def _prepare_vision_image(data: bytes) -> bytes:
+    # shrink the payload before it is base64-encoded; fall back to the raw crop
     try:
-        return json.loads(json_str)
-    except json.JSONDecodeError as exc:
-        print("Failed to parse JSON from Groq:", exc)
-        print("Raw JSON candidate:", json_str[:400])
+        data, _ = preprocess_for_vision(data)
+    except Exception as exc:
+        print("Image preprocessing failed, sending original crop:", exc)
+    return data
+
+
+def _parse_vision_json(text: str, schema: Optional[Dict[str, Any]]) -> Tuple[Optional[dict], str]:
+    """
+    Parse (repairing locally if needed) and validate one answer, and count
+    the outcome ("clean", "repaired" or "failed") in vision_schema.parse_stats().
+    """
+    data, repairs = repair_json(text)
+    if isinstance(data, list) and schema and "items" in schema:
+        data, repairs = {"items": data}, repairs + ["top-level list wrapped in items"]
+    if not isinstance(data, dict):
+        record_parse("failed")
+        stats = parse_stats()
+        print(
+            f"Groq JSON unusable ({', '.join(repairs) or type(data).__name__}); "
+            f"failure rate {stats['failure_rate']:.0%} of {stats['calls']} calls"
+        )
+        print("Raw content:", (text or "")[:400])
+        return None, "failed"
+
+    problems: List[str] = []
+    if schema:
+        data, problems = validate(data, schema)
+    outcome = "repaired" if repairs or problems else "clean"
+    record_parse(outcome)
+    if repairs or problems:
+        stats = parse_stats()
+        print(
+            f"Groq JSON repaired: {'; '.join(repairs + problems)[:400]} "
+            f"(repair rate {stats['repair_rate']:.0%} of {stats['calls']} calls)"
+        )
+    return data, outcome
+
+
+_json_mode_unsupported: set = set()
+
+
+def _json_mode(model: str) -> bool:
+    return bool(getattr(settings, "GROQ_JSON_MODE", True)) and model not in _json_mode_unsupported
+
+
+def _error_body(exc: BaseException) -> Dict[str, Any]:
+    body = getattr(exc, "body", None)
+    if isinstance(body, dict):
+        return body.get("error", body) if isinstance(body.get("error", body), dict) else {}
+    return {}
+
+
+def _vision_key(raws: List[bytes], instruction: str, model: str, temperature: float) -> str:
+    image_key = raws[0] if len(raws) == 1 else b"".join(hashlib.sha256(r).digest() for r in raws)
+    return vision_cache_key(
+        image_key,
+        VISION_SYSTEM_PROMPT + "\n" + instruction,
+        model,
+        temperature,
+        variant={"preprocess": preprocess_config()},
+    )
+
+
+def _cached_vision_answer(image: ImageSource, instruction: str) -> Optional[dict]:
+    if not cache_enabled():
         return None
+    key = _vision_key([_image_bytes(image)], instruction, _vision_model(), _vision_temperature())
+    cached = cache_get(key)
+    if isinstance(cached, dict):
+        print(f"Vision cache hit {key[:12]}; backends skipped")
+        return cached
+    return None
+
+
+def _extract_routed(
+    kind: str,
+    image: ImageSource,
+    instruction: str,
+    schema: Dict[str, Any],
+    text_region: Optional[TextRegion],
+    rule,
+    use_cache: bool,
+    call_info: Optional[Dict[str, Any]] = None,
+    on_token: Optional[Callable[[Optional[str]], None]] = None,
+) -> Dict[str, Any]:
+    # an earlier vision answer for this exact crop beats re-running any backend
+    data = _cached_vision_answer(image, instruction) if use_cache else None
+    if data:
+        return data
+    job = RegionJob(
+        kind=kind,
+        image=_image_bytes(image),
+        text_region=text_region,
+        rule=rule,
+        vision=lambda: _call_groq_vision_json(
+            image, instruction, use_cache=False, schema=schema, call_info=call_info, on_token=on_token
+        ),
+    )
+    data, _ = extract_region(job)
+    return data or {}
 
 
-def _call_groq_vision_json(image_rel_path: str, instruction: str) -> Optional[dict]:
-   
-    client = _get_groq_client()
-    image_url = _image_rel_to_data_url(image_rel_path)
+def _call_info(
+    analysis_id: Optional[int], step_type: str, pmt_no: Optional[str], equipment_no: Optional[str]
+) -> Dict[str, Any]:
+    # what VisionCallLog records about the caller
+    return {"analysis_id": analysis_id, "step_type": step_type, "pmt_no": pmt_no, "equipment_no": equipment_no}
+
+
+def _user_content(prepared: List[bytes], instruction: str) -> List[Dict[str, Any]]:
+    # `prepared` are crops already through _prepare_vision_image
+    content: List[Dict[str, Any]] = [{"type": "text", "text": instruction}]
+    for data in prepared:
+        content.append({"type": "image_url", "image_url": {"url": _image_to_data_url(data)}})
+    return content
+
 
+def _chat_request(
+    user_content: List[Dict[str, Any]], model: str, temperature: float, json_mode: bool
+) -> Dict[str, Any]:
+    request: Dict[str, Any] = {
+        "model": model,
+        "messages": [
+            {
+                "role": "system",
+                "content": VISION_SYSTEM_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": user_content,
+            },
+        ],
+        "max_completion_tokens": 2048,
+        "temperature": temperature,
+    }
+    if json_mode:
+        request["response_format"] = {"type": "json_object"}
+    return request
+
+
+def _stream_completion(client, request: Dict[str, Any], on_token: Callable[[Optional[str]], None]) -> Any:
+    """Run a streamed chat completion; returns an object shaped like a non-streamed one."""
+    on_token(None)
+    parts: List[str] = []
+    usage = None
+    stream = client.chat.completions.create(stream=True, **request)
     try:
-        completion = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are an OCR/table extraction assistant for engineering drawings.\n"
-                        "You MUST return ONLY a single valid JSON object.\n"
-                        "Do not include explanations, comments, markdown or any text outside the JSON."
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": instruction},
-                        {"type": "image_url", "image_url": {"url": image_url}},
-                    ],
-                },
-            ],
-            max_completion_tokens=2048,
-            temperature=0.0,
+        for chunk in stream:
+            if chunk.choices:
+                delta = getattr(chunk.choices[0].delta, "content", None)
+                if delta:
+                    parts.append(delta)
+                    on_token(delta)
+            # Groq sends usage on the last chunk
+            x_groq = getattr(chunk, "x_groq", None)
+            usage = getattr(x_groq, "usage", None) or getattr(chunk, "usage", None) or usage
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    message = SimpleNamespace(content="".join(parts))
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+def _call_groq_vision_json(
+    image: Union[ImageSource, Sequence[ImageSource]],
+    instruction: str,
+    use_cache: bool = True,
+    schema: Optional[Dict[str, Any]] = None,
+    call_info: Optional[Dict[str, Any]] = None,
+    on_token: Optional[Callable[[Optional[str]], None]] = None,
+) -> Optional[dict]:
+    """
+    `image` may be a list to send several crops in one request (combined mode).
+    use_cache=False skips the cache lookup (the fresh answer is still stored),
+    which is how a forced regenerate refreshes stale entries. The answer is
+    checked against `schema` (vision_schema) and shaped to it.
+    Every request is logged to VisionCallLog with `call_info` (analysis_id,
+    step_type, pmt_no, equipment_no).
+    With `on_token` the answer is streamed: it gets each text chunk as it
+    arrives, and None when an attempt starts (drop text from a failed one).
+    It may raise ExtractionCancelled to abandon the request.
+    """
+    images = list(image) if isinstance(image, (list, tuple)) else [image]
+    raws = [_image_bytes(i) for i in images]
+    model = _vision_model()
+    temperature = _vision_temperature()
+
+    cache_key = None
+    if cache_enabled():
+        cache_key = _vision_key(raws, instruction, model, temperature)
+        if use_cache:
+            cached = cache_get(cache_key)
+            if isinstance(cached, dict):
+                print(f"Vision cache hit {cache_key[:12]}; Groq call skipped")
+                return cached
+
+    client = get_groq_client()
+    prepared = [_prepare_vision_image(raw) for raw in raws]
+    user_content = _user_content(prepared, instruction)
+
+    info = dict(call_info or {})
+    sched: Dict[str, float] = {}
+    started = time.perf_counter()
+
+    def log(outcome: str, completion: Any = None) -> None:
+        usage = getattr(completion, "usage", None)
+        record_vision_call(
+            analysis_id=info.get("analysis_id"),
+            step_type=info.get("step_type") or "",
+            pmt_no=(info.get("pmt_no") or "")[:64],
+            equipment_no=(info.get("equipment_no") or "")[:32],
+            model=model[:100],
+            image_count=len(prepared),
+            image_bytes=sum(len(p) for p in prepared),
+            prompt_chars=len(VISION_SYSTEM_PROMPT) + len(instruction),
+            prompt_tokens=getattr(usage, "prompt_tokens", None),
+            completion_tokens=getattr(usage, "completion_tokens", None),
+            # request time of every attempt; falls back to wall time when the call never got scheduled
+            latency_ms=int(1000 * (sched.get("request_seconds") or (time.perf_counter() - started))),
+            queued_ms=int(1000 * sched.get("waited", 0)),
+            retries=int(sched.get("retries", 0)),
+            outcome=outcome,
         )
+
+    def create(json_mode: bool):
+        request = _chat_request(user_content, model, temperature, json_mode)
+        if on_token is None:
+            return client.chat.completions.create(**request)
+        return _stream_completion(client, request, on_token)
+
+    # JSON mode can't be combined with streaming; the local repair covers what it would catch
+    json_mode = _json_mode(model) and on_token is None
+    content: Any = None
+    completion: Any = None
+    try:
+        try:
+            completion = run_scheduled(lambda: create(json_mode), label="Groq Vision", info=sched)
+        except Exception as exc:
+            error = _error_body(exc)
+            if not json_mode or getattr(exc, "status_code", None) != 400:
+                raise
+            if error.get("code") == "json_validate_failed" and error.get("failed_generation"):
+                # JSON mode rejected the model's output; repair that text instead of asking again
+                print("Groq JSON mode rejected the answer; repairing the failed generation locally")
+                content = error["failed_generation"]
+            elif "response_format" in str(error.get("message") or exc):
+                print(f"JSON mode not supported for {model}; retrying without it")
+                _json_mode_unsupported.add(model)
+                completion = run_scheduled(lambda: create(False), label="Groq Vision", info=sched)
+            else:
+                raise
+    except ExtractionCancelled:
+        raise
+    except CircuitOpenError as exc:
+        print("Groq Vision skipped:", exc)
+        log("circuit_open")
+        return None
     except Exception as exc:
         print("Groq Vision error (request failed):", exc)
+        log("request_failed")
         return None
 
-    message = completion.choices[0].message
-    content = getattr(message, "content", "") or ""
+    if content is None:
+        message = completion.choices[0].message
+        content = getattr(message, "content", "") or ""
 
     print("\n========= GROQ RAW RESPONSE (first 400 chars) =========")
     print(str(content)[:400])
@@ -100,10 +396,17 @@ def _call_groq_vision_json(image_rel_path: str, instruction: str) -> Optional[di
             content = str(content)
         except Exception:
             print("Groq content could not be converted to string")
+            log("parse_failed", completion)
             return None
 
-    data = _extract_json_from_text(content)
+    data, parsed = _parse_vision_json(content, schema)
+    log({"clean": "ok", "repaired": "repaired"}.get(parsed, "parse_failed"), completion)
     print("🔍 Parsed JSON keys:", list(data.keys()) if isinstance(data, dict) else data)
+    if cache_key and isinstance(data, dict):
+        try:
+            cache_put(cache_key, data)
+        except OSError as exc:
+            print("Vision cache write failed:", exc)
     return data
 
 
@@ -131,82 +434,78 @@ def _to_float_maybe(value: Any) -> Optional[float]:
 
 
 
-def extract_design_metadata(
-    image_rel_path: str,
-    pmt_no: Optional[str] = None,
-    equipment_no: Optional[str] = None,
-) -> Dict[str, Any]:
-   
-    base_instruction = (
-        "The image is a DESIGN DATA (or similar) table from a pressure vessel or heat exchanger drawing.\n"
-        "Identify ONLY the main DESIGN / OPERATING data table and ignore any BOM / bill of materials.\n\n"
-        "You MUST return ONLY a JSON object with exactly this structure:\n"
-        "{\n"
-        '  \"fluids\": {\n'
-        '    \"shell\": string or null,\n'
-        '    \"tube\": string or null,\n'
-        '    \"header\": string or null\n'
-        "  },\n"
-        '  \"insulation\": string or null,\n'
-        '  \"design\": {\n'
-        '    \"shell\": { \"temp_c\": number or null, \"pressure_mpa\": number or null },\n'
-        '    \"tube\":  { \"temp_c\": number or null, \"pressure_mpa\": number or null }\n'
-        "  },\n"
-        '  \"operating\": {\n'
-        '    \"shell\": { \"temp_c\": number or null, \"pressure_mpa\": number or null },\n'
-        '    \"tube\":  { \"temp_c\": number or null, \"pressure_mpa\": number or null }\n'
-        "  }\n"
-        "}\n\n"
-        "INTERPRETATION RULES (VERY IMPORTANT):\n"
-        "- Tables may use labels like OPERATING, OPERATION, WORKING, or WKG:\n"
-        "  * Anything labelled WORKING PRESSURE / WORKING TEMPERATURE or similar = OPERATING conditions.\n"
-        "  * Anything labelled OPERATING PRESSURE / OPERATING TEMPERATURE = OPERATING conditions.\n"
-        "  * Anything labelled DESIGN PRESSURE / DESIGN TEMPERATURE = DESIGN conditions.\n"
-        "  * If there are TWO repeated blocks of PRESSURE/TEMPERATURE rows without clear labels,\n"
-        "    assume the FIRST block is OPERATING and the SECOND block is DESIGN.\n"
-        "\n"
-        "- Column headings may be SHELL SIDE / TUBE SIDE / CHANNEL / TUBE BUNDLE / HEAD, etc.:\n"
-        "  * Map anything clearly belonging to SHELL, SHELL SIDE, SHELL PART → shell.\n"
-        "  * Map anything clearly belonging to TUBE, TUBE SIDE, CHANNEL, TUBE BUNDLE, HEADER → tube.\n"
-        "  * If only a single value is given (no split), use the same value for both shell and tube.\n"
-        "\n"
-        "- Pressure units:\n"
-        "  * Convert kg/cm2, bar, kPa, etc. to MPa if possible.\n"
-        "  * If unit is not obvious but looks like e.g. \"1.00 KPDG\" or similar, treat it as 1.00 MPa.\n"
-        "  * If you cannot confidently convert, copy the numeric value and assume it is already MPa.\n"
-        "\n"
-        "- Temperature units:\n"
-        "  * Assume °C unless clearly specified otherwise.\n"
-        "\n"
-        "- FLUID / MEDIUM mapping:\n"
-        "  * Use rows labelled FLUID, FLUID NAME, MEDIUM OF SERVICE, or similar.\n"
-        "  * If there are separate columns for SHELL SIDE and TUBE SIDE, map them to fluids.shell and fluids.tube.\n"
-        "  * If there is only one fluid name for the whole equipment, put it into fluids.shell and fluids.tube.\n"
-        "  * If there is a separate HEADER/CHANNEL/TUBE BUNDLE fluid, you may put that into fluids.header.\n"
-        "\n"
-        "- INSULATION mapping:\n"
-        "  * Look for rows labelled INSULATION, DEGREE OF INSULATION, or similar.\n"
-        "  * Also consider rows like FULL/SPOT/NONE RADIOGRAPHY or DEGREE OF RADIOGRAPHY if there is\n"
-        "    no explicit INSULATION row; in that case copy the most relevant text as insulation.\n"
-        "  * If the table clearly indicates NO INSULATION (NIL, NONE, NO INSULATION, '-' etc.),\n"
-        "    set insulation to that text (e.g. \"NIL\" or \"NO INSULATION\").\n"
-        "\n"
-        "- If a value is missing / unreadable, use null.\n"
-        "- Do NOT add extra keys or nested structures beyond the JSON schema above.\n"
-    )
-
-   
-    rule = None
-    if pmt_no and equipment_no:
-        rule = get_design_rule(pmt_no, equipment_no)
-
-    instruction = base_instruction
+DESIGN_INSTRUCTION = (
+    "The image is a DESIGN DATA (or similar) table from a pressure vessel or heat exchanger drawing.\n"
+    "Identify ONLY the main DESIGN / OPERATING data table and ignore any BOM / bill of materials.\n\n"
+    "You MUST return ONLY a JSON object with exactly this structure:\n"
+    "{\n"
+    '  \"fluids\": {\n'
+    '    \"shell\": string or null,\n'
+    '    \"tube\": string or null,\n'
+    '    \"header\": string or null\n'
+    "  },\n"
+    '  \"insulation\": string or null,\n'
+    '  \"design\": {\n'
+    '    \"shell\": { \"temp_c\": number or null, \"pressure_mpa\": number or null },\n'
+    '    \"tube\":  { \"temp_c\": number or null, \"pressure_mpa\": number or null }\n'
+    "  },\n"
+    '  \"operating\": {\n'
+    '    \"shell\": { \"temp_c\": number or null, \"pressure_mpa\": number or null },\n'
+    '    \"tube\":  { \"temp_c\": number or null, \"pressure_mpa\": number or null }\n'
+    "  }\n"
+    "}\n\n"
+    "INTERPRETATION RULES (VERY IMPORTANT):\n"
+    "- Tables may use labels like OPERATING, OPERATION, WORKING, or WKG:\n"
+    "  * Anything labelled WORKING PRESSURE / WORKING TEMPERATURE or similar = OPERATING conditions.\n"
+    "  * Anything labelled OPERATING PRESSURE / OPERATING TEMPERATURE = OPERATING conditions.\n"
+    "  * Anything labelled DESIGN PRESSURE / DESIGN TEMPERATURE = DESIGN conditions.\n"
+    "  * If there are TWO repeated blocks of PRESSURE/TEMPERATURE rows without clear labels,\n"
+    "    assume the FIRST block is OPERATING and the SECOND block is DESIGN.\n"
+    "\n"
+    "- Column headings may be SHELL SIDE / TUBE SIDE / CHANNEL / TUBE BUNDLE / HEAD, etc.:\n"
+    "  * Map anything clearly belonging to SHELL, SHELL SIDE, SHELL PART → shell.\n"
+    "  * Map anything clearly belonging to TUBE, TUBE SIDE, CHANNEL, TUBE BUNDLE, HEADER → tube.\n"
+    "  * If only a single value is given (no split), use the same value for both shell and tube.\n"
+    "\n"
+    "- Pressure units:\n"
+    "  * Convert kg/cm2, bar, kPa, etc. to MPa if possible.\n"
+    "  * If unit is not obvious but looks like e.g. \"1.00 KPDG\" or similar, treat it as 1.00 MPa.\n"
+    "  * If you cannot confidently convert, copy the numeric value and assume it is already MPa.\n"
+    "\n"
+    "- Temperature units:\n"
+    "  * Assume °C unless clearly specified otherwise.\n"
+    "\n"
+    "- FLUID / MEDIUM mapping:\n"
+    "  * Use rows labelled FLUID, FLUID NAME, MEDIUM OF SERVICE, or similar.\n"
+    "  * If there are separate columns for SHELL SIDE and TUBE SIDE, map them to fluids.shell and fluids.tube.\n"
+    "  * If there is only one fluid name for the whole equipment, put it into fluids.shell and fluids.tube.\n"
+    "  * If there is a separate HEADER/CHANNEL/TUBE BUNDLE fluid, you may put that into fluids.header.\n"
+    "\n"
+    "- INSULATION mapping:\n"
+    "  * Look for rows labelled INSULATION, DEGREE OF INSULATION, or similar.\n"
+    "  * Also consider rows like FULL/SPOT/NONE RADIOGRAPHY or DEGREE OF RADIOGRAPHY if there is\n"
+    "    no explicit INSULATION row; in that case copy the most relevant text as insulation.\n"
+    "  * If the table clearly indicates NO INSULATION (NIL, NONE, NO INSULATION, '-' etc.),\n"
+    "    set insulation to that text (e.g. \"NIL\" or \"NO INSULATION\").\n"
+    "\n"
+    "- If a value is missing / unreadable, use null.\n"
+    "- Do NOT add extra keys or nested structures beyond the JSON schema above.\n"
+)
+
+
+def _with_rule_notes(instruction: str, rule) -> str:
     if rule and rule.extra_prompt:
         instruction += "\n\nTEMPLATE-SPECIFIC NOTES FOR THIS DRAWING:\n" + rule.extra_prompt
+    return instruction
+
+
+def _design_rule(pmt_no: Optional[str], equipment_no: Optional[str]):
+    if pmt_no and equipment_no:
+        return get_design_rule(pmt_no, equipment_no)
+    return None
 
-    data = _call_groq_vision_json(image_rel_path, instruction) or {}
-    print("DEBUG design raw data:", data)
 
+def _normalize_design(data: Dict[str, Any], rule) -> Dict[str, Any]:
     fluids = data.get("fluids") or {}
     design = data.get("design") or {}
     operating = data.get("operating") or {}
@@ -276,46 +575,60 @@ def extract_design_metadata(
     return result
 
 
-
-def extract_bom_materials(
-    image_rel_path: str,
+def extract_design_metadata(
+    image: ImageSource,
     pmt_no: Optional[str] = None,
     equipment_no: Optional[str] = None,
-) -> List[Dict[str, Any]]:
-    
-    base_instruction = (
-        "The image is a BILL OF MATERIAL (BOM) table from an engineering drawing.\n"
-        "Identify ONLY the main BOM table and ignore DESIGN DATA or other tables.\n\n"
-        "You MUST return ONLY a JSON object with this structure:\n"
-        "{\n"
-        '  \"items\": [\n'
-        '    { \"part_label\": string, \"material_raw\": string, \"side\": string or null },\n'
-        "    ...\n"
-        "  ]\n"
-        "}\n\n"
-        "General rules:\n"
-        "- Each row for a real pressure part (HEAD, SHELL, BOTTOM HEAD, CHANNEL, "
-        "TUBE BUNDLE, etc.) becomes one item.\n"
-        "- part_label: a clean logical name such as 'Shell', 'Head', 'Bottom Head', "
-        "'Channel', or 'Tube Bundle' that can be matched against Excel part names.\n"
-        "- material_raw: the full material string (for example 'SA-516-70', "
-        "'SA-240 316', 'A/SA 516 Gr 70', 'FE-560-Gr912/789L', 'ZY-982-GR.212/678K').\n"
-        "- side: if there is shell/tube information, set side to 'shell' or 'tube'. "
-        "If not clear, infer (heads/shells → 'shell', channels/tube bundles/headers → 'tube').\n"
-        "- Ignore bolts, nuts, gaskets and other non-primary pressure parts.\n"
-        "- Do NOT add extra keys.\n"
+    text_region: Optional[TextRegion] = None,
+    use_cache: bool = True,
+    analysis_id: Optional[int] = None,
+    on_token: Optional[Callable[[Optional[str]], None]] = None,
+) -> Dict[str, Any]:
+   
+    rule = _design_rule(pmt_no, equipment_no)
+    instruction = _with_rule_notes(DESIGN_INSTRUCTION, rule)
+
+    call_info = _call_info(analysis_id, "design", pmt_no, equipment_no)
+    data = _extract_routed(
+        "design", image, instruction, DESIGN_SCHEMA, text_region, rule, use_cache, call_info, on_token
     )
+    print("DEBUG design raw data:", data)
 
-    rule = None
+    return _normalize_design(data, rule)
+
+
+
+BOM_INSTRUCTION = (
+    "The image is a BILL OF MATERIAL (BOM) table from an engineering drawing.\n"
+    "Identify ONLY the main BOM table and ignore DESIGN DATA or other tables.\n\n"
+    "You MUST return ONLY a JSON object with this structure:\n"
+    "{\n"
+    '  \"items\": [\n'
+    '    { \"part_label\": string, \"material_raw\": string, \"side\": string or null },\n'
+    "    ...\n"
+    "  ]\n"
+    "}\n\n"
+    "General rules:\n"
+    "- Each row for a real pressure part (HEAD, SHELL, BOTTOM HEAD, CHANNEL, "
+    "TUBE BUNDLE, etc.) becomes one item.\n"
+    "- part_label: a clean logical name such as 'Shell', 'Head', 'Bottom Head', "
+    "'Channel', or 'Tube Bundle' that can be matched against Excel part names.\n"
+    "- material_raw: the full material string (for example 'SA-516-70', "
+    "'SA-240 316', 'A/SA 516 Gr 70', 'FE-560-Gr912/789L', 'ZY-982-GR.212/678K').\n"
+    "- side: if there is shell/tube information, set side to 'shell' or 'tube'. "
+    "If not clear, infer (heads/shells → 'shell', channels/tube bundles/headers → 'tube').\n"
+    "- Ignore bolts, nuts, gaskets and other non-primary pressure parts.\n"
+    "- Do NOT add extra keys.\n"
+)
+
+
+def _bom_rule(pmt_no: Optional[str], equipment_no: Optional[str]):
     if pmt_no and equipment_no:
-        rule = get_bom_rule(pmt_no, equipment_no)
+        return get_bom_rule(pmt_no, equipment_no)
+    return None
 
-    instruction = base_instruction
-    if rule and rule.extra_prompt:
-        instruction += "\n\nTEMPLATE-SPECIFIC NOTES FOR THIS DRAWING:\n" + rule.extra_prompt
 
-    data = _call_groq_vision_json(image_rel_path, instruction) or {}
-    print("DEBUG bom raw data:", data)
+def _normalize_bom(data: Dict[str, Any]) -> List[Dict[str, Any]]:
     items = data.get("items") or []
 
     result: List[Dict[str, Any]] = []
@@ -337,3 +650,217 @@ def extract_bom_materials(
 
     print("DEBUG bom_items final:", result)
     return result
+
+
+def extract_bom_materials(
+    image: ImageSource,
+    pmt_no: Optional[str] = None,
+    equipment_no: Optional[str] = None,
+    text_region: Optional[TextRegion] = None,
+    use_cache: bool = True,
+    analysis_id: Optional[int] = None,
+    on_token: Optional[Callable[[Optional[str]], None]] = None,
+) -> List[Dict[str, Any]]:
+    
+    rule = _bom_rule(pmt_no, equipment_no)
+    instruction = _with_rule_notes(BOM_INSTRUCTION, rule)
+
+    call_info = _call_info(analysis_id, "bom", pmt_no, equipment_no)
+    data = _extract_routed("bom", image, instruction, BOM_SCHEMA, text_region, rule, use_cache, call_info, on_token)
+    print("DEBUG bom raw data:", data)
+
+    return _normalize_bom(data)
+
+
+
+def region_rule(kind: str, pmt_no: Optional[str], equipment_no: Optional[str]):
+    """The template rule ("design" or "bom") for a drawing, None when it has no rule."""
+    return _design_rule(pmt_no, equipment_no) if kind == "design" else _bom_rule(pmt_no, equipment_no)
+
+
+def _region_instruction(kind: str, pmt_no: Optional[str], equipment_no: Optional[str]) -> str:
+    if kind == "design":
+        return _with_rule_notes(DESIGN_INSTRUCTION, _design_rule(pmt_no, equipment_no))
+    return _with_rule_notes(BOM_INSTRUCTION, _bom_rule(pmt_no, equipment_no))
+
+
+def _vision_region(
+    kind: str,
+    image: ImageSource,
+    pmt_no: Optional[str],
+    equipment_no: Optional[str],
+    use_cache: bool,
+    analysis_id: Optional[int],
+    on_token: Optional[Callable[[Optional[str]], None]] = None,
+) -> Dict[str, Any]:
+    # one region on its own, as split mode asks it; the combined fallback
+    return _call_groq_vision_json(
+        image,
+        _region_instruction(kind, pmt_no, equipment_no),
+        use_cache=use_cache,
+        schema=DESIGN_SCHEMA if kind == "design" else BOM_SCHEMA,
+        call_info=_call_info(analysis_id, kind, pmt_no, equipment_no),
+        on_token=on_token,
+    ) or {}
+
+
+def vision_batch_request(
+    kind: str, image: ImageSource, pmt_no: Optional[str] = None, equipment_no: Optional[str] = None
+) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Chat completion body for one design/BOM region, as sent by
+    _call_groq_vision_json, for the batch API; plus its vision cache key.
+    """
+    instruction = _region_instruction(kind, pmt_no, equipment_no)
+    raw = _image_bytes(image)
+    model = _vision_model()
+    temperature = _vision_temperature()
+    cache_key = _vision_key([raw], instruction, model, temperature) if cache_enabled() else None
+    user_content = _user_content([_prepare_vision_image(raw)], instruction)
+    return _chat_request(user_content, model, temperature, _json_mode(model)), cache_key
+
+
+def read_vision_answer(
+    kind: str,
+    content: str,
+    pmt_no: Optional[str] = None,
+    equipment_no: Optional[str] = None,
+    cache_key: Optional[str] = None,
+) -> Optional[Any]:
+    """
+    Parse a batch answer for one region the way a live call is parsed.
+    Returns the normalised design dict or BOM item list, None if unusable.
+    """
+    data, _ = _parse_vision_json(content, DESIGN_SCHEMA if kind == "design" else BOM_SCHEMA)
+    if data is None:
+        return None
+    if cache_key:
+        try:
+            cache_put(cache_key, data)
+        except OSError as exc:
+            print("Vision cache write failed:", exc)
+    return normalize_region(kind, data, pmt_no, equipment_no)
+
+
+def normalize_region(
+    kind: str, data: Dict[str, Any], pmt_no: Optional[str] = None, equipment_no: Optional[str] = None
+) -> Any:
+    if kind == "design":
+        return _normalize_design(data, _design_rule(pmt_no, equipment_no))
+    return _normalize_bom(data)
+
+
+# Groq accepts at most this many images in one chat completion
+MAX_IMAGES_PER_REQUEST = 5
+
+
+def _combined_instruction(design_rule, bom_rule, include_design: bool, bom_count: int) -> str:
+    parts: List[str] = []
+    n = 1
+    if include_design:
+        parts.append("Image 1 is the DESIGN DATA table.")
+        n = 2
+    if bom_count:
+        last = n + bom_count - 1
+        which = f"Image {n} is" if bom_count == 1 else f"Images {n} to {last} are"
+        parts.append(f"{which} BILL OF MATERIAL (BOM) tables, in order.")
+
+    schema = []
+    if include_design:
+        schema.append('  \"design\": <DESIGN OBJECT for the design data image>')
+    if bom_count:
+        schema.append('  \"bom_tables\": [<BOM OBJECT>, ...] (exactly one per BOM image, same order)')
+
+    instruction = (
+        f"You are given {int(include_design) + bom_count} images from one engineering drawing. "
+        + " ".join(parts)
+        + "\n\nReturn ONLY one JSON object with this structure:\n{\n"
+        + ",\n".join(schema)
+        + "\n}\n"
+        "Build each object from its own image only, following the section for that table type.\n"
+    )
+    if include_design:
+        instruction += (
+            "\n=== DESIGN OBJECT ===\n" + _with_rule_notes(DESIGN_INSTRUCTION, design_rule)
+        )
+    if bom_count:
+        instruction += "\n=== BOM OBJECT ===\n" + _with_rule_notes(BOM_INSTRUCTION, bom_rule)
+    return instruction
+
+
+def extract_design_and_bom_combined(
+    design_image: ImageSource,
+    bom_images: Sequence[ImageSource],
+    pmt_no: Optional[str] = None,
+    equipment_no: Optional[str] = None,
+    design_text_region: Optional[TextRegion] = None,
+    bom_text_regions: Optional[Sequence[Optional[TextRegion]]] = None,
+    use_cache: bool = True,
+    analysis_id: Optional[int] = None,
+    on_token: Optional[Callable[[Optional[str]], None]] = None,
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    Design and BOM extraction in a single vision request carrying every crop
+    that the local backends (text layer, OCR) could not answer. Returns the same (design_meta,
+    bom_items) that extract_design_metadata / extract_bom_materials produce.
+    A part the combined answer lacks (failed request, unparsable, no
+    "design", or a region's BOM table with no items) is asked again on its
+    own, as split mode would.
+    """
+    design_rule = _design_rule(pmt_no, equipment_no)
+    bom_rule = _bom_rule(pmt_no, equipment_no)
+    bom_text_regions = list(bom_text_regions or [None] * len(bom_images))
+
+    # local backends only (no vision callable); whatever they can't read goes in the one request
+    design_data, _ = extract_region(
+        RegionJob("design", _image_bytes(design_image), design_text_region, design_rule)
+    )
+    bom_data: List[Optional[Dict[str, Any]]] = [
+        extract_region(RegionJob("bom", _image_bytes(image), region, bom_rule))[0]
+        for image, region in zip(bom_images, bom_text_regions)
+    ]
+
+    pending = [i for i, d in enumerate(bom_data) if not d]
+    images: List[ImageSource] = ([] if design_data else [design_image]) + [bom_images[i] for i in pending]
+    if len(images) > MAX_IMAGES_PER_REQUEST:
+        raise ValueError(f"Combined mode takes at most {MAX_IMAGES_PER_REQUEST} images, got {len(images)}")
+
+    if images:
+        instruction = _combined_instruction(design_rule, bom_rule, not design_data, len(pending))
+        schema = combined_schema(not design_data, len(pending))
+        call_info = _call_info(analysis_id, "combined", pmt_no, equipment_no)
+        data = _call_groq_vision_json(
+            images, instruction, use_cache=use_cache, schema=schema, call_info=call_info, on_token=on_token
+        )
+        if data is None:
+            print("Combined request gave no usable answer; asking per region")
+            data = {}
+
+        if not design_data:
+            design_data = data.get("design")
+            if not isinstance(design_data, dict) or not design_data:
+                design_data = _vision_region(
+                    "design", design_image, pmt_no, equipment_no, use_cache, analysis_id, on_token
+                )
+
+        tables = data.get("bom_tables") or ([{"items": data["items"]}] if data.get("items") else [])
+        merged = False
+        if tables and len(tables) != len(pending):
+            items = [i for t in tables if isinstance(t, dict) for i in (t.get("items") or [])]
+            if items:
+                # can't tell which table is which: every item goes to the first region, so
+                # re-asking the others would only duplicate them
+                print(f"Combined BOM: expected {len(pending)} table(s), got {len(tables)}; merging")
+                tables, merged = [{"items": items}], True
+            else:
+                tables = []
+        for pos, idx in enumerate(pending):
+            table = tables[pos] if pos < len(tables) and isinstance(tables[pos], dict) else {}
+            if not merged and not table.get("items"):
+                table = _vision_region("bom", bom_images[idx], pmt_no, equipment_no, use_cache, analysis_id, on_token)
+            bom_data[idx] = table
+
+    bom_items: List[Dict[str, Any]] = []
+    for data in bom_data:
+        bom_items.extend(_normalize_bom(data or {}))
+    return _normalize_design(design_data or {}, design_rule), bom_items
@@ -0,0 +1,432 @@
+# analysis_app/services/backends.py
+from __future__ import annotations
+
+import io
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+
+from ..models import ExtractorBackendStat
+from .text_layer import (
+    TextRegion,
+    Word,
+    bom_data_from_text_layer,
+    bom_data_from_words,
+    design_data_from_text_layer,
+    design_data_from_words,
+    text_layer_enabled,
+)
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+
+class ExtractionCancelled(Exception):
+    """The caller gave up (e.g. closed the progress stream); raised through every layer."""
+
+
+# Every backend returns the same raw dict shape the Groq prompts ask for
+# (or None when it cannot read the region), so ai_extractor normalises all alike.
+
+
+@dataclass
+class RegionJob:
+    """One table region to extract, as the router sees it."""
+
+    kind: str  # "design" or "bom"
+    image: bytes  # encoded crop
+    text_region: Optional[TextRegion] = None  # None = don't use the PDF text layer
+    rule: Any = None  # DesignTemplateRule / BomTemplateRule
+    vision: Optional[Callable[[], Optional[dict]]] = None  # the Groq call; None keeps the job local
+    _size: Optional[Tuple[int, int]] = field(default=None, repr=False)
+
+    def image_size(self) -> Tuple[int, int]:
+        if self._size is None:
+            with Image.open(io.BytesIO(self.image)) as img:
+                self._size = img.size
+        return self._size
+
+
+def _word_parser_allowed(job: RegionJob) -> bool:
+    # rules that turn the text layer off do so because the word parser can't read the table
+    return not (job.rule and not job.rule.text_layer)
+
+
+class ExtractorBackend:
+    name = ""
+    local = True  # runs on this machine, no API call
+    default_seconds = 1.0  # assumed latency until stats exist
+
+    def available(self) -> bool:
+        return True
+
+    def accepts(self, job: RegionJob) -> bool:
+        return self.available()
+
+    def extract(self, job: RegionJob) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+
+class TextLayerBackend(ExtractorBackend):
+    name = "text_layer"
+    default_seconds = 0.1
+
+    def accepts(self, job: RegionJob) -> bool:
+        return job.text_region is not None and text_layer_enabled() and _word_parser_allowed(job)
+
+    def extract(self, job: RegionJob) -> Optional[Dict[str, Any]]:
+        if job.kind == "design":
+            return design_data_from_text_layer(job.text_region, job.rule)
+        return bom_data_from_text_layer(job.text_region, job.rule)
+
+
+# --- Tesseract OCR + ruled-table parsing ---------------------------------------------
+
+
+def _runs(indices: np.ndarray) -> List[Tuple[int, int]]:
+    """Consecutive index runs as (first, last)."""
+    runs: List[Tuple[int, int]] = []
+    for i in indices.tolist():
+        if runs and i == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], i)
+        else:
+            runs.append((i, i))
+    return runs
+
+
+def table_lines(gray: np.ndarray, min_fraction: float = 0.5) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """Horizontal and vertical ruling lines of a table crop, as (first, last) pixel bands."""
+    ink = gray < 128
+    rows = _runs(np.flatnonzero(ink.mean(axis=1) >= min_fraction))
+    cols = _runs(np.flatnonzero(ink.mean(axis=0) >= min_fraction))
+    return rows, cols
+
+
+def _snap_to_grid(
+    words: List[Word], rows: List[Tuple[int, int]], cols: List[Tuple[int, int]]
+) -> List[Word]:
+    """
+    Make the ruling lines visible to the text-layer table parser: words
+    between the same two horizontal lines share a row centre, and every
+    vertical line becomes a gap wide enough to always split cells.
+    """
+    if not words or not (rows or cols):
+        return words
+    heights = sorted(w.height for w in words)
+    gap = 4 * heights[len(heights) // 2]
+    row_edges = [(a + b) / 2 for a, b in rows]
+    col_edges = [(a + b) / 2 for a, b in cols]
+
+    snapped: List[Word] = []
+    for w in words:
+        cy = w.cy
+        above = [y for y in row_edges if y <= cy]
+        below = [y for y in row_edges if y > cy]
+        if above and below:
+            cy = (above[-1] + below[0]) / 2
+        shift = gap * sum(1 for x in col_edges if x < w.cx)
+        half = w.height / 2
+        snapped.append(Word(w.text, w.x0 + shift, cy - half, w.x1 + shift, cy + half))
+    return snapped
+
+
+def ocr_words(png_bytes: bytes) -> List[Word]:
+    with Image.open(io.BytesIO(png_bytes)) as src:
+        gray = np.array(src.convert("L"))
+
+    rows, cols = table_lines(gray)
+    # tesseract reads ruled tables badly; erase the rules before OCR
+    clean = gray.copy()
+    for a, b in rows:
+        clean[a : b + 1, :] = 255
+    for a, b in cols:
+        clean[:, a : b + 1] = 255
+
+    config = getattr(settings, "ANALYSIS_TESSERACT_CONFIG", "--psm 6")
+    min_conf = float(getattr(settings, "ANALYSIS_TESSERACT_MIN_CONF", 30))
+    data = pytesseract.image_to_data(
+        Image.fromarray(clean), config=config, output_type=pytesseract.Output.DICT
+    )
+    words: List[Word] = []
+    for i, text in enumerate(data["text"]):
+        text = (text or "").strip()
+        try:
+            conf = float(data["conf"][i])
+        except (TypeError, ValueError):
+            conf = -1.0
+        if not text or conf < min_conf:
+            continue
+        x, y, w, h = (int(data[k][i]) for k in ("left", "top", "width", "height"))
+        words.append(Word(text, x, y, x + w, y + h))
+    return _snap_to_grid(words, rows, cols)
+
+
+class TesseractBackend(ExtractorBackend):
+    name = "tesseract"
+    default_seconds = 1.5
+
+    def __init__(self):
+        self._available: Optional[bool] = None
+
+    def available(self) -> bool:
+        if self._available is None:
+            if pytesseract is None:
+                self._available = False
+            else:
+                cmd = getattr(settings, "ANALYSIS_TESSERACT_CMD", None)
+                if cmd:
+                    pytesseract.pytesseract.tesseract_cmd = cmd
+                try:
+                    pytesseract.get_tesseract_version()
+                    self._available = True
+                except Exception as exc:
+                    print("Tesseract not usable, OCR backend disabled:", exc)
+                    self._available = False
+        return self._available
+
+    def accepts(self, job: RegionJob) -> bool:
+        if not self.available() or not _word_parser_allowed(job):
+            return False
+        # tiny crops OCR badly; huge ones take longer than a vision call
+        width, height = job.image_size()
+        min_edge = int(getattr(settings, "ANALYSIS_OCR_MIN_EDGE", 150))
+        max_pixels = int(getattr(settings, "ANALYSIS_OCR_MAX_PIXELS", 12_000_000))
+        return min(width, height) >= min_edge and width * height <= max_pixels
+
+    def extract(self, job: RegionJob) -> Optional[Dict[str, Any]]:
+        words = ocr_words(job.image)
+        if job.kind == "design":
+            return design_data_from_words(words)
+        return bom_data_from_words(words, job.rule)
+
+
+class GroqBackend(ExtractorBackend):
+    name = "groq"
+    local = False
+    default_seconds = 4.0
+
+    def accepts(self, job: RegionJob) -> bool:
+        return job.vision is not None
+
+    def extract(self, job: RegionJob) -> Optional[Dict[str, Any]]:
+        return job.vision()
+
+
+BACKENDS: Dict[str, ExtractorBackend] = {
+    b.name: b for b in (TextLayerBackend(), TesseractBackend(), GroqBackend())
+}
+
+
+# --- Recorded stats ----------------------------------------------------------------
+
+_stats_lock = threading.Lock()
+_stats_cache: Dict[Tuple[str, str], Dict[str, float]] = {}
+_stats_loaded_at = 0.0
+
+
+def backend_stats(max_age: float = 60.0) -> Dict[Tuple[str, str], Dict[str, float]]:
+    """(backend, kind) -> calls, success_rate, accuracy, mean_seconds; re-read from the DB every max_age seconds."""
+    global _stats_cache, _stats_loaded_at
+    with _stats_lock:
+        if time.monotonic() - _stats_loaded_at < max_age:
+            return _stats_cache
+    stats: Dict[Tuple[str, str], Dict[str, float]] = {}
+    try:
+        for row in ExtractorBackendStat.objects.all():
+            stats[(row.backend, row.kind)] = {
+                "calls": row.calls,
+                # smoothed so one lucky or unlucky call doesn't decide the route
+                "success_rate": (row.successes + 1) / (row.calls + 2),
+                # assumed right until the checks against the vision answer say otherwise
+                "accuracy": (row.agreed + 4) / (row.checked + 4),
+                "mean_seconds": row.total_seconds / row.calls if row.calls else None,
+            }
+    except Exception as exc:
+        print("Extractor backend stats unavailable:", exc)
+    with _stats_lock:
+        _stats_cache, _stats_loaded_at = stats, time.monotonic()
+    return stats
+
+
+def record_backend_call(
+    backend: str, kind: str, success: bool, seconds: float, agreed: Optional[bool] = None
+) -> None:
+    """`agreed` is set when the answer was checked against the vision answer."""
+    checked = agreed is not None
+    changes = {
+        "calls": F("calls") + 1,
+        "successes": F("successes") + int(success),
+        "total_seconds": F("total_seconds") + seconds,
+        "checked": F("checked") + int(checked),
+        "agreed": F("agreed") + int(bool(agreed)),
+    }
+    try:
+        qs = ExtractorBackendStat.objects.filter(backend=backend, kind=kind)
+        if not qs.update(**changes):
+            try:
+                ExtractorBackendStat.objects.create(
+                    backend=backend,
+                    kind=kind,
+                    calls=1,
+                    successes=int(success),
+                    total_seconds=seconds,
+                    checked=int(checked),
+                    agreed=int(bool(agreed)),
+                )
+            except IntegrityError:
+                qs.update(**changes)
+    except Exception as exc:
+        print("Could not record extractor backend stats:", exc)
+
+
+# --- Agreement with the vision answer ----------------------------------------------
+
+_NUMBER_RE = re.compile(r"[-+]?\d*[.,]?\d+")
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    m = _NUMBER_RE.search(str(value or ""))
+    return float(m.group(0).replace(",", ".")) if m else None
+
+
+def _bom_key(item: Dict[str, Any]) -> Tuple[str, str]:
+    label = " ".join(str(item.get("part_label") or "").upper().split())
+    material = re.sub(r"[\s.-]", "", str(item.get("material_raw") or "").upper())
+    return label, material
+
+
+def answers_agree(kind: str, local: Dict[str, Any], reference: Dict[str, Any]) -> bool:
+    """
+    Whether a local backend's answer matches the vision answer for the same
+    region: every pressure/temperature the local backend read is within 1%
+    of the vision value, or both list the same BOM parts and materials.
+    """
+    if kind == "bom":
+        ours = {_bom_key(i) for i in local.get("items") or [] if isinstance(i, dict)}
+        theirs = {_bom_key(i) for i in reference.get("items") or [] if isinstance(i, dict)}
+        return bool(ours) and ours == theirs
+
+    compared = 0
+    for block in ("design", "operating"):
+        for side in ("shell", "tube"):
+            ours = ((local.get(block) or {}).get(side)) or {}
+            theirs = ((reference.get(block) or {}).get(side)) or {}
+            for key in ("pressure_mpa", "temp_c"):
+                a = _number(ours.get(key))
+                if a is None:
+                    continue
+                b = _number(theirs.get(key))
+                if b is None or abs(a - b) > max(0.01 * abs(b), 0.01):
+                    return False
+                compared += 1
+    return compared > 0
+
+
+# --- Router ------------------------------------------------------------------------
+
+
+def _enabled() -> List[ExtractorBackend]:
+    names = getattr(settings, "ANALYSIS_EXTRACTOR_BACKENDS", ["text_layer", "tesseract", "groq"])
+    return [BACKENDS[n] for n in names if n in BACKENDS]
+
+
+def _expected_seconds(backend: ExtractorBackend, kind: str, stats) -> Tuple[float, float]:
+    """(seconds per call including its configured cost, chance it returns usable data)."""
+    s = stats.get((backend.name, kind)) or {}
+    seconds = s.get("mean_seconds") or backend.default_seconds
+    cost = float((getattr(settings, "ANALYSIS_BACKEND_CALL_COST", {}) or {}).get(backend.name, 0.0))
+    return seconds + cost, s.get("success_rate", 0.5)
+
+
+def route(job: RegionJob) -> List[ExtractorBackend]:
+    """
+    Backends to try for this region, in order. A template rule can pin one.
+    Otherwise local backends go first, ranked by expected time to an answer
+    (own latency plus, when they miss, the remote call after them). A local
+    backend that is expected to be slower than calling the remote backend
+    directly, or whose answers too often disagree with the vision answer,
+    is skipped, except for a small exploration share of calls so its stats
+    can recover.
+    """
+    pinned = getattr(job.rule, "backend", None)
+    if pinned:
+        backend = BACKENDS.get(pinned)
+        if backend is not None:
+            return [backend] if backend.accepts(job) else []
+        print(f"Unknown extractor backend {pinned!r} in template rule; routing normally")
+
+    candidates = [b for b in _enabled() if b.accepts(job)]
+    stats = backend_stats()
+    remote = [b for b in candidates if not b.local]
+    remote_seconds = min((_expected_seconds(b, job.kind, stats)[0] for b in remote), default=0.0)
+    explore = float(getattr(settings, "ANALYSIS_ROUTER_EXPLORE_RATE", 0.05))
+    min_accuracy = float(getattr(settings, "ANALYSIS_ROUTER_MIN_ACCURACY", 0.8))
+
+    ranked: List[Tuple[float, ExtractorBackend]] = []
+    for backend in candidates:
+        if not backend.local:
+            continue
+        seconds, success = _expected_seconds(backend, job.kind, stats)
+        expected = seconds + (1 - success) * remote_seconds
+        accuracy = (stats.get((backend.name, job.kind)) or {}).get("accuracy", 1.0)
+        if remote and (expected >= remote_seconds or accuracy < min_accuracy) and random.random() >= explore:
+            continue
+        ranked.append((expected, backend))
+    ranked.sort(key=lambda pair: pair[0])
+
+    remote.sort(key=lambda b: _expected_seconds(b, job.kind, stats)[0])
+    return [b for _, b in ranked] + remote
+
+
+def _run(backend: ExtractorBackend, job: RegionJob) -> Tuple[Optional[Dict[str, Any]], float]:
+    started = time.perf_counter()
+    try:
+        data = backend.extract(job)
+    except ExtractionCancelled:
+        raise
+    except Exception as exc:
+        print(f"{backend.name} {job.kind} extraction failed:", exc)
+        data = None
+    return data, time.perf_counter() - started
+
+
+def extract_region(job: RegionJob) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Try the routed backends in turn; returns (raw data, backend name) or (None, None).
+    A sampled share of local answers is also asked of the remote backend; the
+    agreement is recorded for routing and the remote answer is returned.
+    """
+    backends = route(job)
+    verify_rate = float(getattr(settings, "ANALYSIS_ROUTER_VERIFY_RATE", 0.05))
+    for i, backend in enumerate(backends):
+        data, elapsed = _run(backend, job)
+        remote = next((b for b in backends[i + 1 :] if not b.local), None)
+        if data and backend.local and remote is not None and random.random() < verify_rate:
+            reference, remote_elapsed = _run(remote, job)
+            record_backend_call(remote.name, job.kind, bool(reference), remote_elapsed)
+            if reference:
+                agreed = answers_agree(job.kind, data, reference)
+                record_backend_call(backend.name, job.kind, True, elapsed, agreed)
+                print(f"{job.kind} region: {backend.name} {'agreed with' if agreed else 'differed from'} {remote.name}")
+                return reference, remote.name
+        record_backend_call(backend.name, job.kind, bool(data), elapsed)
+        if data:
+            if backend.local:
+                print(f"{job.kind} region read by {backend.name} in {elapsed:.2f}s; vision call skipped")
+            return data, backend.name
+    return None, None
@@ -0,0 +1,99 @@
+# analysis_app/services/batch_upload.py
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import zipfile
+from pathlib import PurePosixPath
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from ..models import Analysis, ExternalUser, UploadBatch
+from ..upload_handlers import sha256_of_file
+from .dedupe import create_linked_analysis, find_processed_duplicate
+from .raster_queue import enqueue_rasterization
+from .rasterizer import get_page_count
+
+logger = logging.getLogger(__name__)
+
+def _max_member_bytes() -> int:
+    return int(getattr(settings, "ANALYSIS_BATCH_MAX_PDF_BYTES", 100 * 1024 * 1024))
+
+
+def _iter_zip_pdfs(zip_file) -> Iterator[Tuple[str, ContentFile, str]]:
+    with zipfile.ZipFile(zip_file) as zf:
+        for info in sorted(zf.infolist(), key=lambda i: i.filename):
+            name = PurePosixPath(info.filename).name
+            if info.is_dir() or "__MACOSX" in info.filename or name.startswith("."):
+                continue
+            if not name.lower().endswith(".pdf"):
+                continue
+            if info.file_size > _max_member_bytes():
+                raise ValueError(f"{name} in {zip_file.name} is larger than the allowed size")
+            data = zf.read(info)
+            yield name, ContentFile(data, name=name), hashlib.sha256(data).hexdigest()
+
+
+def iter_uploaded_pdfs(
+    files: Sequence, hashes: Optional[Sequence[str]] = None
+) -> Iterator[Tuple[str, object, str]]:
+    """
+    Yield (filename, file object, sha256) for every PDF in the upload,
+    expanding .zip archives. `hashes` are the digests Sha256UploadHandler
+    recorded for the same field, in upload order.
+    """
+    hashes = hashes or []
+    for idx, f in enumerate(files):
+        name = os.path.basename(f.name)
+        lower = name.lower()
+        if lower.endswith(".zip"):
+            yield from _iter_zip_pdfs(f)
+        elif lower.endswith(".pdf"):
+            sha256 = hashes[idx] if idx < len(hashes) else sha256_of_file(f)
+            yield name, f, sha256
+
+
+def create_batch(
+    created_by: Optional[ExternalUser],
+    pdfs: Iterator[Tuple[str, object, str]],
+) -> Tuple[UploadBatch, List[str]]:
+    """
+    One Analysis per PDF, rasterized by the worker queue. Returns the batch
+    and a list of per-file error messages; a bad file does not stop the rest.
+    """
+    batch = UploadBatch.objects.create(created_by=created_by)
+    errors: List[str] = []
+
+    for name, file_obj, sha256 in pdfs:
+        source = find_processed_duplicate(sha256, created_by)
+        if source:
+            create_linked_analysis(source, created_by=created_by, original_filename=name, batch=batch)
+            continue
+
+        analysis = Analysis.objects.create(
+            created_by=created_by,
+            batch=batch,
+            file=file_obj,
+            file_sha256=sha256,
+            original_filename=name,
+            status="pending",
+        )
+        try:
+            page_count = get_page_count(analysis.file.path)
+            if page_count < 1:
+                raise ValueError("PDF has no pages")
+        except Exception as e:
+            logger.warning("Error reading PDF %s in batch %s: %s", name, batch.id, e)
+            analysis.status = "failed"
+            analysis.save(update_fields=["status"])
+            errors.append(f"{name}: {e}")
+            continue
+
+        analysis.page_count = page_count
+        analysis.save(update_fields=["page_count"])
+        enqueue_rasterization(analysis)
+
+    return batch, errors
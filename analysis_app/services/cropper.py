@@ -1,17 +1,149 @@
 # analysis_app/services/cropper.py
 
+import hashlib
+import io
 import os
-import uuid
+import threading
+from collections import OrderedDict
 from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
 from PIL import Image
 from django.conf import settings
 
 
-def crop_region_from_page(page_image_name: str, x1: float, y1: float, x2: float, y2: float) -> str:
-  
-    full_path = Path(settings.MEDIA_ROOT) / page_image_name
-    img = Image.open(full_path)
-    width, height = img.size
+CROPS_DIR = "analysis/crops"
+
+Coords = Tuple[float, float, float, float]
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+def _count(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def crop_cache_stats() -> Dict[str, float]:
+    """Hit/miss counters for this process since start (or the last reset)."""
+    with _stats_lock:
+        hits, misses = _stats["hits"], _stats["misses"]
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 3) if total else 0.0,
+        "page_cache": _page_cache.stats(),
+    }
+
+
+def reset_crop_cache_stats() -> None:
+    with _stats_lock:
+        _stats["hits"] = 0
+        _stats["misses"] = 0
+    _page_cache.reset_stats()
+
+
+def _page_cache_budget() -> int:
+    return int(getattr(settings, "ANALYSIS_PAGE_CACHE_BYTES", 256 * 1024 * 1024))
+
+
+def _decoded_bytes(img: Image.Image) -> int:
+    # PIL stores "1", "L" and "P" at one byte per pixel, RGB/RGBA at four
+    return img.width * img.height * (1 if img.mode in ("1", "L", "P") else 4)
+
+
+class PageImageCache:
+    """
+    Process-wide LRU of decoded page bitmaps, bounded by a byte budget. An
+    entry is only served while the file's mtime and size still match, so a
+    re-rendered or converted page is decoded again.
+    """
+
+    def __init__(self) -> None:
+        self._items: "OrderedDict[str, Tuple[int, int, Image.Image, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def _fresh(self, name: str, stat: os.stat_result):
+        entry = self._items.get(name)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry
+        return None
+
+    def size_of(self, name: str, stat: os.stat_result) -> Optional[Tuple[int, int]]:
+        with self._lock:
+            entry = self._fresh(name, stat)
+            return entry[2].size if entry else None
+
+    def get(self, name: str, full_path: Path, stat: os.stat_result) -> Image.Image:
+        with self._lock:
+            entry = self._fresh(name, stat)
+            if entry:
+                self._items.move_to_end(name)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        # decode outside the lock; two threads racing on one page both decode once
+        img = Image.open(full_path)
+        img.load()
+        nbytes = _decoded_bytes(img)
+        budget = _page_cache_budget()
+        if nbytes > budget:
+            return img
+
+        with self._lock:
+            old = self._items.pop(name, None)
+            if old:
+                self._bytes -= old[3]
+            self._items[name] = (stat.st_mtime_ns, stat.st_size, img, nbytes)
+            self._bytes += nbytes
+            while self._bytes > budget and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= evicted[3]
+                self.evictions += 1
+        return img
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "pages": len(self._items),
+                "bytes": self._bytes,
+                "budget": _page_cache_budget(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_page_cache = PageImageCache()
+
+
+def _page_size(page_image_name: str, full_path: Path, stat: os.stat_result) -> Tuple[int, int]:
+    size = _page_cache.size_of(page_image_name, stat)
+    if size:
+        return size
+    # header only; pixels are decoded through the page cache when a crop is needed
+    with Image.open(full_path) as img:
+        return img.size
+
+
+def _pixel_box(
+    size: Tuple[int, int], x1: float, y1: float, x2: float, y2: float
+) -> Tuple[int, int, int, int]:
+    width, height = size
 
     left = int(x1 * width)
     upper = int(y1 * height)
@@ -25,16 +157,130 @@ def crop_region_from_page(page_image_name: str, x1: float, y1: float, x2: float,
 
     if right <= left or lower <= upper:
         raise ValueError("Invalid crop region")
+    return left, upper, right, lower
+
+
+def crop_cache_name(page_image_name: str, box: Tuple[int, int, int, int], stat: os.stat_result) -> str:
+    """
+    Deterministic crop name. The page's mtime and size are part of the key so
+    re-rendering or converting a page never serves a stale crop.
+    """
+    key = f"{page_image_name}|{stat.st_mtime_ns}|{stat.st_size}|{box[0]},{box[1]},{box[2]},{box[3]}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return f"{CROPS_DIR}/{digest}.png"
+
+
+def crop_region_from_page(page_image_name: str, x1: float, y1: float, x2: float, y2: float) -> str:
+    """
+    Crop a normalized (0..1) region out of a stored page image and return the
+    crop's path relative to MEDIA_ROOT. The same page and pixel box always map
+    to the same file, which is reused when it already exists.
+    """
+    media_root = Path(settings.MEDIA_ROOT)
+    full_path = media_root / page_image_name
+    stat = full_path.stat()
+
+    box = _pixel_box(_page_size(page_image_name, full_path, stat), x1, y1, x2, y2)
+    rel_path = crop_cache_name(page_image_name, box, stat)
+    out_path = media_root / rel_path
+
+    if out_path.exists():
+        _count("hits")
+        return rel_path
+
+    _count("misses")
+    cropped = _page_cache.get(page_image_name, full_path, stat).crop(box)
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    # write then rename so a concurrent request never reads a half-written crop
+    tmp_path = out_path.with_name(f"{out_path.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+    cropped.save(tmp_path, format="PNG")
+    os.replace(tmp_path, out_path)
+
+    return rel_path
+
+
+def region_crop_etag(
+    page_image_name: str, x1: float, y1: float, x2: float, y2: float, max_width: Optional[int] = None
+) -> str:
+    """Strong validator for a crop: page identity (name, mtime, size), pixel box and width."""
+    full_path = Path(settings.MEDIA_ROOT) / page_image_name
+    stat = full_path.stat()
+    box = _pixel_box(_page_size(page_image_name, full_path, stat), x1, y1, x2, y2)
+    digest = Path(crop_cache_name(page_image_name, box, stat)).stem
+    return f"{digest}-w{max_width}" if max_width else digest
+
+
+def _encode_crop(cropped: Image.Image, max_width: Optional[int]) -> bytes:
+    if max_width and cropped.width > max_width:
+        height = max(1, round(cropped.height * max_width / cropped.width))
+        cropped = cropped.resize((max_width, height), Image.LANCZOS)
+
+    buf = io.BytesIO()
+    cropped.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def crop_regions_to_bytes(
+    page_image_name: str,
+    regions: Sequence[Coords],
+    max_width: Optional[int] = None,
+) -> List[bytes]:
+    """
+    Encoded PNG crops for several regions of one page, in the given order.
+    Crops already cached on disk are read back; the rest are cut from a single
+    decode of the page (shared through the page cache) and not written.
+    """
+    media_root = Path(settings.MEDIA_ROOT)
+    full_path = media_root / page_image_name
+    stat = full_path.stat()
+    size = _page_size(page_image_name, full_path, stat)
+
+    out: List[bytes] = []
+    page: Optional[Image.Image] = None
+    for x1, y1, x2, y2 in regions:
+        box = _pixel_box(size, x1, y1, x2, y2)
+        if not max_width or box[2] - box[0] <= max_width:
+            cached = media_root / crop_cache_name(page_image_name, box, stat)
+            if cached.exists():
+                _count("hits")
+                out.append(cached.read_bytes())
+                continue
+
+        _count("misses")
+        if page is None:
+            page = _page_cache.get(page_image_name, full_path, stat)
+        out.append(_encode_crop(page.crop(box), max_width))
+    return out
+
 
-    cropped = img.crop((left, upper, right, lower))
+def crop_region_to_bytes(
+    page_image_name: str,
+    x1: float,
+    y1: float,
+    x2: float,
+    y2: float,
+    max_width: Optional[int] = None,
+) -> bytes:
+    """
+    Same crop as crop_region_from_page, returned as encoded PNG bytes. A crop
+    already cached on disk is read back; otherwise the crop is encoded in
+    memory and nothing is written. max_width scales the crop down for thumbnails.
+    """
+    return crop_regions_to_bytes(page_image_name, [(x1, y1, x2, y2)], max_width=max_width)[0]
 
-    out_dir = Path(settings.MEDIA_ROOT) / "analysis/crops/"
-    out_dir.mkdir(parents=True, exist_ok=True)
 
-    import uuid
-    filename = f"{uuid.uuid4().hex}.png"
-    out_path = out_dir / filename
-    cropped.save(out_path)
+def crop_region_selections(regions: Sequence) -> Dict[int, bytes]:
+    """
+    PNG bytes for RegionSelection-like objects (id, page.image.name, x1..y2),
+    keyed by id. Regions are grouped by page so each page is decoded once.
+    """
+    by_page: Dict[str, List] = {}
+    for r in regions:
+        by_page.setdefault(r.page.image.name, []).append(r)
 
-    rel_path = str(out_path.relative_to(settings.MEDIA_ROOT))
-    return rel_path
\ No newline at end of file
+    crops: Dict[int, bytes] = {}
+    for page_name, page_regions in by_page.items():
+        encoded = crop_regions_to_bytes(page_name, [(r.x1, r.y1, r.x2, r.y2) for r in page_regions])
+        crops.update(zip((r.id for r in page_regions), encoded))
+    return crops
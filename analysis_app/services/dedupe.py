@@ -0,0 +1,93 @@
+# analysis_app/services/dedupe.py
+from __future__ import annotations
+
+from typing import Dict, Optional
+
+from django.db import transaction
+
+from ..models import Analysis, AnalysisPage, ExternalUser, RegionSelection, UploadBatch
+
+
+def find_processed_duplicate(
+    file_sha256: Optional[str], created_by: Optional[ExternalUser]
+) -> Optional[Analysis]:
+    """
+    Earliest usable analysis of the same PDF bytes uploaded by the same
+    user, if any. Other users' analyses are never linked: their file names
+    and regions are theirs (identical page images are still shared, see
+    find_shared_page).
+    """
+    if not file_sha256 or created_by is None:
+        return None
+    return (
+        Analysis.objects.filter(file_sha256=file_sha256, created_by=created_by, page_count__isnull=False)
+        .exclude(status__in=["pending", "failed"])
+        .order_by("created_at")
+        .first()
+    )
+
+
+def find_shared_page(analysis: Analysis, page_number: int) -> Optional[AnalysisPage]:
+    """A page already rendered for another analysis of the same PDF."""
+    if not analysis.file_sha256:
+        return None
+    return (
+        AnalysisPage.objects.filter(
+            analysis__file_sha256=analysis.file_sha256,
+            page_number=page_number,
+        )
+        .exclude(analysis=analysis)
+        .order_by("id")
+        .first()
+    )
+
+
+@transaction.atomic
+def create_linked_analysis(
+    source: Analysis,
+    created_by: Optional[ExternalUser],
+    original_filename: str,
+    inherit_regions: bool = False,
+    batch: Optional[UploadBatch] = None,
+) -> Analysis:
+    """
+    New Analysis that points at source's stored PDF and page images instead
+    of saving and rendering the same bytes again. With inherit_regions the
+    source's RegionSelection rows are copied onto the linked pages, but
+    only when the source belongs to the same user.
+    """
+    analysis = Analysis.objects.create(
+        created_by=created_by,
+        batch=batch,
+        file=source.file.name,
+        file_sha256=source.file_sha256,
+        original_filename=original_filename,
+        page_count=source.page_count,
+        status="awaiting_regions",
+    )
+
+    page_map: Dict[int, AnalysisPage] = {}
+    for src_page in source.pages.all():
+        page_map[src_page.id] = AnalysisPage.objects.create(
+            analysis=analysis,
+            page_number=src_page.page_number,
+            image=src_page.image.name,
+        )
+
+    if inherit_regions and created_by is not None and source.created_by_id == created_by.id:
+        copied = [
+            RegionSelection(
+                analysis=analysis,
+                page=page_map[r.page_id],
+                step_type=r.step_type,
+                x1=r.x1,
+                y1=r.y1,
+                x2=r.x2,
+                y2=r.y2,
+            )
+            for r in source.regions.order_by("created_at", "id")
+            if r.page_id in page_map
+        ]
+        RegionSelection.objects.bulk_create(copied)
+
+    return analysis
@@ -0,0 +1,242 @@
+# analysis_app/services/extraction.py
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db import connections
+
+from .ai_extractor import (
+    MAX_IMAGES_PER_REQUEST,
+    ImageSource,
+    extract_bom_materials,
+    extract_design_and_bom_combined,
+    extract_design_metadata,
+)
+from .backends import ExtractionCancelled
+from .text_layer import TextRegion
+from .vision_schema import repair_json
+
+# one region to extract: the crop plus its text-layer location (None skips the text layer)
+RegionCrop = Tuple[ImageSource, Optional[TextRegion]]
+
+
+class ExtractionProgress:
+    """
+    Receives progress events from extract_design_and_bom and the generate
+    pipeline as plain dicts. `emit` is called from the extraction worker
+    threads, so it must be thread-safe. Setting `cancel` stops the work at
+    the next region, stage or streamed token.
+    """
+
+    def __init__(self, emit: Callable[[Dict[str, Any]], None], cancel: Optional[threading.Event] = None):
+        self.emit = emit
+        self.cancel = cancel or threading.Event()
+
+    def check(self) -> None:
+        if self.cancel.is_set():
+            raise ExtractionCancelled()
+
+    def stage(self, name: str, **data: Any) -> None:
+        self.check()
+        self.emit({"event": "stage", "stage": name, **data})
+
+    def region(self, key: str, status: str, **data: Any) -> None:
+        self.emit({"event": "region", "region": key, "status": status, **data})
+
+    def token_handler(self, key: str) -> Callable[[Optional[str]], None]:
+        """
+        on_token callback for one vision request. Besides the raw tokens it
+        emits the BOM rows complete so far ("rows"), so they can be shown
+        before the answer is finished.
+        """
+        parts: List[str] = []
+        sent_rows = [0]
+
+        def on_token(text: Optional[str]) -> None:
+            self.check()
+            if text is None:
+                parts.clear()
+                sent_rows[0] = 0
+                self.emit({"event": "token", "region": key, "reset": True})
+                return
+            parts.append(text)
+            self.emit({"event": "token", "region": key, "text": text})
+            if "}" not in text:
+                return
+            so_far = "".join(parts)
+            # cut after the last closing brace: every item object before it is complete
+            data, _ = repair_json(so_far[: so_far.rfind("}") + 1])
+            if not isinstance(data, dict):
+                return
+            items = data.get("items")
+            if items is None and isinstance(data.get("bom_tables"), list):
+                items = [i for t in data["bom_tables"] if isinstance(t, dict) for i in (t.get("items") or [])]
+            items = [i for i in (items or []) if isinstance(i, dict)]
+            if len(items) > sent_rows[0]:
+                sent_rows[0] = len(items)
+                self.emit({"event": "rows", "region": key, "items": items})
+
+        return on_token
+
+
+def extraction_mode() -> str:
+    return getattr(settings, "ANALYSIS_EXTRACTION_MODE", "split")
+
+
+def _extract_workers() -> int:
+    return max(1, int(getattr(settings, "ANALYSIS_EXTRACT_WORKERS", 6)))
+
+
+def _design_call(
+    crop: RegionCrop,
+    pmt_no: Optional[str],
+    equipment_no: Optional[str],
+    use_cache: bool,
+    analysis_id: Optional[int] = None,
+    progress: Optional[ExtractionProgress] = None,
+) -> Dict[str, Any]:
+    if progress:
+        progress.check()
+        progress.region("design", "started")
+    try:
+        result = extract_design_metadata(
+            crop[0],
+            pmt_no=pmt_no,
+            equipment_no=equipment_no,
+            text_region=crop[1],
+            use_cache=use_cache,
+            analysis_id=analysis_id,
+            on_token=progress.token_handler("design") if progress else None,
+        ) or {}
+    except ExtractionCancelled:
+        raise
+    except Exception as e:
+        print("Design metadata extraction failed:", e)
+        result = {}
+    if progress:
+        progress.region("design", "done", design=result)
+    return result
+
+
+def _bom_call(
+    crop: RegionCrop,
+    pmt_no: Optional[str],
+    equipment_no: Optional[str],
+    use_cache: bool,
+    analysis_id: Optional[int] = None,
+    progress: Optional[ExtractionProgress] = None,
+    key: str = "bom",
+) -> List[Dict[str, Any]]:
+    if progress:
+        progress.check()
+        progress.region(key, "started")
+    try:
+        result = extract_bom_materials(
+            crop[0],
+            pmt_no=pmt_no,
+            equipment_no=equipment_no,
+            text_region=crop[1],
+            use_cache=use_cache,
+            analysis_id=analysis_id,
+            on_token=progress.token_handler(key) if progress else None,
+        ) or []
+    except ExtractionCancelled:
+        raise
+    except Exception as e:
+        print("BOM materials extraction failed for one region:", e)
+        result = []
+    if progress:
+        progress.region(key, "done", items=result)
+    return result
+
+
+def _in_worker(fn, *args):
+    # the scheduler touches the DB from pool threads; don't leave their connections open
+    try:
+        return fn(*args)
+    finally:
+        connections.close_all()
+
+
+def extract_design_and_bom(
+    design: RegionCrop,
+    boms: Sequence[RegionCrop],
+    pmt_no: Optional[str] = None,
+    equipment_no: Optional[str] = None,
+    max_workers: Optional[int] = None,
+    use_cache: bool = True,
+    mode: Optional[str] = None,
+    analysis_id: Optional[int] = None,
+    progress: Optional[ExtractionProgress] = None,
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    "split" mode (default) runs the design call and every BOM call at the same
+    time on a bounded thread pool (ANALYSIS_EXTRACT_WORKERS). BOM items come
+    back in region order; a failed call contributes nothing and does not
+    affect the others. "combined" mode sends all crops in one request when
+    they fit (MAX_IMAGES_PER_REQUEST) and falls back to split otherwise.
+    use_cache=False re-asks the vision model instead of using cached answers.
+    analysis_id only labels the VisionCallLog rows of the requests made.
+    `progress` gets a "region" event as each region starts and finishes
+    ("design", "bom-0", "bom-1", ... or "combined"), plus streamed tokens;
+    cancelling it raises ExtractionCancelled from here.
+    """
+    mode = mode or extraction_mode()
+    if mode == "combined":
+        if 1 + len(boms) <= MAX_IMAGES_PER_REQUEST:
+            try:
+                if progress:
+                    progress.region("combined", "started")
+                design_meta, bom_items = extract_design_and_bom_combined(
+                    design[0],
+                    [crop[0] for crop in boms],
+                    pmt_no=pmt_no,
+                    equipment_no=equipment_no,
+                    design_text_region=design[1],
+                    bom_text_regions=[crop[1] for crop in boms],
+                    use_cache=use_cache,
+                    analysis_id=analysis_id,
+                    on_token=progress.token_handler("combined") if progress else None,
+                )
+                if progress:
+                    progress.region("combined", "done", design=design_meta, items=bom_items)
+                return design_meta, bom_items
+            except ExtractionCancelled:
+                raise
+            except Exception as e:
+                print("Combined extraction failed, retrying per region:", e)
+        else:
+            print(f"{1 + len(boms)} regions exceed one request; using split extraction")
+    elif mode != "split":
+        print(f"Unknown ANALYSIS_EXTRACTION_MODE {mode!r}; using split extraction")
+
+    workers = min(max_workers or _extract_workers(), 1 + len(boms))
+    if workers <= 1:
+        design_meta = _design_call(design, pmt_no, equipment_no, use_cache, analysis_id, progress)
+        bom_items = [
+            item
+            for i, crop in enumerate(boms)
+            for item in _bom_call(crop, pmt_no, equipment_no, use_cache, analysis_id, progress, f"bom-{i}")
+        ]
+        return design_meta, bom_items
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract") as pool:
+        design_future = pool.submit(
+            _in_worker, _design_call, design, pmt_no, equipment_no, use_cache, analysis_id, progress
+        )
+        bom_futures = [
+            pool.submit(
+                _in_worker, _bom_call, crop, pmt_no, equipment_no, use_cache, analysis_id, progress, f"bom-{i}"
+            )
+            for i, crop in enumerate(boms)
+        ]
+
+        bom_items: List[Dict[str, Any]] = []
+        for future in bom_futures:
+            bom_items.extend(future.result())
+        design_meta = design_future.result()
+
+    return design_meta, bom_items
@@ -0,0 +1,139 @@
+# analysis_app/services/generate.py
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+from ..models import Analysis
+from .cropper import crop_region_from_page, crop_region_selections
+from .extraction import ExtractionProgress, extract_design_and_bom
+from .masterfile_builder import append_equipment_to_masterfile, parse_filename
+from .ppt_builder import sync_all_slides_from_masterfile
+from .text_layer import TextRegion
+
+
+def analysis_user_key(analysis: Analysis) -> str:
+    # names the per-user masterfile and slide deck
+    if analysis.created_by:
+        return analysis.created_by.staff_id or analysis.created_by.external_id or "anon"
+    return "anon"
+
+
+def region_text_region(analysis: Analysis, region) -> TextRegion:
+    return TextRegion(
+        pdf_path=analysis.file.path,
+        page_number=region.page.page_number,
+        x1=region.x1,
+        y1=region.y1,
+        x2=region.x2,
+        y2=region.y2,
+    )
+
+
+def run_generate(analysis: Analysis, use_cache: bool = True, progress: Optional[ExtractionProgress] = None) -> None:
+    """
+    Extract design/BOM data for an analysis with selected regions, append it
+    to the user's masterfile and sync the slides. Used by the blocking
+    generate view and by the progress stream, which passes `progress` to
+    get stage events ("cropping", "extracting", "masterfile", "ppt") and
+    to cancel between them. The caller checks the regions exist first.
+    A cancelled run raises ExtractionCancelled before anything is written.
+    A run that is cancelled or fails puts the analysis status back.
+    """
+    regions = analysis.regions.select_related("page").all()
+    design_region = regions.filter(step_type="design_data").first()
+    bom_regions = list(regions.filter(step_type="bom"))
+    slide_regions = list(regions.filter(step_type="slide_image"))
+
+    previous_status = analysis.status
+    analysis.status = "in_progress"
+    analysis.save(update_fields=["status"])
+    try:
+        _generate(analysis, design_region, bom_regions, slide_regions, use_cache, progress)
+    except BaseException:
+        # cancelled or failed: don't leave the analysis stuck "in_progress"
+        analysis.status = previous_status
+        analysis.save(update_fields=["status"])
+        raise
+
+    analysis.status = "awaiting_excel_review"
+    analysis.save(update_fields=["status"])
+
+
+def _generate(
+    analysis: Analysis,
+    design_region,
+    bom_regions: List,
+    slide_regions: List,
+    use_cache: bool,
+    progress: Optional[ExtractionProgress],
+) -> None:
+    user_key = analysis_user_key(analysis)
+
+    if not analysis.workbook_path:
+        analysis.workbook_path = f"analysis/workbooks/{user_key}_IPETRO_Masterfile.xlsx"
+        analysis.save(update_fields=["workbook_path"])
+
+    if not analysis.pptx_path:
+        analysis.pptx_path = f"analysis/ppt/{user_key}_InspectionPlan.pptx"
+        analysis.save(update_fields=["pptx_path"])
+
+    pmt_no, equipment_no = parse_filename(analysis.original_filename)
+
+    if progress:
+        progress.stage("cropping", regions=1 + len(bom_regions))
+    # design/BOM crops go to the extractor as PNG bytes; only slide images are saved.
+    # Regions are cut per page so each page is decoded once.
+    crops = crop_region_selections([design_region] + bom_regions)
+
+    if progress:
+        progress.stage("extracting", bom_regions=len(bom_regions))
+    # design and BOM vision calls run concurrently; BOM items keep region order
+    design_meta, bom_items = extract_design_and_bom(
+        (crops[design_region.id], region_text_region(analysis, design_region)),
+        [(crops[r.id], region_text_region(analysis, r)) for r in bom_regions],
+        pmt_no=pmt_no,
+        equipment_no=equipment_no,
+        use_cache=use_cache,
+        analysis_id=analysis.id,
+        progress=progress,
+    )
+
+    slide_image_paths: List[str] = []
+    for r in slide_regions:
+        crop_rel = crop_region_from_page(
+            page_image_name=r.page.image.name,
+            x1=r.x1,
+            y1=r.y1,
+            x2=r.x2,
+            y2=r.y2,
+        )
+        slide_image_paths.append(crop_rel)
+
+    # last point to back out: from here on the masterfile is changed
+    if progress:
+        progress.stage("masterfile")
+
+    image_map: Dict[Tuple[str, str], str] = {}
+    if slide_image_paths:
+        image_map[(pmt_no, equipment_no)] = slide_image_paths[0]
+
+    try:
+        append_equipment_to_masterfile(
+            workbook_rel_path=analysis.workbook_path,
+            original_filename=analysis.original_filename,
+            design_meta=design_meta,
+            bom_items=bom_items,
+        )
+    except Exception as e:
+        print("Append to Masterfile failed:", e)
+
+    if progress:
+        progress.emit({"event": "stage", "stage": "ppt"})
+    try:
+        sync_all_slides_from_masterfile(
+            pptx_rel_path=analysis.pptx_path,
+            workbook_rel_path=analysis.workbook_path,
+            image_map=image_map or None,
+        )
+    except Exception as e:
+        print("PPT sync failed:", e)
@@ -0,0 +1,246 @@
+# analysis_app/services/groq_scheduler.py
+from __future__ import annotations
+
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, TypeVar
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from ..models import RateLimitBucket
+
+T = TypeVar("T")
+
+BUCKET_NAME = "groq"
+
+# HTTP statuses worth retrying; anything else (400, 401, 413, ...) fails at once
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+# "bulk" callers only take a slot that is free right now and leave GROQ_BULK_HEADROOM
+# burst slots untouched, so interactive generates never queue behind a bulk job
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("groq_priority", default="interactive")
+
+
+@contextmanager
+def bulk_priority():
+    token = _priority.set("bulk")
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class CircuitOpenError(RuntimeError):
+    """The API failed repeatedly; calls fail fast until the cool-down ends."""
+
+
+class RateLimitQueueTimeout(RuntimeError):
+    """The next free slot in the shared bucket is further away than GROQ_MAX_QUEUE_WAIT."""
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def _emission_interval() -> float:
+    return 60.0 / max(1, int(_setting("GROQ_REQUESTS_PER_MINUTE", 30)))
+
+
+def _tolerance(interval: float) -> float:
+    # how far ahead of its theoretical arrival time a request may go: the burst
+    return interval * (max(1, int(_setting("GROQ_BURST", 5))) - 1)
+
+
+def _bucket(name: str) -> RateLimitBucket:
+    # caller holds a transaction; the row lock queues concurrent callers in order
+    try:
+        return RateLimitBucket.objects.select_for_update().get(name=name)
+    except RateLimitBucket.DoesNotExist:
+        try:
+            with transaction.atomic():
+                RateLimitBucket.objects.create(name=name)
+        except IntegrityError:
+            pass
+        return RateLimitBucket.objects.select_for_update().get(name=name)
+
+
+def reserve_slot(name: str = BUCKET_NAME, now: Optional[float] = None, bulk: bool = False) -> float:
+    """
+    Reserve the next request slot (GCRA) and return how many seconds to wait
+    before sending. Slots are handed out in the order callers get the row
+    lock, across every process sharing the database. With bulk=True nothing
+    is reserved unless the slot is free now with headroom to spare; the
+    return value is then how long to wait before asking again.
+    """
+    interval = _emission_interval()
+    tolerance = _tolerance(interval)
+    max_wait = float(_setting("GROQ_MAX_QUEUE_WAIT", 120))
+    if bulk:
+        tolerance = max(0.0, tolerance - interval * int(_setting("GROQ_BULK_HEADROOM", 2)))
+
+    with transaction.atomic():
+        bucket = _bucket(name)
+        now = time.time() if now is None else now
+
+        if bucket.open_until and bucket.open_until > now:
+            raise CircuitOpenError(
+                f"{name} circuit open for another {bucket.open_until - now:.0f}s "
+                f"after {bucket.consecutive_failures} consecutive failures"
+            )
+
+        new_tat = max(bucket.tat, now) + interval
+        wait = max(0.0, new_tat - interval - tolerance - now)
+        if bulk and wait > 0:
+            return wait
+        if wait > max_wait:
+            raise RateLimitQueueTimeout(f"{name} rate limit queue is {wait:.0f}s long")
+
+        bucket.tat = new_tat
+        bucket.save(update_fields=["tat", "updated_at"])
+    return wait
+
+
+def push_back(retry_after: float, name: str = BUCKET_NAME) -> None:
+    """The API said slow down: nobody gets a slot before now + retry_after."""
+    # a slot is free once tat - tolerance has passed, so the burst allowance must be
+    # added or a Retry-After shorter than the burst window would not hold anyone back
+    tolerance = _tolerance(_emission_interval())
+    with transaction.atomic():
+        bucket = _bucket(name)
+        bucket.tat = max(bucket.tat, time.time() + retry_after + tolerance)
+        bucket.save(update_fields=["tat", "updated_at"])
+
+
+def record_result(success: bool, name: str = BUCKET_NAME) -> None:
+    threshold = int(_setting("GROQ_BREAKER_THRESHOLD", 5))
+    cooldown = float(_setting("GROQ_BREAKER_COOLDOWN", 30))
+
+    with transaction.atomic():
+        bucket = _bucket(name)
+        if success:
+            if not bucket.consecutive_failures and not bucket.open_until:
+                return
+            bucket.consecutive_failures = 0
+            bucket.open_until = None
+        else:
+            bucket.consecutive_failures += 1
+            # also re-opens at once when a trial call after the cool-down fails
+            if bucket.consecutive_failures >= threshold:
+                bucket.open_until = time.time() + cooldown
+                print(f"{name} circuit opened for {cooldown:.0f}s after {bucket.consecutive_failures} failures")
+        bucket.save(update_fields=["consecutive_failures", "open_until", "updated_at"])
+
+
+def status_code(exc: BaseException) -> Optional[int]:
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        code = getattr(getattr(exc, "response", None), "status_code", None)
+    return code
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    value = headers.get("retry-after") if hasattr(headers, "get") else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    code = status_code(exc)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    # no HTTP status: connection reset, DNS, timeout
+    return type(exc).__name__ in ("APIConnectionError", "APITimeoutError", "ConnectionError", "TimeoutError")
+
+
+def _backoff(attempt: int) -> float:
+    base = float(_setting("GROQ_BACKOFF_BASE", 1.0))
+    cap = float(_setting("GROQ_BACKOFF_MAX", 30.0))
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def run_scheduled(
+    call: Callable[[], T],
+    name: str = BUCKET_NAME,
+    label: str = "Groq call",
+    info: Optional[Dict[str, float]] = None,
+) -> T:
+    """
+    Run `call` inside the shared rate limit with retries, at bulk priority
+    inside a bulk_priority() block. Retryable failures back off
+    exponentially (full jitter) or for the server's Retry-After; the last
+    error is re-raised. Raises CircuitOpenError without calling while the
+    breaker is open; 429s and Retry-After responses do not count towards it. `info`, if given, accumulates "retries", "waited"
+    (queue and backoff seconds) and "request_seconds" across calls.
+    """
+    max_retries = int(_setting("GROQ_MAX_RETRIES", 4))
+    bulk = _priority.get() == "bulk"
+    info = {} if info is None else info
+    for key in ("retries", "waited", "request_seconds"):
+        info.setdefault(key, 0)
+
+    def sleep(seconds: float) -> None:
+        info["waited"] += seconds
+        time.sleep(seconds)
+
+    attempt = 0
+    while True:
+        if bulk:
+            # poll instead of queueing: a reserved future slot would delay interactive callers
+            while True:
+                wait = reserve_slot(name, bulk=True)
+                if wait <= 0:
+                    break
+                sleep(min(wait, 5.0))
+        else:
+            wait = reserve_slot(name)
+            if wait > 0:
+                print(f"{label}: queued {wait:.1f}s for rate limit slot")
+                sleep(wait)
+
+        started = time.perf_counter()
+        try:
+            result = call()
+        except Exception as exc:
+            info["request_seconds"] += time.perf_counter() - started
+            retryable = is_retryable(exc)
+            retry_after = _retry_after(exc)
+            # throttling is the rate limit's job (push_back); it says nothing about the service's health
+            throttled = status_code(exc) == 429 or retry_after is not None
+            if retryable and not throttled:
+                record_result(False, name)
+            if not retryable or attempt >= max_retries:
+                raise
+
+            if retry_after is not None:
+                push_back(retry_after, name)
+                delay = 0.0  # the bucket now holds everyone back; reserve_slot does the waiting
+            else:
+                delay = _backoff(attempt)
+            attempt += 1
+            info["retries"] += 1
+            print(
+                f"{label} failed ({status_code(exc) or type(exc).__name__}), "
+                f"retry {attempt}/{max_retries}"
+                + (f" after Retry-After {retry_after:.1f}s" if retry_after is not None else f" in {delay:.1f}s")
+            )
+            if delay:
+                sleep(delay)
+            continue
+
+        info["request_seconds"] += time.perf_counter() - started
+        record_result(True, name)
+        return result
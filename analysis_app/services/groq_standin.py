@@ -0,0 +1,258 @@
+# analysis_app/services/groq_standin.py
+from __future__ import annotations
+
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# served when no --responses file overrides them; shaped like DESIGN_INSTRUCTION / BOM_INSTRUCTION
+CANNED_RESPONSES: Dict[str, Any] = {
+    "design": {
+        "fluids": {"shell": "CRUDE OIL", "tube": "COOLING WATER", "header": None},
+        "insulation": "NIL",
+        "design": {
+            "shell": {"temp_c": 150.0, "pressure_mpa": 1.5},
+            "tube": {"temp_c": 80.0, "pressure_mpa": 0.8},
+        },
+        "operating": {
+            "shell": {"temp_c": 120.0, "pressure_mpa": 1.0},
+            "tube": {"temp_c": 45.0, "pressure_mpa": 0.5},
+        },
+    },
+    "bom": {
+        "items": [
+            {"part_label": "Shell", "material_raw": "SA-516-70", "side": "shell"},
+            {"part_label": "Head", "material_raw": "SA-516-70", "side": "shell"},
+            {"part_label": "Channel", "material_raw": "SA-240 316", "side": "tube"},
+            {"part_label": "Tube Bundle", "material_raw": "SA-179", "side": "tube"},
+        ]
+    },
+}
+
+DEFAULT_STANDIN: Dict[str, Any] = {
+    "latency_ms": 800.0,  # mean time to answer
+    "jitter_ms": 200.0,  # +/- uniformly around the mean
+    "error_rate": 0.0,  # share of requests answered 500
+    "rate_limit_rate": 0.0,  # share answered 429 with Retry-After
+    "retry_after": 2,  # seconds, sent with every 429
+    "seed": 0,  # same seed + same request order = same latencies and failures
+    "responses": CANNED_RESPONSES,
+}
+
+
+def _prompt_text(body: Dict[str, Any]) -> Tuple[str, int]:
+    """All text parts of the user messages, and the number of images sent."""
+    texts: List[str] = []
+    images = 0
+    for message in body.get("messages") or []:
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                texts.append(part.get("text") or "")
+            elif part.get("type") == "image_url":
+                images += 1
+    return "\n".join(texts), images
+
+
+def prompt_kind(text: str) -> str:
+    """Which ai_extractor prompt this is: combined, design, bom or unknown."""
+    if "=== DESIGN OBJECT ===" in text or "=== BOM OBJECT ===" in text:
+        return "combined"
+    if "DESIGN DATA" in text and "\"fluids\"" in text:
+        return "design"
+    if "BILL OF MATERIAL" in text and "\"items\"" in text:
+        return "bom"
+    return "unknown"
+
+
+def answer_for(body: Dict[str, Any], responses: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    text, images = _prompt_text(body)
+    kind = prompt_kind(text)
+    if kind == "design":
+        return kind, responses["design"]
+    if kind == "bom":
+        return kind, responses["bom"]
+    if kind == "combined":
+        has_design = "=== DESIGN OBJECT ===" in text
+        answer: Dict[str, Any] = {}
+        if has_design:
+            answer["design"] = responses["design"]
+        if "=== BOM OBJECT ===" in text:
+            answer["bom_tables"] = [responses["bom"]] * max(1, images - int(has_design))
+        return kind, answer
+    return kind, {}
+
+
+def _completion(model: str, content: str, prompt_chars: int) -> Dict[str, Any]:
+    # token counts are rough (4 chars per token); enough for usage-based dashboards
+    prompt_tokens = prompt_chars // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _chunk(completion_id: str, model: str, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}],
+    }
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], config: Optional[Dict[str, Any]] = None):
+        super().__init__(address, StandinHandler)
+        self.config = dict(DEFAULT_STANDIN)
+        self.config.update(config or {})
+        self._rng = random.Random(self.config["seed"])
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+
+    def draw(self) -> Tuple[float, str]:
+        """Latency in seconds and outcome ("ok", "error", "rate_limited") for the next request."""
+        c = self.config
+        with self._lock:
+            latency = c["latency_ms"] + self._rng.uniform(-c["jitter_ms"], c["jitter_ms"])
+            roll = self._rng.random()
+        if roll < c["rate_limit_rate"]:
+            outcome = "rate_limited"
+        elif roll < c["rate_limit_rate"] + c["error_rate"]:
+            outcome = "error"
+        else:
+            outcome = "ok"
+        return max(0.0, latency) / 1000.0, outcome
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    server: StandinServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.config.get("verbose"):
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, self.server.counts)
+        elif self.path.rstrip("/").endswith("/models"):
+            model = {"id": "standin", "object": "model", "owned_by": "standin"}
+            self._send_json(200, {"object": "list", "data": [model]})
+        else:
+            self._send_json(404, {"error": {"message": f"No route {self.path}", "type": "not_found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"No route {self.path}", "type": "not_found"}})
+            return
+        try:
+            body = json.loads(raw or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Body is not JSON", "type": "invalid_request_error"}})
+            return
+
+        latency, outcome = self.server.draw()
+        time.sleep(latency)
+
+        if outcome == "rate_limited":
+            self.server.count("429")
+            retry_after = self.server.config["retry_after"]
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached (stand-in)", "type": "rate_limit_exceeded"}},
+                {"retry-after": str(retry_after)},
+            )
+            return
+        if outcome == "error":
+            self.server.count("500")
+            self._send_json(500, {"error": {"message": "Internal error (stand-in)", "type": "internal_error"}})
+            return
+
+        kind, answer = answer_for(body, self.server.config["responses"])
+        self.server.count(kind)
+        content = json.dumps(answer)
+        completion = _completion(body.get("model") or "standin", content, len(raw))
+        if body.get("stream"):
+            self._send_stream(completion, content, latency)
+        else:
+            self._send_json(200, completion)
+
+    def _send_stream(self, completion: Dict[str, Any], content: str, latency: float) -> None:
+        """Send the answer as SSE chunks of a few characters, spread over another `latency` seconds."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        pieces = [content[i : i + 8] for i in range(0, len(content), 8)] or [""]
+        pause = latency / len(pieces)
+        model = completion["model"]
+
+        def send(payload: Any) -> None:
+            data = payload if isinstance(payload, str) else json.dumps(payload)
+            self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            send(_chunk(completion["id"], model, {"role": "assistant", "content": ""}))
+            for piece in pieces:
+                time.sleep(pause)
+                send(_chunk(completion["id"], model, {"content": piece}))
+            last = _chunk(completion["id"], model, {}, "stop")
+            last["x_groq"] = {"id": completion["id"], "usage": completion["usage"]}
+            send(last)
+            send("[DONE]")
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count("stream_aborted")
+
+
+def make_server(host: str, port: int, config: Optional[Dict[str, Any]] = None) -> StandinServer:
+    return StandinServer((host, port), config)
@@ -105,6 +105,11 @@ def _norm_eq(s: str) -> str:
     return (s or "").strip().upper().replace(" ", "")
 
 
+def equipment_key(pmt_no: str, equipment_no: str) -> Tuple[str, str]:
+    # how PMT / equipment numbers are compared everywhere (case and spacing ignored)
+    return _norm_pmt(pmt_no), _norm_eq(equipment_no)
+
+
 def get_design_rule(pmt_no: str, equipment_no: str) -> Optional[DesignTemplateRule]:
     p_norm = _norm_pmt(pmt_no)
     e_norm = _norm_eq(equipment_no)
@@ -396,6 +401,84 @@ def get_or_create_masterfile_workbook(workbook_rel_path: str) -> Path:
     return abs_path
 
 
+# columns filled from design data / from BOM materials; the rest come from the template
+DESIGN_COLUMNS = (COL_FLUID, COL_INSULATION, COL_DESIGN_TEMP, COL_DESIGN_PRESS, COL_OPER_TEMP, COL_OPER_PRESS)
+BOM_COLUMNS = (COL_SPEC, COL_GRADE)
+
+
+def _part_row_values(
+    pattern: TemplatePartPattern,
+    design_meta: Dict[str, Any],
+    bom_items: List[Dict[str, Any]],
+    use_template_oper: bool,
+) -> Dict[int, Any]:
+    """Column -> value for one part row of an equipment block."""
+    fluids = (design_meta.get("fluids") or {})
+    design = (design_meta.get("design") or {})
+    operating = (design_meta.get("operating") or {})
+    insulation_norm = _normalise_insulation(design_meta.get("insulation"))
+
+    def get_design_for_side(side: str) -> Tuple[Optional[float], Optional[float]]:
+        side_block = (design.get(side) or {})
+        return side_block.get("temp_c"), side_block.get("pressure_mpa")
+
+    def get_oper_for_side(side: str) -> Tuple[Optional[float], Optional[float]]:
+        side_block = (operating.get(side) or {})
+        return side_block.get("temp_c"), side_block.get("pressure_mpa")
+
+    part_label = pattern.part
+    side = infer_side_from_part(part_label)
+
+    material_item = find_best_material_for_part(bom_items, part_label) if bom_items else None
+    material_raw = material_item.get("material_raw") if material_item else ""
+    spec, grade = parse_material(material_raw or "")
+
+    if side == "shell":
+        fluid_val = (
+            fluids.get("shell")
+            or fluids.get("shell side")
+            or fluids.get("shell_side")
+        )
+    else:
+        fluid_val = (
+            fluids.get("tube")
+            or fluids.get("header")
+            or fluids.get("tube side")
+            or fluids.get("tube_side")
+        )
+
+    des_temp, des_press = get_design_for_side(side)
+    if not des_temp and not des_press:
+        des_temp, des_press = get_design_for_side("shell")
+
+    if use_template_oper:
+        op_temp = pattern.oper_temp
+        op_press = pattern.oper_press
+
+        if op_temp is None and op_press is None:
+            op_temp, op_press = get_oper_for_side(side)
+            if not op_temp and not op_press:
+                op_temp, op_press = get_oper_for_side("shell")
+    else:
+        op_temp, op_press = get_oper_for_side(side)
+        if not op_temp and not op_press:
+            op_temp, op_press = get_oper_for_side("shell")
+
+    return {
+        COL_PARTS: part_label,
+        COL_PHASE: pattern.phase,
+        COL_FLUID: fluid_val or None,
+        COL_TYPE: pattern.type_name,
+        COL_SPEC: spec or None,
+        COL_GRADE: grade or None,
+        COL_INSULATION: insulation_norm,
+        COL_DESIGN_TEMP: des_temp,
+        COL_DESIGN_PRESS: des_press,
+        COL_OPER_TEMP: op_temp,
+        COL_OPER_PRESS: op_press,
+    }
+
+
 def append_equipment_to_masterfile(
     workbook_rel_path: str,
     original_filename: str,
@@ -428,72 +511,14 @@ def append_equipment_to_masterfile(
     print("DEBUG first empty row:", current_row)
 
    
-    fluids = (design_meta.get("fluids") or {})
-    design = (design_meta.get("design") or {})
-    operating = (design_meta.get("operating") or {})
-    insulation_norm = _normalise_insulation(design_meta.get("insulation"))
-
-    def get_design_for_side(side: str) -> Tuple[Optional[float], Optional[float]]:
-        side_block = (design.get(side) or {})
-        return side_block.get("temp_c"), side_block.get("pressure_mpa")
-
-    def get_oper_for_side(side: str) -> Tuple[Optional[float], Optional[float]]:
-        side_block = (operating.get(side) or {})
-        return side_block.get("temp_c"), side_block.get("pressure_mpa")
-
-    
     is_first_row_for_equipment = True
     first_row_for_equipment: Optional[int] = None
 
     use_template_oper = _use_template_operating(pmt_no, equipment_no)
 
     for pattern in patterns:
-        part_label = pattern.part
-        side = infer_side_from_part(part_label)
-
-      
-        material_item = find_best_material_for_part(bom_items, part_label) if bom_items else None
-        material_raw = material_item.get("material_raw") if material_item else ""
-        spec, grade = parse_material(material_raw or "")
+        values = _part_row_values(pattern, design_meta, bom_items, use_template_oper)
 
-        
-        if side == "shell":
-            fluid_val = (
-                fluids.get("shell")
-                or fluids.get("shell side")
-                or fluids.get("shell_side")
-            )
-        else:
-            fluid_val = (
-                fluids.get("tube")
-                or fluids.get("header")
-                or fluids.get("tube side")
-                or fluids.get("tube_side")
-            )
-
-        
-        des_temp, des_press = get_design_for_side(side)
-        if not des_temp and not des_press:
-            des_temp, des_press = get_design_for_side("shell")
-
-        
-        if use_template_oper:
-            
-            op_temp = pattern.oper_temp
-            op_press = pattern.oper_press
-
-            
-            if op_temp is None and op_press is None:
-                op_temp, op_press = get_oper_for_side(side)
-                if not op_temp and not op_press:
-                    op_temp, op_press = get_oper_for_side("shell")
-        else:
-           
-            op_temp, op_press = get_oper_for_side(side)
-            if not op_temp and not op_press:
-                op_temp, op_press = get_oper_for_side("shell")
-
-        
         r = current_row
 
         if is_first_row_for_equipment:
@@ -506,17 +531,8 @@ def append_equipment_to_masterfile(
 
             is_first_row_for_equipment = False
 
-        ws_out.cell(row=r, column=COL_PARTS).value = part_label
-        ws_out.cell(row=r, column=COL_PHASE).value = pattern.phase
-        ws_out.cell(row=r, column=COL_FLUID).value = fluid_val or None
-        ws_out.cell(row=r, column=COL_TYPE).value = pattern.type_name
-        ws_out.cell(row=r, column=COL_SPEC).value = spec or None
-        ws_out.cell(row=r, column=COL_GRADE).value = grade or None
-        ws_out.cell(row=r, column=COL_INSULATION).value = insulation_norm
-        ws_out.cell(row=r, column=COL_DESIGN_TEMP).value = des_temp
-        ws_out.cell(row=r, column=COL_DESIGN_PRESS).value = des_press
-        ws_out.cell(row=r, column=COL_OPER_TEMP).value = op_temp
-        ws_out.cell(row=r, column=COL_OPER_PRESS).value = op_press
+        for col, value in values.items():
+            ws_out.cell(row=r, column=col).value = value
 
         current_row += 1
 
@@ -543,3 +559,75 @@ def append_equipment_to_masterfile(
             wrap_text=False,   
         )
     wb_out.save(abs_path)
+
+
+def find_equipment_rows(ws, pmt_no: str, equipment_no: str) -> List[int]:
+    """Rows of the last block written for this equipment (regenerate appends a new one)."""
+    start = None
+    for row in range(FIRST_DATA_ROW, ws.max_row + 1):
+        eq_val = ws.cell(row=row, column=COL_EQUIPMENT_NO).value or ""
+        pmt_val = ws.cell(row=row, column=COL_PMT_NO).value or ""
+        if _norm_eq(str(eq_val)) == _norm_eq(equipment_no) and _norm_pmt(str(pmt_val)) == _norm_pmt(pmt_no):
+            start = row
+    if start is None:
+        return []
+
+    rows = [start]
+    row = start + 1
+    while row <= ws.max_row:
+        # merged equipment cells read as empty inside the block
+        if ws.cell(row=row, column=COL_EQUIPMENT_NO).value or ws.cell(row=row, column=COL_PMT_NO).value:
+            break
+        if ws.cell(row=row, column=COL_PARTS).value in (None, ""):
+            break
+        rows.append(row)
+        row += 1
+    return rows
+
+
+def update_equipment_in_masterfile(
+    workbook_rel_path: str,
+    original_filename: str,
+    design_meta: Optional[Dict[str, Any]] = None,
+    bom_items: Optional[List[Dict[str, Any]]] = None,
+) -> bool:
+    """
+    Overwrite the extracted columns of an equipment block already in the
+    workbook: design columns when design_meta is given, SPEC/GRADE when
+    bom_items is given. Returns False when the equipment has no block yet.
+    """
+    pmt_no, equipment_no = parse_filename(original_filename)
+    _tmpl_wb, tmpl_ws = load_masterfile_template()
+    patterns, _, _ = extract_equipment_pattern(tmpl_ws, pmt_no, equipment_no)
+    if not patterns:
+        print(f"[Masterfile] No template pattern found for {pmt_no} / {equipment_no}")
+        return False
+
+    abs_path = Path(settings.MEDIA_ROOT) / workbook_rel_path
+    if not abs_path.exists():
+        return False
+    wb_out = load_workbook(abs_path)
+    ws_out = wb_out[MASTERFILE_SHEET_NAME]
+
+    rows = find_equipment_rows(ws_out, pmt_no, equipment_no)
+    if not rows:
+        return False
+
+    columns: List[int] = []
+    if design_meta is not None:
+        columns.extend(DESIGN_COLUMNS)
+    if bom_items is not None:
+        columns.extend(BOM_COLUMNS)
+
+    by_part = {_normalise_token(p.part): p for p in patterns}
+    use_template_oper = _use_template_operating(pmt_no, equipment_no)
+    for row in rows:
+        pattern = by_part.get(_normalise_token(str(ws_out.cell(row=row, column=COL_PARTS).value)))
+        if pattern is None:
+            continue
+        values = _part_row_values(pattern, design_meta or {}, bom_items or [], use_template_oper)
+        for col in columns:
+            ws_out.cell(row=row, column=col).value = values[col]
+
+    wb_out.save(abs_path)
+    return True
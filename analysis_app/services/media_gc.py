@@ -0,0 +1,148 @@
+# analysis_app/services/media_gc.py
+from __future__ import annotations
+
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from PIL import Image
+from django.conf import settings
+
+from ..models import Analysis, AnalysisPage, RegionSelection
+from .cropper import CROPS_DIR, _pixel_box, crop_cache_name
+from .rasterizer import PAGES_DIR
+
+DAY = 24 * 60 * 60
+
+# seconds an unreferenced file is kept; the grace period covers files written
+# before their DB row is saved (an upload or render still in flight)
+DEFAULT_RETENTION: Dict[str, int] = {
+    "analysis/crops": 7 * DAY,
+    "analysis/pages": 1 * DAY,
+    "analysis/pdf": 1 * DAY,
+    "analysis/ppt": 30 * DAY,
+    "analysis/workbooks": 30 * DAY,
+}
+
+
+@dataclass
+class DirReport:
+    directory: str
+    scanned: int = 0
+    referenced: int = 0
+    kept_recent: int = 0
+    removed: List[str] = field(default_factory=list)
+    removed_bytes: int = 0
+    errors: List[str] = field(default_factory=list)
+
+
+def media_retention() -> Dict[str, int]:
+    retention = dict(DEFAULT_RETENTION)
+    retention.update(getattr(settings, "ANALYSIS_MEDIA_RETENTION", {}) or {})
+    return retention
+
+
+def _crop_names(media_root: Path) -> Set[str]:
+    # crops are named after their page and pixel box, so the names every
+    # current region would use can be recomputed without decoding any page
+    names: Set[str] = set()
+    regions = RegionSelection.objects.select_related("page").only(
+        "x1", "y1", "x2", "y2", "page__image"
+    )
+    sizes: Dict[str, Optional[tuple]] = {}
+    for r in regions.iterator():
+        page_name = r.page.image.name
+        if page_name not in sizes:
+            page_path = media_root / page_name
+            try:
+                with Image.open(page_path) as img:
+                    sizes[page_name] = (img.size, page_path.stat())
+            except (FileNotFoundError, OSError):
+                sizes[page_name] = None
+        info = sizes[page_name]
+        if info is None:
+            continue
+        try:
+            box = _pixel_box(info[0], r.x1, r.y1, r.x2, r.y2)
+        except ValueError:
+            continue
+        names.add(crop_cache_name(page_name, box, info[1]))
+    return names
+
+
+def referenced_files(media_root: Optional[Path] = None) -> Dict[str, Set[str]]:
+    """MEDIA_ROOT-relative names each managed directory still needs."""
+    media_root = Path(media_root or settings.MEDIA_ROOT)
+    analyses = Analysis.objects.values_list("file", "workbook_path", "pptx_path")
+
+    refs: Dict[str, Set[str]] = {d: set() for d in DEFAULT_RETENTION}
+    for pdf, workbook, pptx in analyses.iterator():
+        if pdf:
+            refs["analysis/pdf"].add(pdf)
+        if workbook:
+            refs["analysis/workbooks"].add(workbook)
+        if pptx:
+            refs["analysis/ppt"].add(pptx)
+    refs[PAGES_DIR].update(AnalysisPage.objects.values_list("image", flat=True))
+    refs[CROPS_DIR] = _crop_names(media_root)
+    return refs
+
+
+def collect_media_garbage(
+    dry_run: bool = True,
+    directories: Optional[List[str]] = None,
+    media_root: Optional[Path] = None,
+    now: Optional[float] = None,
+) -> List[DirReport]:
+    """
+    Remove files under the managed media directories that no DB row references
+    and that are older than the directory's retention. With dry_run nothing is
+    deleted; the reports list what would be. Otherwise only files actually
+    unlinked are counted in removed / removed_bytes.
+    """
+    media_root = Path(media_root or settings.MEDIA_ROOT)
+    now = now or time.time()
+    retention = media_retention()
+    refs = referenced_files(media_root)
+
+    reports: List[DirReport] = []
+    for directory in directories or sorted(retention):
+        report = DirReport(directory=directory)
+        reports.append(report)
+        root = media_root / directory
+        if not root.is_dir():
+            continue
+
+        keep = {name.replace(os.sep, "/") for name in refs.get(directory, set())}
+        cutoff = now - retention.get(directory, DEFAULT_RETENTION.get(directory, 30 * DAY))
+
+        doomed: List[tuple] = []
+        for entry in os.scandir(root):
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            report.scanned += 1
+            rel = f"{directory}/{entry.name}"
+            if rel in keep:
+                report.referenced += 1
+                continue
+            st = entry.stat(follow_symlinks=False)
+            if st.st_mtime > cutoff:
+                report.kept_recent += 1
+                continue
+            doomed.append((Path(entry.path), rel, st.st_size))
+
+        for path, rel, size in doomed:
+            if not dry_run:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    continue  # already gone: someone else freed it
+                except OSError as e:
+                    report.errors.append(f"{path.name}: {e}")
+                    continue
+            report.removed.append(rel)
+            report.removed_bytes += size
+
+    return reports
@@ -0,0 +1,171 @@
+# analysis_app/services/preprocess.py
+from __future__ import annotations
+
+import io
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+
+
+# ANALYSIS_VISION_PREPROCESS overrides any of these keys
+DEFAULT_PREPROCESS: Dict[str, Any] = {
+    "enabled": True,
+    "steps": ["grayscale", "deskew", "trim", "downscale"],
+    "binarize_threshold": 160,  # used by the "binarize" step
+    "deskew_max_angle": 3.0,  # degrees either way
+    "deskew_step": 0.25,
+    "trim_threshold": 245,  # pixels lighter than this count as background
+    "trim_padding": 8,
+    "max_long_edge": 1600,
+    "log": False,  # print size/mode/latency per step
+}
+
+
+def preprocess_config() -> Dict[str, Any]:
+    config = dict(DEFAULT_PREPROCESS)
+    config.update(getattr(settings, "ANALYSIS_VISION_PREPROCESS", {}) or {})
+    return config
+
+
+def _grayscale(img: Image.Image, config: Dict[str, Any]) -> Image.Image:
+    return img if img.mode == "L" else img.convert("L")
+
+
+def _binarize(img: Image.Image, config: Dict[str, Any]) -> Image.Image:
+    threshold = int(config["binarize_threshold"])
+    return _grayscale(img, config).point(lambda p: 255 if p > threshold else 0, mode="1")
+
+
+def _skew_angle(img: Image.Image, max_angle: float, step: float) -> float:
+    # projection profile: text rows line up best (sharpest row sums) at the skew angle
+    small = img.convert("L")  # always a copy; thumbnail() works in place
+    small.thumbnail((800, 800))
+    ink = small.point(lambda p: 255 if p < 160 else 0)
+
+    def score(angle: float) -> float:
+        rotated = ink.rotate(angle, resample=Image.NEAREST, fillcolor=0)
+        rows = np.asarray(rotated, dtype=np.float32).sum(axis=1)
+        return float(np.square(np.diff(rows)).sum())
+
+    # an angle has to beat "no rotation" outright, so blank or flat crops stay as they are
+    best_angle, best_score = 0.0, score(0.0)
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        if abs(angle) < 1e-9:
+            continue
+        s = score(float(angle))
+        if s > best_score:
+            best_angle, best_score = float(angle), s
+    return best_angle
+
+
+def _deskew(img: Image.Image, config: Dict[str, Any]) -> Image.Image:
+    step = float(config["deskew_step"])
+    angle = _skew_angle(img, float(config["deskew_max_angle"]), step)
+    # one search step off level is within the noise of the projection score
+    if abs(angle) <= step:
+        return img
+    fill = 255 if img.mode in ("L", "1") else (255,) * len(img.getbands())
+    return img.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=fill)
+
+
+def _trim(img: Image.Image, config: Dict[str, Any]) -> Image.Image:
+    gray = _grayscale(img, config)
+    threshold = int(config["trim_threshold"])
+    bbox = gray.point(lambda p: 255 if p < threshold else 0).getbbox()
+    if not bbox:
+        return img
+    pad = int(config["trim_padding"])
+    left, upper, right, lower = bbox
+    box = (
+        max(0, left - pad),
+        max(0, upper - pad),
+        min(img.width, right + pad),
+        min(img.height, lower + pad),
+    )
+    return img if box == (0, 0, img.width, img.height) else img.crop(box)
+
+
+def _downscale(img: Image.Image, config: Dict[str, Any]) -> Image.Image:
+    max_edge = int(config["max_long_edge"])
+    if max(img.size) <= max_edge:
+        return img
+    scale = max_edge / max(img.size)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    if img.mode == "1":
+        img = img.convert("L")
+    return img.resize(size, Image.LANCZOS)
+
+
+STEPS: Dict[str, Callable[[Image.Image, Dict[str, Any]], Image.Image]] = {
+    "grayscale": _grayscale,
+    "binarize": _binarize,
+    "deskew": _deskew,
+    "trim": _trim,
+    "downscale": _downscale,
+}
+
+
+def _encode_png(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=img.mode in ("L", "1"))
+    return buf.getvalue()
+
+
+def preprocess_for_vision(
+    png_bytes: bytes, config: Optional[Dict[str, Any]] = None
+) -> Tuple[bytes, List[Dict[str, Any]]]:
+    """
+    Run the configured steps over an encoded crop and return the re-encoded
+    PNG plus one stats dict per step (size in pixels, mode, milliseconds;
+    bytes only for the input and the final encode). Unknown step names
+    raise ValueError.
+    """
+    config = config or preprocess_config()
+    if not config.get("enabled", True):
+        return png_bytes, []
+
+    steps = list(config.get("steps") or [])
+    unknown = [s for s in steps if s not in STEPS]
+    if unknown:
+        raise ValueError(f"Unknown preprocessing step(s) {unknown}; choose from {sorted(STEPS)}")
+
+    log = bool(config.get("log", False))
+    with Image.open(io.BytesIO(png_bytes)) as src:
+        img = src.copy()
+    stats: List[Dict[str, Any]] = [
+        {"step": "input", "size": img.size, "mode": img.mode, "bytes": len(png_bytes), "ms": 0.0}
+    ]
+
+    for name in steps:
+        started = time.perf_counter()
+        img = STEPS[name](img, config)
+        elapsed = (time.perf_counter() - started) * 1000
+        # no per-step encode: an optimized PNG encode costs more than the steps themselves
+        stats.append({"step": name, "size": img.size, "mode": img.mode, "bytes": None, "ms": elapsed})
+
+    started = time.perf_counter()
+    out = _encode_png(img)
+    stats.append(
+        {
+            "step": "encode",
+            "size": img.size,
+            "mode": img.mode,
+            "bytes": len(out),
+            "ms": (time.perf_counter() - started) * 1000,
+        }
+    )
+
+    if log:
+        for s in stats:
+            size = f"{s['size'][0]}x{s['size'][1]}"
+            kb = f"{s['bytes'] / 1024:.0f} KB" if s["bytes"] is not None else "-"
+            print(f"[preprocess] {s['step']:<10} {size:>11} {s['mode']:<4} {kb:>8} {s['ms']:7.1f} ms")
+        print(
+            f"[preprocess] payload {len(png_bytes) / 1024:.0f} KB -> {len(out) / 1024:.0f} KB "
+            f"({(1 - len(out) / len(png_bytes)) * 100:.0f}% smaller)"
+        )
+
+    return out, stats
@@ -0,0 +1,180 @@
+# analysis_app/services/raster_queue.py
+from __future__ import annotations
+
+import os
+import socket
+from datetime import timedelta
+from typing import List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from ..models import Analysis, RasterJob
+from .rasterizer import get_page_count, iter_render_pages_parallel, record_page, render_pages
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_rasterization(analysis: Analysis) -> RasterJob:
+    analysis.status = "pending"
+    analysis.save(update_fields=["status"])
+    return RasterJob.objects.create(analysis=analysis)
+
+
+def _max_attempts() -> int:
+    return int(getattr(settings, "RASTER_JOB_MAX_ATTEMPTS", 3))
+
+
+def _fail_analysis_without_pages(analysis: Analysis) -> None:
+    # once page 1 exists the analysis is usable; select_region renders missing pages on demand
+    if not analysis.pages.exists():
+        analysis.status = "failed"
+        analysis.save(update_fields=["status"])
+
+
+def requeue_stale_jobs(stale_after: Optional[int] = None) -> int:
+    """
+    Put jobs whose worker stopped sending heartbeats back on the queue, or
+    fail them once they used up RASTER_JOB_MAX_ATTEMPTS (a job that keeps
+    killing its worker must not loop forever). Returns the jobs requeued.
+    """
+    if stale_after is None:
+        stale_after = int(getattr(settings, "RASTER_JOB_STALE_AFTER", 15 * 60))
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    stale = RasterJob.objects.filter(status="running", locked_at__lt=cutoff)
+
+    exhausted = list(stale.filter(attempts__gte=_max_attempts()).select_related("analysis"))
+    for job in exhausted:
+        failed = RasterJob.objects.filter(pk=job.pk, status="running", locked_at__lt=cutoff).update(
+            status="failed",
+            worker_id=None,
+            locked_at=None,
+            error=f"worker stopped responding (attempt {job.attempts})",
+            updated_at=timezone.now(),
+        )
+        if failed:
+            print(f"Raster job {job.id} failed: worker stopped responding {job.attempts} times")
+            _fail_analysis_without_pages(job.analysis)
+
+    return stale.filter(attempts__lt=_max_attempts()).update(
+        status="queued", worker_id=None, locked_at=None, updated_at=timezone.now()
+    )
+
+
+def heartbeat(job: RasterJob) -> bool:
+    """
+    Refresh the job's lock so requeue_stale_jobs leaves it alone. False
+    means the job was taken away from this worker (it looked dead).
+    """
+    return bool(
+        RasterJob.objects.filter(pk=job.pk, status="running", worker_id=job.worker_id).update(
+            locked_at=timezone.now(), updated_at=timezone.now()
+        )
+    )
+
+
+class JobLost(Exception):
+    """The job was requeued or failed while this worker still had it."""
+
+
+def claim_next_job(worker_id: str) -> Optional[RasterJob]:
+    """
+    Atomically take the oldest queued job.
+
+    The claim is a conditional UPDATE on (pk, status="queued"), so several
+    worker processes - on this host or others sharing the DB and media
+    directory - can poll the same table without handing a job out twice.
+    """
+    candidates = list(
+        RasterJob.objects.filter(status="queued")
+        .order_by("created_at")
+        .values_list("pk", flat=True)[:10]
+    )
+    for pk in candidates:
+        claimed = RasterJob.objects.filter(pk=pk, status="queued").update(
+            status="running",
+            worker_id=worker_id,
+            locked_at=timezone.now(),
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return RasterJob.objects.select_related("analysis").get(pk=pk)
+    return None
+
+
+def _missing_ranges(recorded: Set[int], first_page: int, last_page: int) -> List[Tuple[int, int]]:
+    """Contiguous (first, last) runs of pages in first_page..last_page not yet recorded."""
+    ranges: List[Tuple[int, int]] = []
+    for n in range(first_page, last_page + 1):
+        if n in recorded:
+            continue
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1] = (ranges[-1][0], n)
+        else:
+            ranges.append((n, n))
+    return ranges
+
+
+def run_job(job: RasterJob) -> None:
+    analysis = job.analysis
+    pdf_path = analysis.file.path
+
+    try:
+        page_count = get_page_count(pdf_path)
+        if page_count < 1:
+            raise ValueError("PDF has no pages")
+
+        analysis.page_count = page_count
+        analysis.save(update_fields=["page_count"])
+
+        # pages a previous attempt (or select_region) already recorded are not rendered again
+        recorded = set(analysis.pages.values_list("page_number", flat=True))
+
+        # page 1 first so the user can start selecting regions straight away
+        if 1 not in recorded:
+            first_rel = render_pages(pdf_path, analysis.id, first_page=1, last_page=1)[0]
+            record_page(analysis, 1, first_rel)
+        if analysis.status == "pending":
+            analysis.status = "awaiting_regions"
+            analysis.save(update_fields=["status"])
+
+        for first, last in _missing_ranges(recorded, 2, page_count):
+            if not heartbeat(job):
+                raise JobLost()
+            for idx, rel_path in iter_render_pages_parallel(pdf_path, analysis.id, first, last):
+                record_page(analysis, idx, rel_path)
+                if not heartbeat(job):
+                    raise JobLost()
+
+    except JobLost:
+        # another worker owns it now (or it was failed); leave its row alone
+        print(f"Raster job {job.id} was taken over while running; stopping")
+        return
+
+    except Exception as e:
+        print(f"Raster job {job.id} failed (attempt {job.attempts}): {e}")
+        job.error = str(e)
+        job.worker_id = None
+        job.locked_at = None
+        if job.attempts < _max_attempts():
+            job.status = "queued"
+        else:
+            job.status = "failed"
+            _fail_analysis_without_pages(analysis)
+        job.save(update_fields=["status", "error", "worker_id", "locked_at", "updated_at"])
+        return
+
+    job.status = "done"
+    job.error = None
+    job.save(update_fields=["status", "error", "updated_at"])
+
+
+def run_next_job(worker_id: Optional[str] = None) -> bool:
+    job = claim_next_job(worker_id or default_worker_id())
+    if job is None:
+        return False
+    run_job(job)
+    return True
@@ -0,0 +1,261 @@
+# analysis_app/services/rasterizer.py
+from __future__ import annotations
+
+import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from ..models import Analysis, AnalysisPage
+from .dedupe import find_shared_page
+
+
+PAGES_DIR = "analysis/pages"
+
+
+def _poppler_path() -> Optional[str]:
+    return getattr(settings, "POPPLER_PATH", None) or None
+
+
+def _raster_dpi() -> int:
+    return int(getattr(settings, "ANALYSIS_RASTER_DPI", 200))
+
+
+def get_page_count(pdf_path: str) -> int:
+    from pdf2image import pdfinfo_from_path
+
+    info = pdfinfo_from_path(pdf_path, poppler_path=_poppler_path())
+    return int(info.get("Pages") or 0)
+
+
+# name -> (file extension, PIL format, save kwargs)
+PAGE_FORMATS = {
+    "png": ("png", "PNG", {}),
+    "png-gray": ("png", "PNG", {"optimize": True}),
+    "png-1bit": ("png", "PNG", {"optimize": True}),
+    "png-palette": ("png", "PNG", {"optimize": True}),
+    "webp": ("webp", "WEBP", {"lossless": True, "quality": 80, "method": 4}),
+}
+
+# grey level at or above which a pixel is paper (white) in png-1bit
+BILEVEL_THRESHOLD = 160
+
+
+def page_format() -> str:
+    fmt = getattr(settings, "ANALYSIS_PAGE_FORMAT", "png")
+    if fmt not in PAGE_FORMATS:
+        raise ValueError(f"Unknown ANALYSIS_PAGE_FORMAT {fmt!r}; choose one of {sorted(PAGE_FORMATS)}")
+    return fmt
+
+
+def _renders_grayscale(fmt: str) -> bool:
+    return fmt in ("png-gray", "png-1bit")
+
+
+def page_image_rel_path(analysis_id: int, page_number: int, fmt: Optional[str] = None) -> str:
+    ext = PAGE_FORMATS[fmt or page_format()][0]
+    return f"{PAGES_DIR}/analysis_{analysis_id}_p{page_number}.{ext}"
+
+
+def convert_page_image(page_img, fmt: str):
+    """Return page_img converted to the pixel mode stored for `fmt`."""
+    if fmt == "png-gray":
+        return page_img if page_img.mode == "L" else page_img.convert("L")
+    if fmt == "png-1bit":
+        gray = page_img if page_img.mode == "L" else page_img.convert("L")
+        return gray.point(lambda v: 255 if v >= BILEVEL_THRESHOLD else 0, mode="1")
+    if fmt == "png-palette":
+        from PIL import Image
+
+        rgb = page_img if page_img.mode == "RGB" else page_img.convert("RGB")
+        return rgb.quantize(colors=16, method=Image.Quantize.MEDIANCUT)
+    return page_img
+
+
+def save_page_image(page_img, out_path: Path, fmt: str) -> None:
+    _, pil_format, save_kwargs = PAGE_FORMATS[fmt]
+    converted = convert_page_image(page_img, fmt)
+    converted.save(out_path, pil_format, **save_kwargs)
+    if converted is not page_img:
+        converted.close()
+
+
+def _save_page_image(
+    page_img, analysis_id: int, page_number: int, media_root: Optional[str] = None
+) -> str:
+    fmt = page_format()
+    rel_path = page_image_rel_path(analysis_id, page_number, fmt)
+    out_path = Path(media_root or settings.MEDIA_ROOT) / rel_path
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    save_page_image(page_img, out_path, fmt)
+    return rel_path
+
+
+def _raster_batch_size() -> int:
+    return max(1, int(getattr(settings, "ANALYSIS_RASTER_BATCH_SIZE", 1)))
+
+
+def iter_render_pages(
+    pdf_path: str,
+    analysis_id: int,
+    first_page: int,
+    last_page: int,
+    batch_size: Optional[int] = None,
+    media_root: Optional[str] = None,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Render pages first_page..last_page a batch at a time, yielding
+    (page_number, rel_path) as each page is saved.
+
+    Only one batch of decoded pages is alive at once, so peak memory depends
+    on batch_size and page size, not on how many pages the PDF has.
+    """
+    from pdf2image import convert_from_path
+
+    if batch_size is None:
+        batch_size = _raster_batch_size()
+
+    start = first_page
+    while start <= last_page:
+        end = min(start + batch_size - 1, last_page)
+        batch = convert_from_path(
+            pdf_path,
+            dpi=_raster_dpi(),
+            first_page=start,
+            last_page=end,
+            poppler_path=_poppler_path(),
+            grayscale=_renders_grayscale(page_format()),
+        )
+        for offset in range(len(batch)):
+            page_img = batch[offset]
+            batch[offset] = None
+            rel_path = _save_page_image(page_img, analysis_id, start + offset, media_root)
+            page_img.close()
+            del page_img
+            yield start + offset, rel_path
+        del batch
+        start = end + 1
+
+
+def _raster_processes() -> int:
+    return max(1, int(getattr(settings, "ANALYSIS_RASTER_PROCESSES", 1)))
+
+
+def _init_raster_process() -> None:
+    # spawned children (Windows) re-import this module, which needs the app registry
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+def _render_page_range(
+    pdf_path: str,
+    analysis_id: int,
+    first_page: int,
+    last_page: int,
+    media_root: Optional[str],
+) -> List[Tuple[int, str]]:
+    return list(
+        iter_render_pages(pdf_path, analysis_id, first_page, last_page, media_root=media_root)
+    )
+
+
+def split_page_range(first_page: int, last_page: int, chunks: int) -> List[Tuple[int, int]]:
+    """Split first_page..last_page into at most `chunks` contiguous, ordered ranges."""
+    total = last_page - first_page + 1
+    if total <= 0:
+        return []
+    size = math.ceil(total / max(1, chunks))
+    return [
+        (start, min(start + size - 1, last_page))
+        for start in range(first_page, last_page + 1, size)
+    ]
+
+
+def iter_render_pages_parallel(
+    pdf_path: str,
+    analysis_id: int,
+    first_page: int,
+    last_page: int,
+    processes: Optional[int] = None,
+    media_root: Optional[str] = None,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Render first_page..last_page across a process pool.
+
+    The range is cut into contiguous chunks (two per process, so a slow
+    chunk does not leave the other cores idle). Results are yielded per
+    finished chunk in page order within it; callers key pages by
+    page_number, so completion order does not affect AnalysisPage numbering.
+    """
+    if processes is None:
+        processes = _raster_processes()
+
+    if processes <= 1 or last_page <= first_page:
+        yield from iter_render_pages(
+            pdf_path, analysis_id, first_page, last_page, media_root=media_root
+        )
+        return
+
+    ranges = split_page_range(first_page, last_page, processes * 2)
+    with ProcessPoolExecutor(
+        max_workers=min(processes, len(ranges)), initializer=_init_raster_process
+    ) as pool:
+        futures = [
+            pool.submit(_render_page_range, pdf_path, analysis_id, start, end, media_root)
+            for start, end in ranges
+        ]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def render_pages(
+    pdf_path: str,
+    analysis_id: int,
+    first_page: int = 1,
+    last_page: Optional[int] = None,
+) -> List[str]:
+    """Render pages first_page..last_page and return their MEDIA-relative paths."""
+    if last_page is None:
+        last_page = get_page_count(pdf_path)
+    return [
+        rel_path
+        for _, rel_path in iter_render_pages(pdf_path, analysis_id, first_page, last_page)
+    ]
+
+
+def record_page(analysis: Analysis, page_number: int, rel_path: str) -> AnalysisPage:
+    try:
+        page, _ = AnalysisPage.objects.get_or_create(
+            analysis=analysis,
+            page_number=page_number,
+            defaults={"image": rel_path},
+        )
+    except IntegrityError:
+        # a worker or another request recorded the same page first; the file is identical
+        page = AnalysisPage.objects.get(analysis=analysis, page_number=page_number)
+    return page
+
+
+def ensure_page(analysis: Analysis, page_number: int) -> AnalysisPage:
+    """Return the AnalysisPage, rendering just that page the first time it is needed."""
+    page = AnalysisPage.objects.filter(analysis=analysis, page_number=page_number).first()
+    if page is not None:
+        return page
+
+    shared = find_shared_page(analysis, page_number)
+    if shared is not None:
+        return record_page(analysis, page_number, shared.image.name)
+
+    rel_path = render_pages(
+        analysis.file.path,
+        analysis.id,
+        first_page=page_number,
+        last_page=page_number,
+    )[0]
+    return record_page(analysis, page_number, rel_path)
@@ -0,0 +1,408 @@
+# analysis_app/services/reextract.py
+from __future__ import annotations
+
+import json
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from ..models import Analysis, ReextractItem, ReextractRun
+from .ai_extractor import (
+    extract_bom_materials,
+    extract_design_metadata,
+    get_groq_client,
+    normalize_region,
+    read_vision_answer,
+    region_rule,
+    vision_batch_request,
+)
+from .backends import RegionJob, extract_region
+from .cropper import crop_region_selections
+from .generate import region_text_region
+from .groq_scheduler import bulk_priority
+from .masterfile_builder import (
+    append_equipment_to_masterfile,
+    equipment_key,
+    parse_filename,
+    update_equipment_in_masterfile,
+)
+from .ppt_builder import sync_all_slides_from_masterfile
+
+KINDS = ("design", "bom")
+
+# batch job states with no more output coming
+_BATCH_FINISHED = {"completed", "failed", "expired", "cancelled"}
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+# --- Selecting work ----------------------------------------------------------------
+
+
+def affected_analyses(
+    rules: Sequence[Tuple[str, str]] = (),
+    analysis_ids: Sequence[int] = (),
+) -> List[Analysis]:
+    """
+    Generated analyses (they have a masterfile) with design and BOM regions,
+    limited to the given (pmt_no, equipment_no) rule keys and/or ids.
+    """
+    qs = (
+        Analysis.objects.exclude(workbook_path__isnull=True)
+        .exclude(workbook_path="")
+        .filter(regions__step_type="design_data")
+        .filter(regions__step_type="bom")
+        .distinct()
+        .order_by("id")
+    )
+    if analysis_ids:
+        qs = qs.filter(pk__in=analysis_ids)
+    analyses = list(qs)
+    if rules:
+        wanted = {equipment_key(p, e) for p, e in rules}
+        analyses = [
+            a for a in analyses
+            if equipment_key(*parse_filename(a.original_filename)) in wanted
+        ]
+    return analyses
+
+
+def create_run(analyses: Iterable[Analysis], kinds: Sequence[str], mode: str, description: str) -> ReextractRun:
+    with transaction.atomic():
+        run = ReextractRun.objects.create(mode=mode, description=description[:255])
+        items: List[ReextractItem] = []
+        for analysis in analyses:
+            regions = analysis.regions.all()
+            if "design" in kinds:
+                design_region = regions.filter(step_type="design_data").first()
+                if design_region:
+                    items.append(ReextractItem(run=run, analysis=analysis, region=design_region, kind="design"))
+            if "bom" in kinds:
+                for region in regions.filter(step_type="bom").order_by("id"):
+                    items.append(ReextractItem(run=run, analysis=analysis, region=region, kind="bom"))
+        ReextractItem.objects.bulk_create(items)
+    return run
+
+
+def run_progress(run: ReextractRun) -> Dict[str, int]:
+    counts = {status: 0 for status, _ in ReextractItem.STATUS_CHOICES}
+    for row in run.items.values("status").order_by().annotate(n=Count("id")):
+        counts[row["status"]] = row["n"]
+    return counts
+
+
+def _crops(items: Sequence[ReextractItem]) -> Dict[int, bytes]:
+    return crop_region_selections([item.region for item in items])
+
+
+def _pending(run: ReextractRun):
+    return run.items.filter(status="pending").select_related("analysis", "region", "region__page")
+
+
+def _has_values(value: Any) -> bool:
+    if isinstance(value, dict):
+        return any(_has_values(v) for v in value.values())
+    if isinstance(value, list):
+        return any(_has_values(v) for v in value)
+    return value not in (None, "")
+
+
+def _finish_item(item: ReextractItem, result: Any, source: str) -> None:
+    item.result = result
+    item.source = source
+    # an empty answer must not blank out values the workbook already has
+    if _has_values(result):
+        item.status, item.error = "done", None
+    else:
+        item.status, item.error = "failed", "empty answer; workbook values kept"
+    item.save(update_fields=["result", "source", "status", "error", "updated_at"])
+
+
+def _fail_or_retry(item: ReextractItem, error: str) -> None:
+    # failed requests go back to pending (the next pass or --resume retries them)
+    # until the item has used its attempts
+    item.error = error[:2000]
+    item.status = "failed" if item.attempts >= int(_setting("REEXTRACT_MAX_ATTEMPTS", 3)) else "pending"
+    item.batch_id = None
+    item.save(update_fields=["error", "status", "batch_id", "updated_at"])
+
+
+# --- Local backends first ------------------------------------------------------------
+
+
+def run_local_pass(run: ReextractRun) -> int:
+    """Answer what the text layer / OCR can read without any API call. Returns items done."""
+    done = 0
+    pending = list(_pending(run))
+    by_analysis: Dict[int, List[ReextractItem]] = defaultdict(list)
+    for item in pending:
+        by_analysis[item.analysis_id].append(item)
+
+    for items in by_analysis.values():
+        analysis = items[0].analysis
+        pmt_no, equipment_no = parse_filename(analysis.original_filename)
+        crops = _crops(items)
+        for item in items:
+            rule = region_rule(item.kind, pmt_no, equipment_no)
+            job = RegionJob(item.kind, crops[item.region_id], region_text_region(analysis, item.region), rule)
+            data, backend = extract_region(job)
+            if not data:
+                continue
+            _finish_item(item, normalize_region(item.kind, data, pmt_no, equipment_no), backend)
+            done += 1
+    return done
+
+
+# --- Batch API -----------------------------------------------------------------------
+
+
+def batch_supported(client) -> bool:
+    return hasattr(client, "batches") and hasattr(client, "files") and not _setting("GROQ_BASE_URL", None)
+
+
+def submit_batches(run: ReextractRun, client=None) -> List[str]:
+    """
+    Upload every pending item as batch request lines, in chunks under the
+    batch file size limit. Each chunk's items are marked submitted as soon
+    as its batch exists, so a crash loses at most one chunk's bookkeeping.
+    """
+    client = client or get_groq_client()
+    max_bytes = int(_setting("GROQ_BATCH_MAX_BYTES", 90 * 1024 * 1024))
+    window = _setting("GROQ_BATCH_COMPLETION_WINDOW", "24h")
+
+    pending = list(_pending(run))
+    by_analysis: Dict[int, List[ReextractItem]] = defaultdict(list)
+    for item in pending:
+        by_analysis[item.analysis_id].append(item)
+
+    batch_ids: List[str] = []
+    lines: List[bytes] = []
+    chunk: List[Tuple[ReextractItem, Optional[str]]] = []
+    size = 0
+
+    def flush():
+        nonlocal lines, chunk, size
+        if not chunk:
+            return
+        uploaded = client.files.create(file=("reextract.jsonl", b"".join(lines)), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window=window,
+        )
+        with transaction.atomic():
+            for item, cache_key in chunk:
+                item.batch_id = batch.id
+                item.cache_key = cache_key
+                item.status = "submitted"
+                item.attempts += 1
+                item.save(update_fields=["batch_id", "cache_key", "status", "attempts", "updated_at"])
+        print(f"Re-extract run {run.id}: batch {batch.id} submitted with {len(chunk)} region(s)")
+        batch_ids.append(batch.id)
+        lines, chunk, size = [], [], 0
+
+    for items in by_analysis.values():
+        analysis = items[0].analysis
+        pmt_no, equipment_no = parse_filename(analysis.original_filename)
+        crops = _crops(items)
+        for item in items:
+            body, cache_key = vision_batch_request(item.kind, crops[item.region_id], pmt_no, equipment_no)
+            line = (
+                json.dumps(
+                    {"custom_id": item.custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+                )
+                + "\n"
+            ).encode("utf-8")
+            if size + len(line) > max_bytes:
+                flush()
+            lines.append(line)
+            chunk.append((item, cache_key))
+            size += len(line)
+    flush()
+    return batch_ids
+
+
+def _file_lines(client, file_id: Optional[str]) -> List[Dict[str, Any]]:
+    if not file_id:
+        return []
+    raw = client.files.content(file_id).read()
+    return [json.loads(line) for line in raw.decode("utf-8").splitlines() if line.strip()]
+
+
+def _answer_content(line: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """(content, error) of one batch output line."""
+    response = line.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code") == 200:
+        try:
+            return body["choices"][0]["message"]["content"] or "", None
+        except (KeyError, IndexError, TypeError):
+            return None, "malformed completion in batch output"
+    error = body.get("error") or line.get("error") or {}
+    if isinstance(error, dict) and error.get("code") == "json_validate_failed" and error.get("failed_generation"):
+        return error["failed_generation"], None
+    return None, json.dumps(error)[:500] if error else f"status {response.get('status_code')}"
+
+
+def poll_batches(run: ReextractRun, client=None) -> bool:
+    """
+    Collect results of finished batch jobs. Returns True when no item of
+    the run is waiting on a batch any more.
+    """
+    client = client or get_groq_client()
+    batch_ids = list(
+        run.items.filter(status="submitted").values_list("batch_id", flat=True).distinct().order_by()
+    )
+    waiting = False
+    for batch_id in batch_ids:
+        batch = client.batches.retrieve(batch_id)
+        counts = getattr(batch, "request_counts", None)
+        print(
+            f"Batch {batch_id}: {batch.status}"
+            + (f" ({counts.completed}/{counts.total} done, {counts.failed} failed)" if counts else "")
+        )
+        if batch.status not in _BATCH_FINISHED:
+            waiting = True
+            continue
+
+        items = {
+            i.custom_id: i
+            for i in run.items.filter(batch_id=batch_id, status="submitted").select_related("analysis")
+        }
+        lines = _file_lines(client, getattr(batch, "output_file_id", None))
+        lines += _file_lines(client, getattr(batch, "error_file_id", None))
+        for line in lines:
+            item = items.pop(line.get("custom_id"), None)
+            if item is None:
+                continue
+            content, error = _answer_content(line)
+            if content is None:
+                _fail_or_retry(item, error or "no answer")
+                continue
+            pmt_no, equipment_no = parse_filename(item.analysis.original_filename)
+            result = read_vision_answer(item.kind, content, pmt_no, equipment_no, item.cache_key)
+            if result is None:
+                _fail_or_retry(item, "unusable JSON in answer")
+            elif not _has_values(result):
+                _fail_or_retry(item, "empty answer")
+            else:
+                _finish_item(item, result, "groq_batch")
+        for item in items.values():
+            _fail_or_retry(item, f"batch {batch.status} without an answer for this region")
+    return not waiting
+
+
+# --- Local low-priority queue --------------------------------------------------------
+
+
+def run_queue(run: ReextractRun, limit: Optional[int] = None) -> int:
+    """
+    Re-extract pending items one at a time through the normal extraction
+    path at bulk priority, so interactive generates keep their rate limit
+    headroom. Every item is checkpointed as it finishes. The extractors
+    swallow API errors and answer empty, so an empty answer counts as a
+    failed attempt: the item stays pending for the next run_queue
+    (--resume) until REEXTRACT_MAX_ATTEMPTS.
+    """
+    done = 0
+    by_analysis: Dict[int, List[ReextractItem]] = defaultdict(list)
+    for item in _pending(run):
+        by_analysis[item.analysis_id].append(item)
+
+    with bulk_priority():
+        for items in by_analysis.values():
+            analysis = items[0].analysis
+            pmt_no, equipment_no = parse_filename(analysis.original_filename)
+            crops = _crops(items)
+            for item in items:
+                if limit is not None and done >= limit:
+                    return done
+                item.attempts += 1
+                item.save(update_fields=["attempts", "updated_at"])
+                extract = extract_design_metadata if item.kind == "design" else extract_bom_materials
+                try:
+                    result = extract(
+                        crops[item.region_id],
+                        pmt_no=pmt_no,
+                        equipment_no=equipment_no,
+                        text_region=region_text_region(analysis, item.region),
+                        analysis_id=analysis.id,
+                    )
+                except Exception as exc:
+                    _fail_or_retry(item, str(exc))
+                    continue
+                if not _has_values(result):
+                    _fail_or_retry(item, "no usable answer (request failed or empty)")
+                    continue
+                _finish_item(item, result, "queue")
+                done += 1
+    return done
+
+
+# --- Writing results back ------------------------------------------------------------
+
+
+def write_back(run: ReextractRun) -> int:
+    """
+    Update the masterfile (and slides) of every analysis whose items are all
+    finished. A failed design or BOM part keeps the workbook's current values
+    for those columns. Returns analyses written.
+    """
+    by_analysis: Dict[int, List[ReextractItem]] = defaultdict(list)
+    for item in run.items.exclude(status="written").select_related("analysis"):
+        by_analysis[item.analysis_id].append(item)
+
+    written = 0
+    synced: Set[Tuple[str, str]] = set()
+    for items in by_analysis.values():
+        if any(i.status in ("pending", "submitted") for i in items):
+            continue
+        analysis = items[0].analysis
+        design_items = [i for i in items if i.kind == "design"]
+        bom_items = [i for i in items if i.kind == "bom"]
+
+        design_meta = design_items[0].result if design_items and design_items[0].status == "done" else None
+        bom_list: Optional[List[Dict[str, Any]]] = None
+        if bom_items and all(i.status == "done" for i in bom_items):
+            bom_list = [entry for i in bom_items for entry in (i.result or [])]
+
+        if design_meta is not None or bom_list is not None:
+            try:
+                updated = update_equipment_in_masterfile(
+                    analysis.workbook_path, analysis.original_filename, design_meta, bom_list
+                )
+                if not updated and design_meta is not None and bom_list is not None:
+                    append_equipment_to_masterfile(
+                        analysis.workbook_path, analysis.original_filename, design_meta, bom_list
+                    )
+                    updated = True
+                if not updated:
+                    print(f"Analysis {analysis.id}: equipment not in its masterfile; nothing to update")
+            except Exception as exc:
+                print(f"Analysis {analysis.id}: masterfile update failed:", exc)
+                continue
+            if analysis.pptx_path:
+                synced.add((analysis.pptx_path, analysis.workbook_path))
+            written += 1
+
+        ReextractItem.objects.filter(pk__in=[i.pk for i in items if i.status == "done"]).update(status="written")
+
+    for pptx_path, workbook_path in synced:
+        try:
+            sync_all_slides_from_masterfile(pptx_rel_path=pptx_path, workbook_rel_path=workbook_path)
+        except Exception as exc:
+            print("PPT sync failed:", exc)
+    return written
+
+
+def finish_if_complete(run: ReextractRun) -> bool:
+    if run.items.filter(status__in=("pending", "submitted", "done")).exists():
+        return False
+    run.status = "done"
+    run.save(update_fields=["status", "updated_at"])
+    return True
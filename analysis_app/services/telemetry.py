@@ -0,0 +1,75 @@
+# analysis_app/services/telemetry.py
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+from ..models import VisionCallLog
+
+# the admin summary reads at most this many of the newest (filtered) rows
+SUMMARY_MAX_ROWS = 20000
+
+
+def telemetry_enabled() -> bool:
+    return bool(getattr(settings, "ANALYSIS_VISION_CALL_LOG", True))
+
+
+def record_vision_call(**fields: Any) -> None:
+    """Store one VisionCallLog row; telemetry problems never fail an extraction."""
+    if not telemetry_enabled():
+        return
+    try:
+        VisionCallLog.objects.create(**fields)
+    except Exception as exc:
+        print("Could not record vision call:", exc)
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """Linear-interpolated q-th percentile (0-100) of values, None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100.0
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def template_summary(queryset=None) -> List[Dict[str, Any]]:
+    """
+    Per equipment template (pmt_no, equipment_no): calls, failure rate,
+    p50/p95 request latency, mean retries and queue time. Slowest p95 first.
+    Percentiles are computed here because MySQL has no percentile aggregate.
+    """
+    qs = VisionCallLog.objects.all() if queryset is None else queryset
+    rows = qs.order_by("-created_at").values_list(
+        "pmt_no", "equipment_no", "latency_ms", "queued_ms", "retries", "outcome"
+    )[:SUMMARY_MAX_ROWS]
+
+    groups: Dict[Tuple[str, str], List[Tuple[int, int, int, str]]] = defaultdict(list)
+    for pmt_no, equipment_no, latency_ms, queued_ms, retries, outcome in rows:
+        groups[(pmt_no, equipment_no)].append((latency_ms, queued_ms, retries, outcome))
+
+    summary: List[Dict[str, Any]] = []
+    for (pmt_no, equipment_no), calls in groups.items():
+        # skipped calls (circuit open) never reached the API; keep them out of the latency figures
+        latencies = [c[0] for c in calls if c[3] != "circuit_open"]
+        failures = sum(1 for c in calls if c[3] not in ("ok", "repaired"))
+        summary.append(
+            {
+                "pmt_no": pmt_no or "-",
+                "equipment_no": equipment_no or "-",
+                "calls": len(calls),
+                "failures": failures,
+                "failure_rate": failures / len(calls),
+                "repaired": sum(1 for c in calls if c[3] == "repaired"),
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+                "avg_retries": sum(c[2] for c in calls) / len(calls),
+                "avg_queued_ms": sum(c[1] for c in calls) / len(calls),
+            }
+        )
+    summary.sort(key=lambda s: (s["p95_ms"] is None, -(s["p95_ms"] or 0)))
+    return summary
@@ -9,12 +9,22 @@ class DesignTemplateRule:
   
     extra_prompt: Optional[str] = None
     force_null_operating: bool = False
+    # False when the table needs the model's judgement (compound cells, column
+    # layouts) and the PDF text-layer parser must not be trusted for it
+    # (this also rules out OCR, which feeds the same parser)
+    text_layer: bool = True
+    # pin one extractor backend ("text_layer", "tesseract", "groq") instead of routing
+    backend: Optional[str] = None
 
 
 @dataclass
 class BomTemplateRule:
  
     extra_prompt: Optional[str] = None
+    text_layer: bool = True
+    # text-layer BOM: row keyword (upper case) -> part_label, checked before the defaults
+    text_layer_part_labels: Optional[Dict[str, str]] = None
+    backend: Optional[str] = None
 
 
 # ---------- DESIGN DATA RULES (ikut file) -----------------
@@ -56,7 +66,8 @@ DESIGN_RULES: Dict[Tuple[str, str], DesignTemplateRule] = {
             "Use the 'FLUID NAME' row as the process fluid and map it to "
             "fluids.shell, fluids.tube and fluids.header.\n"
             "Use the 'INSULATION' row as the source for the 'insulation' field.\n"
-        )
+        ),
+        text_layer=False,
     ),
 
     # ------------------------------------------------------
@@ -101,7 +112,8 @@ DESIGN_RULES: Dict[Tuple[str, str], DesignTemplateRule] = {
             "design.shell and design.tube.\n"
             "BOTTOM CHANNEL in Excel will reuse the tube-side values.\n"
             "Use the INSULATION row as the source for the 'insulation' field.\n"
-        )
+        ),
+        text_layer=False,
     ),
 
     # ------------------------------------------------------
@@ -219,7 +231,8 @@ BOM_RULES: Dict[Tuple[str, str], BomTemplateRule] = {
             "If the material cell contains two materials such as "
             "'SA 240 M 316L/ SA 240 316', use only the main head material "
             "'SA 240 316' as material_raw for the head item."
-        )
+        ),
+        text_layer=False,
     ),
 
     
@@ -229,7 +242,8 @@ BOM_RULES: Dict[Tuple[str, str], BomTemplateRule] = {
             "Create two items from this row: one with part_label='Shell' and one with "
             "part_label='Head', both sharing the same material_raw "
             "(for example 'A/SA 516 Gr 70')."
-        )
+        ),
+        text_layer=False,
     ),
 
     
@@ -241,7 +255,8 @@ BOM_RULES: Dict[Tuple[str, str], BomTemplateRule] = {
             "part_label='Channel'.\n"
             "If the material text looks like 'FE-560-Gr912/789L', keep the full string "
             "as material_raw; the system will split SPEC and GRADE later."
-        )
+        ),
+        text_layer=False,
     ),
 
     
@@ -261,7 +276,8 @@ BOM_RULES: Dict[Tuple[str, str], BomTemplateRule] = {
             "Map HEAD to part_label='Channel', SHELL to part_label='Shell', "
             "and TUBE to part_label='Tube Bundle'.\n"
             "Keep material strings such as 'PQ999-ZR312' as a single material_raw value."
-        )
+        ),
+        text_layer_part_labels={"HEAD": "Channel", "TUBE": "Tube Bundle"},
     ),
 
     # 10108
@@ -270,7 +286,8 @@ BOM_RULES: Dict[Tuple[str, str], BomTemplateRule] = {
             "For MLK PMT 10108 - H-002 the BOM also has HEAD, SHELL and TUBE rows.\n"
             "Again map HEAD→'Channel', SHELL→'Shell', and TUBE→'Tube Bundle'.\n"
             "Keep strings like 'JK981-IO827' as material_raw."
-        )
+        ),
+        text_layer_part_labels={"HEAD": "Channel", "TUBE": "Tube Bundle"},
     ),
 
     # 10109
@@ -279,7 +296,8 @@ BOM_RULES: Dict[Tuple[str, str], BomTemplateRule] = {
             "For MLK PMT 10109 - H-003 map HEAD to part_label='Channel', SHELL to 'Shell' "
             "and TUBE to 'Tube Bundle'.\n"
             "Keep materials such as 'JU923-YT726' as material_raw."
-        )
+        ),
+        text_layer_part_labels={"HEAD": "Channel", "TUBE": "Tube Bundle"},
     ),
 
     # 10110
@@ -289,7 +307,12 @@ BOM_RULES: Dict[Tuple[str, str], BomTemplateRule] = {
             "Map the SHELL row to part_label='Shell', the semi-elliptical head-style row "
             "to part_label='Channel', and the TUBE row to part_label='Tube Bundle'.\n"
             "Material strings like 'ZY-982-GR.212/678K' should be stored whole as material_raw."
-        )
+        ),
+        text_layer_part_labels={
+            "ELLIPTICAL": "Channel",
+            "HEAD": "Channel",
+            "TUBE": "Tube Bundle",
+        },
     ),
 }
 
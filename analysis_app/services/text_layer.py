@@ -0,0 +1,466 @@
+# analysis_app/services/text_layer.py
+from __future__ import annotations
+
+import os
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from statistics import median
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from .template_rules import BomTemplateRule, DesignTemplateRule
+
+
+# Reads DESIGN DATA / BOM tables straight from a vector PDF's text layer so the
+# vision model is only needed for scanned drawings. Output dicts use the same
+# JSON shape the Groq prompts ask for, so ai_extractor normalises both alike.
+
+
+@dataclass(frozen=True)
+class TextRegion:
+    """A RegionSelection box (normalised 0..1, as drawn on the rendered page) in its source PDF."""
+
+    pdf_path: str
+    page_number: int
+    x1: float
+    y1: float
+    x2: float
+    y2: float
+
+
+@dataclass(frozen=True)
+class Word:
+    """A word in display-space points (page as rendered, i.e. after /Rotate), origin top-left."""
+
+    text: str
+    x0: float
+    top: float
+    x1: float
+    bottom: float
+
+    @property
+    def cx(self) -> float:
+        return (self.x0 + self.x1) / 2
+
+    @property
+    def cy(self) -> float:
+        return (self.top + self.bottom) / 2
+
+    @property
+    def height(self) -> float:
+        return self.bottom - self.top
+
+
+def text_layer_enabled() -> bool:
+    return bool(getattr(settings, "ANALYSIS_TEXT_LAYER_ENABLED", True))
+
+
+# --- Page words + spatial index ----------------------------------------------------
+
+
+class WordIndex:
+    """Uniform-grid spatial index over a page's words, for cheap box queries."""
+
+    def __init__(self, words: List[Word], width: float, height: float, cells: int = 48):
+        self.words = words
+        self.width = width or 1.0
+        self.height = height or 1.0
+        self.cells = cells
+        self._grid: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for i, w in enumerate(words):
+            for key in self._cells_for(w.x0, w.top, w.x1, w.bottom):
+                self._grid[key].append(i)
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        cx = min(self.cells - 1, max(0, int(x / self.width * self.cells)))
+        cy = min(self.cells - 1, max(0, int(y / self.height * self.cells)))
+        return cx, cy
+
+    def _cells_for(self, x0: float, top: float, x1: float, bottom: float) -> Iterable[Tuple[int, int]]:
+        c0x, c0y = self._cell(x0, top)
+        c1x, c1y = self._cell(x1, bottom)
+        for gx in range(c0x, c1x + 1):
+            for gy in range(c0y, c1y + 1):
+                yield gx, gy
+
+    def query(self, x0: float, top: float, x1: float, bottom: float) -> List[Word]:
+        """Words whose centre lies inside the box, in reading order."""
+        seen = set()
+        found: List[Word] = []
+        for key in self._cells_for(x0, top, x1, bottom):
+            for i in self._grid.get(key, ()):
+                if i in seen:
+                    continue
+                seen.add(i)
+                w = self.words[i]
+                if x0 <= w.cx <= x1 and top <= w.cy <= bottom:
+                    found.append(w)
+        found.sort(key=lambda w: (round(w.cy, 1), w.x0))
+        return found
+
+    def query_normalized(self, x1: float, y1: float, x2: float, y2: float) -> List[Word]:
+        return self.query(
+            min(x1, x2) * self.width,
+            min(y1, y2) * self.height,
+            max(x1, x2) * self.width,
+            max(y1, y2) * self.height,
+        )
+
+
+@lru_cache(maxsize=16)
+def _load_page_index(pdf_path: str, page_number: int, mtime_ns: int) -> Optional[WordIndex]:
+    import pdfplumber
+
+    # pdfplumber applies /Rotate, so coordinates already match the rendered page image
+    with pdfplumber.open(pdf_path) as pdf:
+        if page_number < 1 or page_number > len(pdf.pages):
+            return None
+        page = pdf.pages[page_number - 1]
+        bx0, btop, bx1, bbottom = page.bbox
+        words = [
+            Word(
+                text=w["text"],
+                x0=w["x0"] - bx0,
+                top=w["top"] - btop,
+                x1=w["x1"] - bx0,
+                bottom=w["bottom"] - btop,
+            )
+            for w in page.extract_words()
+            if w.get("upright", True)
+        ]
+    return WordIndex(words, bx1 - bx0, bbottom - btop)
+
+
+def get_page_index(pdf_path: str, page_number: int) -> Optional[WordIndex]:
+    try:
+        mtime_ns = os.stat(pdf_path).st_mtime_ns
+    except OSError:
+        return None
+    try:
+        return _load_page_index(pdf_path, page_number, mtime_ns)
+    except Exception as exc:
+        print("Text layer read failed:", exc)
+        return None
+
+
+def region_words(region: TextRegion) -> List[Word]:
+    index = get_page_index(region.pdf_path, region.page_number)
+    if index is None:
+        return []
+    return index.query_normalized(region.x1, region.y1, region.x2, region.y2)
+
+
+# --- Table reconstruction ----------------------------------------------------------
+
+
+def group_rows(words: List[Word]) -> List[List[Word]]:
+    if not words:
+        return []
+    tol = median(w.height for w in words) * 0.6
+    rows: List[List[Word]] = []
+    for w in sorted(words, key=lambda w: w.cy):
+        if rows and abs(w.cy - sum(x.cy for x in rows[-1]) / len(rows[-1])) <= tol:
+            rows[-1].append(w)
+        else:
+            rows.append([w])
+    for row in rows:
+        row.sort(key=lambda w: w.x0)
+    return rows
+
+
+def _cells(row: List[Word]) -> List[List[Word]]:
+    if not row:
+        return []
+    gap_limit = median(w.height for w in row) * 1.5
+    cells: List[List[Word]] = [[row[0]]]
+    for w in row[1:]:
+        if w.x0 - cells[-1][-1].x1 > gap_limit:
+            cells.append([w])
+        else:
+            cells[-1].append(w)
+    return cells
+
+
+def row_cells(row: List[Word]) -> List[Tuple[str, float]]:
+    """Merge a row's words into cells on wide horizontal gaps; returns (text, centre x)."""
+    return [
+        (" ".join(w.text for w in cell), (cell[0].x0 + cell[-1].x1) / 2)
+        for cell in _cells(row)
+    ]
+
+
+# --- DESIGN DATA -------------------------------------------------------------------
+
+
+_NUMBER_RE = re.compile(r"[-+]?\d+(?:[.,]\d+)?")
+
+_PRESSURE_FACTORS = [
+    (re.compile(r"KG\s*/?\s*CM"), 0.0980665),
+    (re.compile(r"KPA"), 0.001),
+    (re.compile(r"\bBAR"), 0.1),
+    (re.compile(r"PSI"), 0.00689476),
+    (re.compile(r"MPA"), 1.0),
+]
+
+
+def _first_number(text: str) -> Optional[float]:
+    m = _NUMBER_RE.search(text or "")
+    if not m:
+        return None
+    try:
+        return float(m.group(0).replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _pressure_mpa(value_text: str, unit_hint: str) -> Optional[float]:
+    value = _first_number(value_text)
+    if value is None:
+        return None
+    unit = f"{value_text} {unit_hint}".upper()
+    for pattern, factor in _PRESSURE_FACTORS:
+        if pattern.search(unit):
+            return round(value * factor, 4)
+    return value
+
+
+def _temperature_c(value_text: str, unit_hint: str) -> Optional[float]:
+    value = _first_number(value_text)
+    if value is None:
+        return None
+    unit = f"{value_text} {unit_hint}".upper()
+    if re.search(r"°\s*F|\bDEG\.?\s*F\b|\(F\)", unit):
+        return round((value - 32) * 5 / 9, 1)
+    return value
+
+
+def _side_columns(rows: List[List[Word]]) -> Tuple[Dict[str, float], float]:
+    """
+    Centre x of the SHELL / TUBE header columns (if the table has a side
+    split) and the x where those columns begin; row labels sit left of it.
+    """
+    for row in rows:
+        cols: Dict[str, float] = {}
+        starts: List[float] = []
+        for cell in _cells(row):
+            text = " ".join(w.text for w in cell).upper()
+            if "SHELL" in text and "shell" not in cols:
+                cols["shell"] = (cell[0].x0 + cell[-1].x1) / 2
+                starts.append(cell[0].x0)
+            elif any(k in text for k in ("TUBE", "CHANNEL")) and "tube" not in cols:
+                cols["tube"] = (cell[0].x0 + cell[-1].x1) / 2
+                starts.append(cell[0].x0)
+        if len(cols) == 2:
+            return cols, min(starts) - median(w.height for w in row) * 0.5
+    return {}, 0.0
+
+
+def _label_and_values(
+    row: List[Word], columns: Dict[str, float], boundary: float
+) -> Tuple[str, Dict[str, str]]:
+    if not columns:
+        cells = row_cells(row)
+        if len(cells) < 2:
+            return (cells[0][0] if cells else ""), {}
+        value = " ".join(t for t, _ in cells[1:])
+        return cells[0][0], {"shell": value, "tube": value}
+
+    label = " ".join(w.text for w in row if w.x1 <= boundary)
+    by_side: Dict[str, List[str]] = {}
+    for w in row:
+        if w.x1 <= boundary:
+            continue
+        side = min(columns, key=lambda s: abs(columns[s] - w.cx))
+        by_side.setdefault(side, []).append(w.text)
+    return label, {side: " ".join(texts) for side, texts in by_side.items()}
+
+
+# pressure/temperature rows that are neither the design nor the operating value:
+# hydrotest pressure, MAWP, minimum design metal temperature (MDMT)
+_OTHER_CONDITION_RE = re.compile(r"\b(?:TEST|HYDRO\w*|ALLOWABLE|MAWP|MDMT|MIN|MINIMUM|METAL)\b")
+
+
+def design_data_from_words(words: List[Word]) -> Optional[Dict[str, Any]]:
+    """
+    DESIGN DATA table in the vision answer's shape, or None when the design
+    pressure and temperature cannot be read with confidence (the region then
+    goes to the vision model). Unlabelled PRESSURE / TEMPERATURE rows are
+    only taken as an operating + design pair, and only when no labelled row
+    of that kind exists.
+    """
+    rows = group_rows(words)
+    if not rows:
+        return None
+
+    columns, boundary = _side_columns(rows)
+    data: Dict[str, Any] = {
+        "fluids": {"shell": None, "tube": None, "header": None},
+        "insulation": None,
+        "design": {"shell": {}, "tube": {}},
+        "operating": {"shell": {}, "tube": {}},
+    }
+    radiography_text: Optional[str] = None
+    # (kind, block or None when unlabelled, label, values) in table order
+    conditions: List[Tuple[str, Optional[str], str, Dict[str, str]]] = []
+
+    for row in rows:
+        label, values = _label_and_values(row, columns, boundary)
+        label = label.upper()
+        if not label or not values:
+            continue
+        any_value = values.get("shell") or values.get("tube")
+
+        if any(k in label for k in ("FLUID", "MEDIUM", "SERVICE")):
+            data["fluids"]["shell"] = values.get("shell") or any_value
+            data["fluids"]["tube"] = values.get("tube") or any_value
+            data["fluids"]["header"] = data["fluids"]["tube"]
+            continue
+
+        if "INSULATION" in label or label.startswith("DEGREE OF"):
+            data["insulation"] = any_value
+            continue
+
+        if "RADIOGRAPH" in label:
+            radiography_text = any_value
+            continue
+
+        if "PRESS" in label:
+            kind = "pressure"
+        elif "TEMP" in label:
+            kind = "temperature"
+        else:
+            continue
+        if _OTHER_CONDITION_RE.search(label):
+            continue
+
+        if "DESIGN" in label:
+            block: Optional[str] = "design"
+        elif any(k in label for k in ("OPERAT", "WORKING", "WKG")):
+            block = "operating"
+        else:
+            block = None
+        conditions.append((kind, block, label, values))
+
+    for kind in ("pressure", "temperature"):
+        labelled = [c for c in conditions if c[0] == kind and c[1] is not None]
+        unlabelled = [c for c in conditions if c[0] == kind and c[1] is None]
+        if not unlabelled:
+            continue
+        # tables that repeat a bare PRESSURE / TEMPERATURE row list operating first,
+        # then design; anything else can't be told apart here
+        if labelled or len(unlabelled) != 2:
+            return None
+        for block, (_, _, label, values) in zip(("operating", "design"), unlabelled):
+            labelled.append((kind, block, label, values))
+        conditions = [c for c in conditions if c[0] != kind] + labelled
+
+    for kind, block, label, values in conditions:
+        key = "pressure_mpa" if kind == "pressure" else "temp_c"
+        for side, text in values.items():
+            if kind == "pressure":
+                parsed = _pressure_mpa(text, label)
+            else:
+                parsed = _temperature_c(text, label)
+            if parsed is not None:
+                data[block][side].setdefault(key, parsed)
+
+    if data["insulation"] is None and radiography_text:
+        data["insulation"] = radiography_text
+
+    design = data["design"]
+    has_pressure = any("pressure_mpa" in design[s] for s in ("shell", "tube"))
+    has_temp = any("temp_c" in design[s] for s in ("shell", "tube"))
+    if not (has_pressure and has_temp):
+        return None
+    return data
+
+
+# --- BILL OF MATERIAL --------------------------------------------------------------
+
+
+# longest first so "BOTTOM HEAD" wins over "HEAD"
+_DEFAULT_PART_LABELS: List[Tuple[str, str]] = [
+    ("TUBE BUNDLE", "Tube Bundle"),
+    ("BOTTOM HEAD", "Bottom Head"),
+    ("DISHED END", "Head"),
+    ("CHANNEL", "Channel"),
+    ("SHELL", "Shell"),
+    ("HEAD", "Head"),
+    ("TUBE", "Tube Bundle"),
+]
+
+_IGNORED_PARTS = ("BOLT", "NUT", "GASKET", "STUD", "WASHER", "NAME PLATE", "NAMEPLATE", "LIFTING")
+
+_MATERIAL_RE = re.compile(r"^(?:[A-Z]{1,3}/)?[A-Z]{1,4}[- .]?\d{2,4}")
+
+_TUBE_SIDE_LABELS = {"Channel", "Tube Bundle"}
+
+
+def _part_label(text: str, overrides: Dict[str, str]) -> Optional[str]:
+    t = " ".join(text.upper().split())
+    if any(k in t for k in _IGNORED_PARTS):
+        return None
+    for key, label in sorted(overrides.items(), key=lambda kv: -len(kv[0])):
+        if key.upper() in t:
+            return label
+    for key, label in _DEFAULT_PART_LABELS:
+        if key in t:
+            return label
+    return None
+
+
+def bom_data_from_words(
+    words: List[Word], rule: Optional[BomTemplateRule] = None
+) -> Optional[Dict[str, Any]]:
+    overrides = dict(rule.text_layer_part_labels) if rule and rule.text_layer_part_labels else {}
+    items: List[Dict[str, Any]] = []
+    seen = set()
+
+    for row in group_rows(words):
+        cells = [text for text, _ in row_cells(row)]
+        label = None
+        material = None
+        for text in cells:
+            upper = text.upper().strip()
+            if material is None and _MATERIAL_RE.match(upper) and not _part_label(upper, {}):
+                material = text.strip()
+            elif label is None:
+                label = _part_label(text, overrides)
+        if not label or not material or (label, material) in seen:
+            continue
+        seen.add((label, material))
+        items.append(
+            {
+                "part_label": label,
+                "material_raw": material,
+                "side": "tube" if label in _TUBE_SIDE_LABELS else "shell",
+            }
+        )
+
+    if not items:
+        return None
+    return {"items": items}
+
+
+# --- Entry points used by ai_extractor ---------------------------------------------
+
+
+def design_data_from_text_layer(
+    region: TextRegion, rule: Optional[DesignTemplateRule] = None
+) -> Optional[Dict[str, Any]]:
+    """Design table read from the PDF text, or None when absent/incomplete (caller falls back to vision)."""
+    if not text_layer_enabled() or (rule and not rule.text_layer):
+        return None
+    return design_data_from_words(region_words(region))
+
+
+def bom_data_from_text_layer(
+    region: TextRegion, rule: Optional[BomTemplateRule] = None
+) -> Optional[Dict[str, Any]]:
+    """BOM items read from the PDF text, or None when absent/incomplete (caller falls back to vision)."""
+    if not text_layer_enabled() or (rule and not rule.text_layer):
+        return None
+    return bom_data_from_words(region_words(region), rule)
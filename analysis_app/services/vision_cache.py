@@ -0,0 +1,143 @@
+# analysis_app/services/vision_cache.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+
+_evict_lock = threading.Lock()
+
+# Running size of the cache as this process sees it, so a write only walks the
+# directory when the budget is passed. Other processes' writes are picked up by a
+# full rescan every RESCAN_AFTER_WRITES writes.
+RESCAN_AFTER_WRITES = 200
+_size_lock = threading.Lock()
+_size: Dict[str, Any] = {"dir": None, "bytes": None, "writes": 0}
+
+
+def cache_enabled() -> bool:
+    return bool(getattr(settings, "ANALYSIS_VISION_CACHE_ENABLED", True))
+
+
+def _cache_dir() -> Path:
+    default = Path(settings.BASE_DIR) / "cache" / "vision"
+    return Path(getattr(settings, "ANALYSIS_VISION_CACHE_DIR", default))
+
+
+def _max_bytes() -> int:
+    return int(getattr(settings, "ANALYSIS_VISION_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+
+
+def vision_cache_key(
+    image_bytes: bytes,
+    instruction: str,
+    model: str,
+    temperature: float,
+    variant: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Key for one vision call. `variant` holds anything else that changes what
+    is sent (e.g. the preprocessing config) so a tuning change is a miss.
+    """
+    h = hashlib.sha256()
+    h.update(hashlib.sha256(image_bytes).digest())
+    h.update(hashlib.sha256(instruction.encode("utf-8")).digest())
+    h.update(model.encode("utf-8"))
+    h.update(repr(float(temperature)).encode("ascii"))
+    if variant:
+        h.update(json.dumps(variant, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _path(key: str) -> Path:
+    return _cache_dir() / key[:2] / f"{key}.json"
+
+
+def cache_get(key: str) -> Optional[Any]:
+    path = _path(key)
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Vision cache entry {key[:12]} unreadable, ignoring: {e}")
+        return None
+    try:
+        # mtime is the recency used by eviction
+        os.utime(path)
+    except OSError:
+        pass
+    return data
+
+
+def _needs_eviction(added: int) -> bool:
+    """Add a write to the running size; True when the directory should be walked."""
+    root = str(_cache_dir())
+    with _size_lock:
+        if _size["dir"] != root or _size["bytes"] is None or _size["writes"] >= RESCAN_AFTER_WRITES:
+            return True
+        _size["bytes"] += added
+        _size["writes"] += 1
+        return _size["bytes"] > _max_bytes()
+
+
+def cache_put(key: str, value: Any) -> None:
+    path = _path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        replaced = path.stat().st_size
+    except OSError:
+        replaced = 0
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False)
+    written = tmp.stat().st_size
+    os.replace(tmp, path)
+    if _needs_eviction(written - replaced):
+        evict_to_budget()
+
+
+def evict_to_budget(max_bytes: Optional[int] = None) -> int:
+    """
+    Delete least recently used entries until the cache fits. Walks the whole
+    cache; cache_put only calls it when the running size passes the budget.
+    Returns files removed.
+    """
+    max_bytes = _max_bytes() if max_bytes is None else max_bytes
+    root = _cache_dir()
+    if not root.is_dir():
+        return 0
+
+    with _evict_lock:
+        entries = []
+        total = 0
+        for sub in os.scandir(root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.is_file() and entry.name.endswith(".json"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        removed = 0
+        if total > max_bytes:
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+                if total <= max_bytes:
+                    break
+
+        with _size_lock:
+            _size.update({"dir": str(root), "bytes": total, "writes": 0})
+    return removed
@@ -0,0 +1,237 @@
+# analysis_app/services/vision_schema.py
+from __future__ import annotations
+
+import json
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# Leaf types: "str" = string or null, "num" = number, numeric string or null.
+# A dict spec lists exactly the allowed keys; a one-element list spec is "list of".
+_SIDE = {"temp_c": "num", "pressure_mpa": "num"}
+
+DESIGN_SCHEMA: Dict[str, Any] = {
+    "fluids": {"shell": "str", "tube": "str", "header": "str"},
+    "insulation": "str",
+    "design": {"shell": _SIDE, "tube": _SIDE},
+    "operating": {"shell": _SIDE, "tube": _SIDE},
+}
+
+BOM_SCHEMA: Dict[str, Any] = {
+    "items": [{"part_label": "str", "material_raw": "str", "side": "str"}],
+}
+
+
+def combined_schema(include_design: bool, bom_count: int) -> Dict[str, Any]:
+    schema: Dict[str, Any] = {}
+    if include_design:
+        schema["design"] = DESIGN_SCHEMA
+    if bom_count:
+        schema["bom_tables"] = [BOM_SCHEMA]
+        # a single table sometimes comes back flattened to the top level
+        schema["items"] = BOM_SCHEMA["items"]
+    return schema
+
+
+_NUMBER = re.compile(r"^\s*[-+]?[0-9]*[.,]?[0-9]+")
+
+
+def _check(value: Any, spec: Any, path: str, problems: List[str]) -> Any:
+    """Return `value` shaped to `spec`; every change is appended to `problems`."""
+    if isinstance(spec, dict):
+        if not isinstance(value, dict):
+            if value is not None:
+                problems.append(f"{path or '$'}: expected object, got {type(value).__name__}")
+            value = {}
+        for key in value:
+            if key not in spec:
+                problems.append(f"{path}.{key}: unexpected key dropped" if path else f"{key}: unexpected key dropped")
+        return {k: _check(value.get(k), s, f"{path}.{k}" if path else k, problems) for k, s in spec.items()}
+
+    if isinstance(spec, list):
+        if isinstance(value, dict):
+            problems.append(f"{path}: expected list, wrapped single object")
+            value = [value]
+        elif not isinstance(value, list):
+            if value is not None:
+                problems.append(f"{path}: expected list, got {type(value).__name__}")
+            return []
+        out = []
+        for i, item in enumerate(value):
+            if isinstance(spec[0], dict) and not isinstance(item, dict):
+                problems.append(f"{path}[{i}]: expected object, item dropped")
+                continue
+            out.append(_check(item, spec[0], f"{path}[{i}]", problems))
+        return out
+
+    if value is None:
+        return None
+    if spec == "num":
+        if isinstance(value, bool):
+            problems.append(f"{path}: boolean is not a number, set to null")
+            return None
+        if isinstance(value, (int, float)) or (isinstance(value, str) and _NUMBER.match(value)):
+            return value  # numeric strings ("1.5 MPa") are converted later by _to_float_maybe
+        if isinstance(value, str) and not value.strip():
+            return None
+        problems.append(f"{path}: {value!r} is not a number, set to null")
+        return None
+    # "str"
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    problems.append(f"{path}: expected string, got {type(value).__name__}, set to null")
+    return None
+
+
+def validate(data: Any, schema: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Check a parsed model answer against `schema`. Returns the data with
+    unknown keys dropped, missing keys set to null and wrongly typed leaves
+    nulled, plus a list of the problems fixed (empty = valid as sent; missing
+    keys alone do not count, the model may leave out null fields).
+    """
+    problems: List[str] = []
+    return _check(data, schema, "", problems), problems
+
+
+# ---- local JSON repair ----
+
+_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+_PY_LITERALS = {"None": "null", "True": "true", "False": "false"}
+
+
+def _outside_strings(text: str, fn) -> str:
+    # apply fn to the parts of text that are not inside JSON strings
+    parts = re.split(r'("(?:[^"\\]|\\.)*")', text)
+    return "".join(p if i % 2 else fn(p) for i, p in enumerate(parts))
+
+
+def _close_truncated(text: str) -> Optional[str]:
+    """
+    Cut a truncated document back to the last complete value and close the
+    open arrays/objects, e.g. '{"items": [{"a": 1}, {"a' -> '{"items": [{"a": 1}]}'.
+    """
+    stack: List[str] = []
+    cuts: List[Tuple[int, str]] = []  # (end index, closers needed there)
+    in_string = escape = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            cuts.append((i + 1, "".join(reversed(stack))))
+            if not stack:
+                return text[: i + 1]
+        elif ch == "," and stack:
+            cuts.append((i, "".join(reversed(stack))))
+
+    for end, closers in reversed(cuts):
+        candidate = text[:end] + closers
+        try:
+            json.loads(candidate)
+            return candidate
+        except ValueError:
+            continue
+    return None
+
+
+def repair_json(text: str) -> Tuple[Optional[Any], List[str]]:
+    """
+    Parse a model answer that should be one JSON object. Returns the value
+    (None if nothing could be recovered) and the repairs applied, empty when
+    the text parsed as it was.
+    """
+    repairs: List[str] = []
+    if not text or not text.strip():
+        return None, ["empty response"]
+
+    stripped = _FENCE.sub("", text.strip())
+    if stripped != text.strip():
+        repairs.append("markdown fence removed")
+
+    start = stripped.find("{")
+    if start == -1:
+        return None, repairs + ["no JSON object in response"]
+    if stripped[:start].strip():
+        repairs.append("leading text removed")
+    candidate = stripped[start:]
+
+    decoder = json.JSONDecoder()
+    try:
+        value, end = decoder.raw_decode(candidate)
+        if candidate[end:].strip():
+            repairs.append("trailing text removed")
+        return value, repairs
+    except ValueError:
+        pass
+
+    fixed = _outside_strings(candidate, lambda p: _TRAILING_COMMA.sub(r"\1", p))
+    if fixed != candidate:
+        repairs.append("trailing commas removed")
+    literals = _outside_strings(
+        fixed, lambda p: re.sub(r"\b(None|True|False)\b", lambda m: _PY_LITERALS[m.group(1)], p)
+    )
+    if literals != fixed:
+        repairs.append("Python literals converted")
+    fixed = literals
+
+    try:
+        value, end = decoder.raw_decode(fixed)
+        if fixed[end:].strip():
+            repairs.append("trailing text removed")
+        return value, repairs
+    except ValueError:
+        pass
+
+    closed = _close_truncated(fixed)
+    if closed is not None:
+        try:
+            value = json.loads(closed)
+            return value, repairs + ["truncated JSON closed"]
+        except ValueError:
+            pass
+    return None, repairs + ["unparseable JSON"]
+
+
+# ---- per-process outcome counters ----
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {"calls": 0, "clean": 0, "repaired": 0, "failed": 0}
+
+
+def record_parse(outcome: str) -> None:
+    """outcome: "clean" (valid as sent), "repaired" or "failed"."""
+    with _stats_lock:
+        _stats["calls"] += 1
+        _stats[outcome] += 1
+
+
+def parse_stats() -> Dict[str, float]:
+    """Parse outcome counters for this process since start (or the last reset)."""
+    with _stats_lock:
+        stats = dict(_stats)
+    calls = stats["calls"]
+    stats["repair_rate"] = round(stats["repaired"] / calls, 3) if calls else 0.0
+    stats["failure_rate"] = round(stats["failed"] / calls, 3) if calls else 0.0
+    return stats
+
+
+def reset_parse_stats() -> None:
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
@@ -1,3 +1,1477 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import jwt
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .models import (
+    Analysis,
+    AnalysisPage,
+    ExternalUser,
+    ExtractorBackendStat,
+    RasterJob,
+    RegionSelection,
+    UploadBatch,
+    VisionCallLog,
+)
+from . import views
+from .services import (
+    ai_extractor,
+    backends,
+    cropper,
+    extraction,
+    generate,
+    groq_scheduler,
+    groq_standin,
+    media_gc,
+    preprocess,
+    raster_queue,
+    rasterizer,
+    reextract,
+    telemetry,
+    vision_cache,
+)
+from .services.dedupe import create_linked_analysis, find_processed_duplicate
+from .services.rasterizer import iter_render_pages
+from .services.text_layer import Word, WordIndex, bom_data_from_words, design_data_from_words
+from .services.vision_schema import BOM_SCHEMA, DESIGN_SCHEMA, repair_json, validate
+
+
+PAGE_BYTES = 4 * 1024 * 1024
+
+
+class _FakePage:
+    """Stands in for a decoded PIL page; its buffer is visible to tracemalloc."""
+
+    def __init__(self):
+        self.buffer = bytearray(PAGE_BYTES)
+
+    def save(self, path, fmt=None):
+        with open(path, "wb") as f:
+            f.write(b"page")
+
+    def close(self):
+        self.buffer = None
+
+
+def _fake_convert_from_path(pdf_path, dpi, first_page, last_page, poppler_path, grayscale=False):
+    return [_FakePage() for _ in range(first_page, last_page + 1)]
+
+
+class StreamingRasterizationTests(SimpleTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+
+    def _peak_bytes(self, page_count, batch_size):
+        with override_settings(MEDIA_ROOT=self.media_root, ANALYSIS_PAGE_FORMAT="png"), mock.patch(
+            "pdf2image.convert_from_path", _fake_convert_from_path
+        ):
+            tracemalloc.start()
+            try:
+                rendered = list(
+                    iter_render_pages("drawing.pdf", 1, 1, page_count, batch_size=batch_size)
+                )
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        self.assertEqual([n for n, _ in rendered], list(range(1, page_count + 1)))
+        return peak
+
+    def test_peak_memory_is_one_page_regardless_of_page_count(self):
+        peak = self._peak_bytes(page_count=40, batch_size=1)
+        self.assertLess(peak, 2 * PAGE_BYTES)
+
+    def test_peak_memory_is_bounded_by_batch_size(self):
+        peak = self._peak_bytes(page_count=40, batch_size=3)
+        self.assertLess(peak, 4 * PAGE_BYTES)
+
+    def test_peak_memory_does_not_grow_with_page_count(self):
+        small = self._peak_bytes(page_count=2, batch_size=1)
+        large = self._peak_bytes(page_count=40, batch_size=1)
+        self.assertLess(large, small + PAGE_BYTES // 2)
+
+
+class ParallelRasterizationTests(SimpleTestCase):
+    def test_page_range_is_split_into_contiguous_ordered_chunks(self):
+        self.assertEqual(rasterizer.split_page_range(1, 10, 4), [(1, 3), (4, 6), (7, 9), (10, 10)])
+        self.assertEqual(rasterizer.split_page_range(5, 6, 8), [(5, 5), (6, 6)])
+        self.assertEqual(rasterizer.split_page_range(3, 2, 4), [])
+
+    def test_every_page_is_rendered_once_across_the_pool(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        # threads stand in for the process pool; the chunking and collection are the same
+        with override_settings(MEDIA_ROOT=media_root, ANALYSIS_PAGE_FORMAT="png"), mock.patch(
+            "pdf2image.convert_from_path", _fake_convert_from_path
+        ), mock.patch.object(rasterizer, "ProcessPoolExecutor", ThreadPoolExecutor):
+            rendered = list(rasterizer.iter_render_pages_parallel("drawing.pdf", 7, 1, 9, processes=3))
+
+        self.assertEqual(sorted(n for n, _ in rendered), list(range(1, 10)))
+        self.assertEqual(dict(rendered)[4], "analysis/pages/analysis_7_p4.png")
+
+
+def _drawing(mode="RGB"):
+    """White sheet with black linework and a light grey hatch, like a scanned drawing."""
+    img = Image.new(mode, (60, 40), "white")
+    for x in range(5, 55):
+        img.putpixel((x, 10), (0, 0, 0) if mode == "RGB" else 0)
+    for x in range(5, 55, 2):
+        img.putpixel((x, 30), (200, 200, 200) if mode == "RGB" else 200)
+    return img
+
+
+class PageFormatTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+
+    def _saved(self, fmt):
+        path = Path(self.media_root) / f"page.{rasterizer.PAGE_FORMATS[fmt][0]}"
+        rasterizer.save_page_image(_drawing(), path, fmt)
+        return Image.open(path)
+
+    def test_each_format_stores_its_pixel_mode(self):
+        with self._saved("png-gray") as img:
+            self.assertEqual(img.mode, "L")
+            self.assertEqual(img.getpixel((31, 30)), 200)
+        with self._saved("png-1bit") as img:
+            self.assertEqual(img.mode, "1")
+            # the light hatch is above the threshold and becomes paper
+            self.assertEqual((img.getpixel((30, 10)), img.getpixel((31, 30))), (0, 255))
+        with self._saved("png-palette") as img:
+            self.assertEqual(img.mode, "P")
+            self.assertLessEqual(len(img.getcolors()), 16)
+        with self._saved("webp") as img:
+            self.assertEqual(list(img.convert("RGB").getdata()), list(_drawing().getdata()))
+
+    def test_unknown_format_is_rejected(self):
+        with override_settings(ANALYSIS_PAGE_FORMAT="jpeg"), self.assertRaises(ValueError):
+            rasterizer.page_format()
+        self.assertEqual(rasterizer.page_image_rel_path(3, 2, "webp"), "analysis/pages/analysis_3_p2.webp")
+
+    def test_convert_command_rewrites_each_shared_file_once(self):
+        name = "analysis/pages/analysis_1_p1.png"
+        (Path(self.media_root) / "analysis/pages").mkdir(parents=True)
+        _drawing().save(Path(self.media_root) / name)
+        for n in (1, 2):
+            analysis = Analysis.objects.create(file="analysis/pdf/a.pdf", original_filename=f"{n}.pdf")
+            AnalysisPage.objects.create(analysis=analysis, page_number=1, image=name)
+
+        with override_settings(MEDIA_ROOT=self.media_root):
+            call_command("convert_page_images", "--format", "png-gray", "--dry-run", stdout=mock.Mock())
+            self.assertEqual(set(AnalysisPage.objects.values_list("image", flat=True)), {name})
+            call_command("convert_page_images", "--format", "webp", stdout=mock.Mock())
+
+        webp = "analysis/pages/analysis_1_p1.webp"
+        self.assertEqual(set(AnalysisPage.objects.values_list("image", flat=True)), {webp})
+        self.assertEqual(sorted(os.listdir(Path(self.media_root) / "analysis/pages")), ["analysis_1_p1.webp"])
+
+
+def _fake_render_pages(pdf_path, analysis_id, first_page=1, last_page=None):
+    return [f"analysis/pages/{analysis_id}_page_{n}.png" for n in range(first_page, last_page + 1)]
+
+
+@override_settings(RASTER_JOB_MAX_ATTEMPTS=2, RASTER_JOB_STALE_AFTER=60)
+class RasterQueueTests(TestCase):
+    def setUp(self):
+        self.analysis = Analysis.objects.create(
+            file="analysis/pdf/drawing.pdf", original_filename="drawing.pdf", status="pending"
+        )
+        self.job = RasterJob.objects.create(analysis=self.analysis)
+
+    def _claim(self):
+        return raster_queue.claim_next_job("host:1")
+
+    def _age(self, job, seconds):
+        RasterJob.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(seconds=seconds))
+
+    def _run(self, job, pages, page_count=3):
+        with mock.patch.object(raster_queue, "get_page_count", return_value=page_count), mock.patch.object(
+            raster_queue, "render_pages", _fake_render_pages
+        ), mock.patch.object(raster_queue, "iter_render_pages_parallel", pages):
+            raster_queue.run_job(job)
+
+    def test_heartbeat_keeps_a_long_running_job_claimed(self):
+        job = self._claim()
+        self._age(job, 120)
+        self.assertTrue(raster_queue.heartbeat(job))
+        self.assertEqual(raster_queue.requeue_stale_jobs(), 0)
+        self.assertEqual(RasterJob.objects.get(pk=job.pk).status, "running")
+
+    def test_stale_job_is_requeued_then_failed_at_max_attempts(self):
+        job = self._claim()
+        self._age(job, 120)
+        self.assertEqual(raster_queue.requeue_stale_jobs(), 1)
+        self.assertEqual(RasterJob.objects.get(pk=job.pk).status, "queued")
+
+        job = self._claim()
+        self.assertEqual(job.attempts, 2)
+        self._age(job, 120)
+        self.assertEqual(raster_queue.requeue_stale_jobs(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.analysis.refresh_from_db()
+        self.assertEqual(self.analysis.status, "failed")
+
+    def test_worker_stops_when_its_job_was_taken_over(self):
+        job = self._claim()
+        seen = []
+
+        def pages(pdf_path, analysis_id, first, last):
+            for n in range(first, last + 1):
+                seen.append(n)
+                # another worker requeued and claimed the job meanwhile
+                RasterJob.objects.filter(pk=job.pk).update(worker_id="host:2")
+                yield n, f"analysis/pages/{n}.png"
+
+        self._run(job, pages, page_count=5)
+        self.assertEqual(seen, [2])
+        self.assertEqual(RasterJob.objects.get(pk=job.pk).status, "running")
+
+    def test_failure_after_first_page_keeps_the_analysis_usable(self):
+        def pages(pdf_path, analysis_id, first, last):
+            raise RuntimeError("poppler crashed")
+            yield  # pragma: no cover
+
+        job = self._claim()
+        self._run(job, pages)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "queued")
+
+        job = self._claim()
+        self._run(job, pages)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.analysis.refresh_from_db()
+        self.assertEqual(self.analysis.status, "awaiting_regions")
+        self.assertEqual(list(self.analysis.pages.values_list("page_number", flat=True)), [1])
+
+    def test_retry_renders_only_missing_pages(self):
+        AnalysisPage.objects.create(analysis=self.analysis, page_number=1, image="analysis/pages/1.png")
+        AnalysisPage.objects.create(analysis=self.analysis, page_number=2, image="analysis/pages/2.png")
+        calls = []
+
+        def pages(pdf_path, analysis_id, first, last):
+            calls.append((first, last))
+            return iter((n, f"analysis/pages/{n}.png") for n in range(first, last + 1))
+
+        job = self._claim()
+        self._run(job, pages, page_count=4)
+        self.assertEqual(calls, [(3, 4)])
+        self.assertEqual(RasterJob.objects.get(pk=job.pk).status, "done")
+        self.assertEqual(self.analysis.pages.count(), 4)
+
+    def test_retry_renders_each_gap_separately(self):
+        for n in (1, 2, 5, 6):
+            AnalysisPage.objects.create(analysis=self.analysis, page_number=n, image=f"analysis/pages/{n}.png")
+        calls = []
+
+        def pages(pdf_path, analysis_id, first, last):
+            calls.append((first, last))
+            return iter((n, f"analysis/pages/{n}.png") for n in range(first, last + 1))
+
+        job = self._claim()
+        self._run(job, pages, page_count=8)
+        self.assertEqual(calls, [(3, 4), (7, 8)])
+        self.assertEqual(self.analysis.pages.count(), 8)
+
+
+class DedupeTests(TestCase):
+    def setUp(self):
+        self.alice = ExternalUser.objects.create(external_id="1", staff_id="A1")
+        self.bob = ExternalUser.objects.create(external_id="2", staff_id="B2")
+        self.source = Analysis.objects.create(
+            file="analysis/pdf/drawing.pdf",
+            file_sha256="ab" * 32,
+            original_filename="MLK PMT 10101 - V-001.pdf",
+            page_count=1,
+            created_by=self.alice,
+        )
+        page = AnalysisPage.objects.create(analysis=self.source, page_number=1, image="analysis/pages/1.png")
+        RegionSelection.objects.create(
+            analysis=self.source, page=page, step_type="design_data", x1=0, y1=0, x2=10, y2=10
+        )
+
+    def test_duplicate_is_found_for_the_same_user_only(self):
+        self.assertEqual(find_processed_duplicate("ab" * 32, self.alice), self.source)
+        self.assertIsNone(find_processed_duplicate("ab" * 32, self.bob))
+        self.assertIsNone(find_processed_duplicate("ab" * 32, None))
+
+    def test_linked_analysis_shares_pages_and_copies_own_regions(self):
+        linked = create_linked_analysis(self.source, self.alice, "copy.pdf", inherit_regions=True)
+        self.assertEqual(linked.file.name, self.source.file.name)
+        self.assertEqual(list(linked.pages.values_list("image", flat=True)), ["analysis/pages/1.png"])
+        self.assertEqual(linked.regions.count(), 1)
+
+    def test_regions_are_never_copied_from_another_user(self):
+        linked = create_linked_analysis(self.source, self.bob, "copy.pdf", inherit_regions=True)
+        self.assertEqual(linked.regions.count(), 0)
+
+
+TEST_JWT_SECRET = "test-secret-for-session-tokens-0123456789"
+
+
+def _log_in(client, external_id):
+    """Give the test client the session token rbi_login_required expects."""
+    session = client.session
+    session["api_token"] = jwt.encode({"id": external_id}, TEST_JWT_SECRET, algorithm="HS256")
+    session.save()
+
+
+@override_settings(JWT_SECRET=TEST_JWT_SECRET, JWT_ALGORITHM="HS256")
+class BatchAccessTests(TestCase):
+    def setUp(self):
+        owner = ExternalUser.objects.create(external_id="1")
+        self.batch = UploadBatch.objects.create(created_by=owner)
+        Analysis.objects.create(
+            file="analysis/pdf/a.pdf", original_filename="MLK PMT 10101 - V-001.pdf", batch=self.batch
+        )
+
+    def test_owner_sees_batch_status(self):
+        _log_in(self.client, "1")
+        response = self.client.get(reverse("analysis_app:batch_status", args=[self.batch.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "MLK PMT 10101 - V-001.pdf")
+
+    def test_other_user_gets_404(self):
+        _log_in(self.client, "2")
+        for name in ("batch_status", "batch_progress"):
+            response = self.client.get(reverse(f"analysis_app:{name}", args=[self.batch.id]))
+            self.assertEqual(response.status_code, 404)
+
+
+@override_settings(JWT_SECRET=TEST_JWT_SECRET, JWT_ALGORITHM="HS256")
+class LazyPageTests(TestCase):
+    def setUp(self):
+        ExternalUser.objects.create(external_id="1")
+        self.analysis = Analysis.objects.create(
+            file="analysis/pdf/drawing.pdf", original_filename="drawing.pdf", status="done", page_count=4
+        )
+        patcher = mock.patch.object(rasterizer, "render_pages", side_effect=_fake_render_pages)
+        self.render = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_visit_renders_only_that_page_and_later_visits_reuse_it(self):
+        page = rasterizer.ensure_page(self.analysis, 3)
+        again = rasterizer.ensure_page(self.analysis, 3)
+
+        self.assertEqual(page.pk, again.pk)
+        self.assertEqual(page.image.name, f"analysis/pages/{self.analysis.id}_page_3.png")
+        self.render.assert_called_once_with(mock.ANY, self.analysis.id, first_page=3, last_page=3)
+        self.assertEqual(list(self.analysis.pages.values_list("page_number", flat=True)), [3])
+
+    def test_page_of_an_identical_pdf_is_reused_without_rendering(self):
+        source = Analysis.objects.create(file="analysis/pdf/drawing.pdf", original_filename="a.pdf", file_sha256="ab" * 32)
+        AnalysisPage.objects.create(analysis=source, page_number=2, image="analysis/pages/shared_2.png")
+        Analysis.objects.filter(pk=self.analysis.pk).update(file_sha256="ab" * 32)
+        self.analysis.refresh_from_db()
+
+        page = rasterizer.ensure_page(self.analysis, 2)
+
+        self.assertEqual(page.image.name, "analysis/pages/shared_2.png")
+        self.render.assert_not_called()
+
+    def test_select_region_renders_the_visited_page_and_links_its_neighbours(self):
+        _log_in(self.client, "1")
+        response = self.client.get(
+            reverse("analysis_app:select_region", args=[self.analysis.id, "bom", 2])
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.render.assert_called_once_with(mock.ANY, self.analysis.id, first_page=2, last_page=2)
+        self.assertIsNotNone(response.context["prev_page_url"])
+        self.assertIsNotNone(response.context["next_page_url"])
+
+    def test_select_region_past_the_last_page_is_404(self):
+        _log_in(self.client, "1")
+        response = self.client.get(
+            reverse("analysis_app:select_region", args=[self.analysis.id, "bom", 5])
+        )
+        self.assertEqual(response.status_code, 404)
+        self.render.assert_not_called()
+
+
+class CombinedExtractionFallbackTests(SimpleTestCase):
+    """Combined mode must never return less than the split calls would."""
+
+    def _extract(self, answers):
+        calls = []
+
+        def vision(image, instruction, use_cache=True, schema=None, call_info=None, on_token=None):
+            calls.append(call_info["step_type"])
+            return answers[call_info["step_type"]]
+
+        with mock.patch.object(ai_extractor, "extract_region", return_value=(None, None)), mock.patch.object(
+            ai_extractor, "_call_groq_vision_json", side_effect=vision
+        ), mock.patch.object(ai_extractor, "_design_rule", return_value=None), mock.patch.object(
+            ai_extractor, "_bom_rule", return_value=None
+        ):
+            design, items = ai_extractor.extract_design_and_bom_combined(b"design", [b"bom-1", b"bom-2"])
+        return calls, design, items
+
+    def test_failed_combined_request_falls_back_to_split_calls(self):
+        calls, design, items = self._extract(
+            {
+                "combined": None,
+                "design": {"insulation": "Yes"},
+                "bom": {"items": [{"part_label": "Shell", "material_raw": "SA-516-70", "side": None}]},
+            }
+        )
+        self.assertEqual(calls, ["combined", "design", "bom", "bom"])
+        self.assertEqual(design["insulation"], "Yes")
+        self.assertEqual([i["part_label"] for i in items], ["Shell", "Shell"])
+
+    def test_missing_part_of_combined_answer_is_asked_alone(self):
+        calls, design, items = self._extract(
+            {
+                "combined": {"bom_tables": [{"items": [{"part_label": "Head", "material_raw": "SA-240 316"}]}, {}]},
+                "design": {"insulation": "No"},
+                "bom": {"items": [{"part_label": "Channel", "material_raw": "SA-105"}]},
+            }
+        )
+        self.assertEqual(calls, ["combined", "design", "bom"])
+        self.assertEqual(design["insulation"], "No")
+        self.assertEqual([i["part_label"] for i in items], ["Head", "Channel"])
+
+    def test_region_with_empty_items_is_asked_alone(self):
+        calls, _, items = self._extract(
+            {
+                "combined": {
+                    "design": {"insulation": "No"},
+                    "bom_tables": [{"items": []}, {"items": [{"part_label": "Head", "material_raw": "SA-240 316"}]}],
+                },
+                "bom": {"items": [{"part_label": "Shell", "material_raw": "SA-516-70"}]},
+            }
+        )
+        self.assertEqual(calls, ["combined", "bom"])
+        self.assertEqual([i["part_label"] for i in items], ["Shell", "Head"])
+
+    def test_unmatched_table_count_is_merged_without_re_asking(self):
+        calls, _, items = self._extract(
+            {
+                "combined": {
+                    "design": {"insulation": "No"},
+                    "items": [{"part_label": "Shell", "material_raw": "SA-516-70"}],
+                },
+            }
+        )
+        self.assertEqual(calls, ["combined"])
+        self.assertEqual([i["part_label"] for i in items], ["Shell"])
+
+
+@override_settings(REEXTRACT_MAX_ATTEMPTS=2)
+class ReextractQueueTests(TestCase):
+    def setUp(self):
+        analysis = Analysis.objects.create(
+            file="analysis/pdf/drawing.pdf",
+            original_filename="MLK PMT 10101 - V-001.pdf",
+            workbook_path="analysis/workbooks/A1_IPETRO_Masterfile.xlsx",
+        )
+        page = AnalysisPage.objects.create(analysis=analysis, page_number=1, image="analysis/pages/1.png")
+        RegionSelection.objects.create(analysis=analysis, page=page, step_type="design_data", x1=0, y1=0, x2=1, y2=1)
+        RegionSelection.objects.create(analysis=analysis, page=page, step_type="bom", x1=0, y1=0, x2=1, y2=1)
+        self.run = reextract.create_run(reextract.affected_analyses(analysis_ids=[analysis.id]), ["bom"], "queue", "test")
+        self.item = self.run.items.get()
+
+    def _run_queue(self, *answers):
+        # extract_bom_materials swallows API errors and answers [] - the case being retried
+        extract = mock.Mock(side_effect=list(answers))
+        with mock.patch.object(reextract, "_crops", lambda items: {i.region_id: b"png" for i in items}), mock.patch.object(
+            reextract, "extract_bom_materials", extract
+        ):
+            reextract.run_queue(self.run)
+        self.item.refresh_from_db()
+        return extract.call_count
+
+    def test_failed_item_is_retried_on_resume(self):
+        self._run_queue([])
+        self.assertEqual((self.item.status, self.item.attempts), ("pending", 1))
+        self.assertIn("no usable answer", self.item.error)
+
+        # --resume runs the queue again
+        self._run_queue([{"part_label": "Shell", "material_raw": "SA-516-70", "side": None}])
+        self.assertEqual((self.item.status, self.item.attempts), ("done", 2))
+        self.assertEqual(self.item.result[0]["part_label"], "Shell")
+
+    def test_item_fails_for_good_after_max_attempts(self):
+        self._run_queue([])
+        self._run_queue([])
+        self.assertEqual((self.item.status, self.item.attempts), ("failed", 2))
+        self.assertEqual(self._run_queue(), 0)
+
+
+@override_settings(JWT_SECRET=TEST_JWT_SECRET, JWT_ALGORITHM="HS256")
+class GenerateStreamTests(TestCase):
+    def setUp(self):
+        self.owner = ExternalUser.objects.create(external_id="1")
+        ExternalUser.objects.create(external_id="2")
+        self.analysis = Analysis.objects.create(
+            file="analysis/pdf/drawing.pdf",
+            original_filename="MLK PMT 10101 - V-001.pdf",
+            status="ready_to_generate",
+            created_by=self.owner,
+        )
+        page = AnalysisPage.objects.create(analysis=self.analysis, page_number=1, image="analysis/pages/1.png")
+        for step_type in ("design_data", "bom"):
+            RegionSelection.objects.create(
+                analysis=self.analysis, page=page, step_type=step_type, x1=0, y1=0, x2=1, y2=1
+            )
+        # the generate pipeline itself is not under test here
+        patcher = mock.patch.object(views, "_sse_events_sync", return_value=iter(["event: done\ndata: {}\n\n"]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _stream_url(self):
+        _log_in(self.client, "1")
+        response = self.client.post(reverse("analysis_app:generate_stream_start", args=[self.analysis.id]))
+        self.assertEqual(response.status_code, 200)
+        return response.json()["stream_url"]
+
+    def test_token_is_single_use(self):
+        url = self._stream_url()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(b"".join(response.streaming_content), b"event: done\ndata: {}\n\n")
+        # the nonce is claimed in the database, so no other worker process can replay it either
+        self.assertEqual(self.client.get(url).status_code, 204)
+
+    def test_token_is_bound_to_its_user(self):
+        url = self._stream_url()
+        _log_in(self.client, "2")
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_stream_needs_a_login(self):
+        url = self._stream_url()
+        self.client.session.flush()
+        self.client.cookies.clear()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+
+    def test_tampered_token_is_rejected(self):
+        url = self._stream_url()
+        self.assertEqual(self.client.get(url[:-2] + "xx").status_code, 403)
+
+    def test_failed_generate_puts_the_status_back(self):
+        with mock.patch.object(generate, "crop_region_selections", side_effect=OSError("page image missing")):
+            with self.assertRaises(OSError):
+                generate.run_generate(self.analysis)
+        self.analysis.refresh_from_db()
+        self.assertEqual(self.analysis.status, "ready_to_generate")
+
+
+class VisionAnswerRepairTests(SimpleTestCase):
+    def test_clean_json_needs_no_repair(self):
+        self.assertEqual(repair_json('{"items": []}'), ({"items": []}, []))
+
+    def test_fence_and_surrounding_text_are_removed(self):
+        value, repairs = repair_json('```json\nHere you go: {"items": []} hope it helps\n```')
+        self.assertEqual(value, {"items": []})
+        self.assertEqual(repairs, ["markdown fence removed", "leading text removed", "trailing text removed"])
+
+    def test_trailing_commas_and_python_literals(self):
+        value, repairs = repair_json('{"insulation": None, "items": [{"side": "None,"},],}')
+        self.assertEqual(value, {"insulation": None, "items": [{"side": "None,"}]})
+        self.assertEqual(repairs, ["trailing commas removed", "Python literals converted"])
+
+    def test_truncated_answer_keeps_complete_items(self):
+        value, repairs = repair_json('{"items": [{"part_label": "Shell"}, {"part_label": "He')
+        self.assertEqual(value, {"items": [{"part_label": "Shell"}]})
+        self.assertIn("truncated JSON closed", repairs)
+
+    def test_unrecoverable_answer(self):
+        self.assertIsNone(repair_json("no table found")[0])
+        self.assertIsNone(repair_json("")[0])
+
+    def test_validate_shapes_answer_to_schema(self):
+        data, problems = validate(
+            {"items": {"part_label": "Shell", "material_raw": 516, "side": True, "note": "x"}}, BOM_SCHEMA
+        )
+        self.assertEqual(data, {"items": [{"part_label": "Shell", "material_raw": "516", "side": None}]})
+        self.assertEqual(len(problems), 3)  # wrapped object, dropped key, boolean side
+
+    def test_validate_keeps_numeric_strings_and_nulls_other_text(self):
+        data, problems = validate(
+            {"design": {"shell": {"temp_c": "120 C", "pressure_mpa": "FV"}}}, DESIGN_SCHEMA
+        )
+        self.assertEqual(data["design"]["shell"], {"temp_c": "120 C", "pressure_mpa": None})
+        self.assertEqual(data["fluids"], {"shell": None, "tube": None, "header": None})
+        self.assertEqual(problems, ["design.shell.pressure_mpa: 'FV' is not a number, set to null"])
+
+
+class _ApiError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": retry_after} if retry_after is not None else {}
+        self.response = mock.Mock(status_code=status_code, headers=headers)
+
+
+# one slot per second, bursts of 3 (2 s of tolerance)
+@override_settings(
+    GROQ_REQUESTS_PER_MINUTE=60,
+    GROQ_BURST=3,
+    GROQ_BULK_HEADROOM=1,
+    GROQ_MAX_QUEUE_WAIT=1.5,
+    GROQ_BREAKER_THRESHOLD=2,
+    GROQ_BREAKER_COOLDOWN=30,
+    GROQ_MAX_RETRIES=2,
+)
+class RateLimiterTests(TestCase):
+    NOW = 1000.0
+
+    def _reserve(self, now=NOW, bulk=False):
+        return groq_scheduler.reserve_slot("test", now=now, bulk=bulk)
+
+    def test_burst_then_one_slot_per_interval(self):
+        self.assertEqual([self._reserve() for _ in range(4)], [0.0, 0.0, 0.0, 1.0])
+
+    def test_queue_longer_than_max_wait_is_refused_without_reserving(self):
+        for _ in range(4):
+            self._reserve()
+        with self.assertRaises(groq_scheduler.RateLimitQueueTimeout):
+            self._reserve()
+        # the refused call did not move the bucket
+        self.assertEqual(self._reserve(now=self.NOW + 1), 1.0)
+
+    def test_bulk_callers_leave_headroom_for_interactive_ones(self):
+        self.assertEqual(self._reserve(bulk=True), 0.0)
+        self.assertEqual(self._reserve(bulk=True), 0.0)
+        # a third bulk call would eat the last burst slot: told to wait, nothing reserved
+        self.assertEqual(self._reserve(bulk=True), 1.0)
+        self.assertEqual(self._reserve(), 0.0)
+
+    def test_retry_after_holds_everyone_back_even_inside_the_burst_window(self):
+        with mock.patch.object(groq_scheduler.time, "time", return_value=self.NOW):
+            groq_scheduler.push_back(1.0, "test")
+        with override_settings(GROQ_MAX_QUEUE_WAIT=120):
+            self.assertEqual(self._reserve(), 1.0)
+            self.assertEqual(self._reserve(now=self.NOW + 1), 1.0)
+
+    def test_breaker_opens_after_consecutive_failures_and_closes_on_success(self):
+        groq_scheduler.record_result(False, "test")
+        groq_scheduler.record_result(False, "test")
+        with self.assertRaises(groq_scheduler.CircuitOpenError):
+            groq_scheduler.reserve_slot("test")
+        groq_scheduler.record_result(True, "test")
+        self.assertEqual(groq_scheduler.reserve_slot("test"), 0.0)
+
+    @override_settings(GROQ_BREAKER_THRESHOLD=10)
+    def test_retryable_errors_are_retried_then_succeed(self):
+        call = mock.Mock(side_effect=[_ApiError(503), _ApiError(429), "answer"])
+        info = {}
+        with mock.patch.object(groq_scheduler.time, "sleep"):
+            self.assertEqual(groq_scheduler.run_scheduled(call, "test", info=info), "answer")
+        self.assertEqual(call.call_count, 3)
+        self.assertEqual(info["retries"], 2)
+
+    @override_settings(GROQ_BREAKER_THRESHOLD=10)
+    def test_retries_stop_at_the_limit(self):
+        call = mock.Mock(side_effect=_ApiError(500))
+        with mock.patch.object(groq_scheduler.time, "sleep"), self.assertRaises(_ApiError):
+            groq_scheduler.run_scheduled(call, "test")
+        self.assertEqual(call.call_count, 3)
+
+    def test_client_errors_are_not_retried(self):
+        call = mock.Mock(side_effect=_ApiError(400))
+        with self.assertRaises(_ApiError):
+            groq_scheduler.run_scheduled(call, "test")
+        self.assertEqual(call.call_count, 1)
+
+    @override_settings(GROQ_BREAKER_THRESHOLD=10, GROQ_MAX_QUEUE_WAIT=120)
+    def test_retry_after_is_waited_in_the_queue_not_by_backoff(self):
+        call = mock.Mock(side_effect=[_ApiError(429, retry_after="4"), "answer"])
+        with mock.patch.object(groq_scheduler.time, "sleep") as sleep:
+            self.assertEqual(groq_scheduler.run_scheduled(call, "test"), "answer")
+        waited = sum(c.args[0] for c in sleep.call_args_list)
+        self.assertAlmostEqual(waited, 4.0, delta=0.5)
+
+    def test_throttling_does_not_open_the_breaker(self):
+        call = mock.Mock(side_effect=[_ApiError(429), _ApiError(503, retry_after="0"), _ApiError(429)])
+        with mock.patch.object(groq_scheduler.time, "sleep"), self.assertRaises(_ApiError):
+            groq_scheduler.run_scheduled(call, "test")
+        self.assertEqual(call.call_count, 3)
+        # threshold is 2: counting any of those would have opened it
+        bucket = groq_scheduler._bucket("test")
+        self.assertEqual(bucket.consecutive_failures, 0)
+        self.assertIsNone(bucket.open_until)
+
+
+def _row(y, *cells):
+    """Words of one table row; each cell is (x, text), words 6 pt per character apart by 3 pt."""
+    words = []
+    for x, text in cells:
+        for part in text.split():
+            words.append(Word(part, x, y, x + 6 * len(part), y + 10))
+            x += 6 * len(part) + 3
+    return words
+
+
+def _table(*rows):
+    return [w for i, cells in enumerate(rows) for w in _row(20 * i, *cells)]
+
+
+class TextLayerDesignTests(SimpleTestCase):
+    def test_design_and_operating_rows_per_side(self):
+        data = design_data_from_words(
+            _table(
+                [(300, "SHELL"), (400, "TUBE")],
+                [(0, "FLUID"), (300, "CRUDE"), (400, "WATER")],
+                [(0, "DESIGN PRESSURE (MPa)"), (300, "1.5"), (400, "0.8")],
+                [(0, "DESIGN TEMPERATURE (C)"), (300, "120"), (400, "90")],
+                [(0, "OPERATING PRESSURE (MPa)"), (300, "1.2"), (400, "0.5")],
+                [(0, "OPERATING TEMPERATURE (C)"), (300, "100"), (400, "60")],
+            )
+        )
+        self.assertEqual(data["design"]["shell"], {"pressure_mpa": 1.5, "temp_c": 120.0})
+        self.assertEqual(data["design"]["tube"], {"pressure_mpa": 0.8, "temp_c": 90.0})
+        self.assertEqual(data["operating"]["shell"], {"pressure_mpa": 1.2, "temp_c": 100.0})
+        self.assertEqual(data["fluids"]["tube"], "WATER")
+
+    def test_test_pressure_mawp_and_mdmt_rows_are_ignored(self):
+        data = design_data_from_words(
+            _table(
+                [(0, "MIN. DESIGN METAL TEMP"), (300, "-29")],
+                [(0, "HYDROSTATIC TEST PRESSURE"), (300, "2.3")],
+                [(0, "MAX ALLOWABLE WORKING PRESSURE"), (300, "1.9")],
+                [(0, "DESIGN PRESSURE"), (300, "1.5")],
+                [(0, "DESIGN TEMPERATURE"), (300, "120")],
+            )
+        )
+        self.assertEqual(data["design"]["shell"], {"pressure_mpa": 1.5, "temp_c": 120.0})
+        self.assertEqual(data["operating"]["shell"], {})
+
+    def test_unlabelled_pairs_are_operating_then_design(self):
+        data = design_data_from_words(
+            _table(
+                [(0, "PRESSURE (BAR)"), (300, "10")],
+                [(0, "PRESSURE (BAR)"), (300, "15")],
+                [(0, "TEMPERATURE (F)"), (300, "212")],
+                [(0, "TEMPERATURE (F)"), (300, "302")],
+            )
+        )
+        self.assertEqual(data["operating"]["shell"], {"pressure_mpa": 1.0, "temp_c": 100.0})
+        self.assertEqual(data["design"]["shell"], {"pressure_mpa": 1.5, "temp_c": 150.0})
+
+    def test_ambiguous_unlabelled_rows_fall_back_to_vision(self):
+        self.assertIsNone(
+            design_data_from_words(
+                _table(
+                    [(0, "PRESSURE"), (300, "1.5")],
+                    [(0, "DESIGN PRESSURE"), (300, "1.5")],
+                    [(0, "DESIGN TEMPERATURE"), (300, "120")],
+                )
+            )
+        )
+        self.assertIsNone(
+            design_data_from_words(
+                _table([(0, "PRESSURE"), (300, "1.5")], [(0, "DESIGN TEMPERATURE"), (300, "120")])
+            )
+        )
+
+    def test_missing_design_values_fall_back_to_vision(self):
+        self.assertIsNone(design_data_from_words(_table([(0, "OPERATING PRESSURE"), (300, "1.2")])))
+        self.assertIsNone(design_data_from_words([]))
+
+
+class TextLayerBomTests(SimpleTestCase):
+    def test_pressure_parts_are_read_and_fasteners_skipped(self):
+        data = bom_data_from_words(
+            _table(
+                [(0, "1"), (40, "SHELL"), (300, "SA-516-70")],
+                [(0, "2"), (40, "CHANNEL"), (300, "SA-240 316")],
+                [(0, "3"), (40, "STUD BOLT"), (300, "SA-193 B7")],
+                [(0, "4"), (40, "SHELL"), (300, "SA-516-70")],
+            )
+        )
+        self.assertEqual(
+            data["items"],
+            [
+                {"part_label": "Shell", "material_raw": "SA-516-70", "side": "shell"},
+                {"part_label": "Channel", "material_raw": "SA-240 316", "side": "tube"},
+            ],
+        )
+
+    def test_no_items_falls_back_to_vision(self):
+        self.assertIsNone(bom_data_from_words(_table([(0, "NOTES"), (300, "SEE DWG")])))
+
+
+class WordIndexTests(SimpleTestCase):
+    def test_query_returns_words_centred_in_box_in_reading_order(self):
+        words = [
+            Word("B", 300, 10, 310, 20),
+            Word("A", 10, 10, 20, 20),
+            Word("C", 10, 500, 20, 510),
+            Word("edge", 95, 10, 125, 20),  # centre at x=110, outside
+        ]
+        index = WordIndex(words, 600, 800, cells=8)
+        self.assertEqual([w.text for w in index.query(0, 0, 100, 100)], ["A"])
+        self.assertEqual([w.text for w in index.query_normalized(0, 0, 1, 0.1)], ["A", "edge", "B"])
+
+
+class VisionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        # every test starts without a running size, as a fresh process would
+        patcher = mock.patch.dict(vision_cache._size, {"dir": None, "bytes": None, "writes": 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _settings(self, max_bytes):
+        return override_settings(ANALYSIS_VISION_CACHE_DIR=self.cache_dir, ANALYSIS_VISION_CACHE_MAX_BYTES=max_bytes)
+
+    def _key(self, n):
+        return vision_cache.vision_cache_key(bytes([n]), "prompt", "model", 0.0)
+
+    def test_round_trip(self):
+        with self._settings(10_000):
+            vision_cache.cache_put(self._key(1), {"items": []})
+            self.assertEqual(vision_cache.cache_get(self._key(1)), {"items": []})
+            self.assertIsNone(vision_cache.cache_get(self._key(2)))
+
+    def test_writes_under_budget_do_not_walk_the_cache(self):
+        with self._settings(10_000), mock.patch.object(
+            vision_cache, "evict_to_budget", wraps=vision_cache.evict_to_budget
+        ) as evict:
+            for n in range(20):
+                vision_cache.cache_put(self._key(n), {"n": n})
+        # only the first write, which has no running size yet
+        self.assertEqual(evict.call_count, 1)
+
+    def test_least_recently_used_entries_are_evicted_past_the_budget(self):
+        entry_size = len('{"n": 0}')
+        with self._settings(3 * entry_size):
+            for n in range(3):
+                vision_cache.cache_put(self._key(n), {"n": n})
+                os.utime(vision_cache._path(self._key(n)), (1000 + n, 1000 + n))
+            # reading entry 0 makes entry 1 the least recently used
+            vision_cache.cache_get(self._key(0))
+            vision_cache.cache_put(self._key(3), {"n": 3})
+
+            self.assertIsNone(vision_cache.cache_get(self._key(1)))
+            for n in (0, 2, 3):
+                self.assertEqual(vision_cache.cache_get(self._key(n)), {"n": n})
+
+    def test_other_processes_writes_are_seen_on_rescan(self):
+        with self._settings(10_000), mock.patch.object(vision_cache, "RESCAN_AFTER_WRITES", 3), mock.patch.object(
+            vision_cache, "evict_to_budget", wraps=vision_cache.evict_to_budget
+        ) as evict:
+            for n in range(8):
+                vision_cache.cache_put(self._key(n), {"n": n})
+        self.assertEqual(evict.call_count, 2)
+
+
+class MediaGarbageTests(TestCase):
+    NOW = 10 * media_gc.DAY
+
+    def setUp(self):
+        self.media_root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        analysis = Analysis.objects.create(
+            file="analysis/pdf/kept.pdf", original_filename="kept.pdf", status="done",
+            workbook_path="analysis/workbooks/kept.xlsx",
+        )
+        AnalysisPage.objects.create(analysis=analysis, page_number=1, image="analysis/pages/kept_1.png")
+        for rel, age_days in [
+            ("analysis/pdf/kept.pdf", 5),
+            ("analysis/pdf/orphan.pdf", 5),
+            ("analysis/pdf/uploading.pdf", 0),
+            ("analysis/pages/kept_1.png", 5),
+            ("analysis/pages/orphan_1.png", 5),
+            ("analysis/workbooks/kept.xlsx", 60),
+            ("analysis/workbooks/orphan.xlsx", 60),
+        ]:
+            self._file(rel, age_days)
+
+    def _file(self, rel, age_days):
+        path = self.media_root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * 10)
+        mtime = self.NOW - age_days * media_gc.DAY
+        os.utime(path, (mtime, mtime))
+
+    def _collect(self, dry_run):
+        reports = media_gc.collect_media_garbage(dry_run=dry_run, media_root=self.media_root, now=self.NOW)
+        return {r.directory: r for r in reports}
+
+    def _remaining(self):
+        return sorted(str(p.relative_to(self.media_root)) for p in self.media_root.rglob("*") if p.is_file())
+
+    def test_only_old_unreferenced_files_are_removed(self):
+        reports = self._collect(dry_run=False)
+
+        self.assertEqual(self._remaining(), [
+            "analysis/pages/kept_1.png",
+            "analysis/pdf/kept.pdf",
+            "analysis/pdf/uploading.pdf",
+            "analysis/workbooks/kept.xlsx",
+        ])
+        pdf = reports["analysis/pdf"]
+        self.assertEqual((pdf.scanned, pdf.referenced, pdf.kept_recent), (3, 1, 1))
+        self.assertEqual(pdf.removed, ["analysis/pdf/orphan.pdf"])
+        self.assertEqual(pdf.removed_bytes, 10)
+        self.assertEqual(reports["analysis/workbooks"].removed, ["analysis/workbooks/orphan.xlsx"])
+
+    def test_dry_run_reports_without_deleting(self):
+        before = self._remaining()
+        reports = self._collect(dry_run=True)
+        self.assertEqual(self._remaining(), before)
+        self.assertEqual(reports["analysis/pages"].removed, ["analysis/pages/orphan_1.png"])
+        self.assertEqual(reports["analysis/pages"].removed_bytes, 10)
+
+    def test_failed_unlinks_are_not_counted_as_freed(self):
+        real_unlink = Path.unlink
+
+        def unlink(path, *args, **kwargs):
+            if path.name == "orphan.pdf":
+                raise PermissionError("busy")
+            return real_unlink(path, *args, **kwargs)
+
+        with mock.patch.object(Path, "unlink", unlink):
+            pdf = self._collect(dry_run=False)["analysis/pdf"]
+
+        self.assertEqual((pdf.removed, pdf.removed_bytes), ([], 0))
+        self.assertEqual(len(pdf.errors), 1)
+        self.assertIn("analysis/pdf/orphan.pdf", self._remaining())
+
+
+class _FakeBackend(backends.ExtractorBackend):
+    def __init__(self, name, local=True, answer=None, default_seconds=1.0):
+        self.name = name
+        self.local = local
+        self.answer = answer
+        self.default_seconds = default_seconds
+        self.calls = 0
+
+    def extract(self, job):
+        self.calls += 1
+        return self.answer
+
+
+DESIGN_ANSWER = {"design": {"shell": {"pressure_mpa": 1.5, "temp_c": 120}, "tube": {}}}
+
+
+@override_settings(
+    ANALYSIS_BACKEND_CALL_COST={},
+    ANALYSIS_ROUTER_EXPLORE_RATE=0.05,
+    ANALYSIS_ROUTER_VERIFY_RATE=0.05,
+    ANALYSIS_ROUTER_MIN_ACCURACY=0.8,
+)
+class BackendRoutingTests(TestCase):
+    def setUp(self):
+        self.fast = _FakeBackend("fast", answer=DESIGN_ANSWER, default_seconds=0.1)
+        self.slow = _FakeBackend("slow", answer=DESIGN_ANSWER, default_seconds=1.0)
+        self.vision = _FakeBackend("vision", local=False, answer=DESIGN_ANSWER, default_seconds=4.0)
+        self.job = backends.RegionJob("design", b"")
+        enabled = mock.patch.object(backends, "_enabled", return_value=[self.slow, self.vision, self.fast])
+        enabled.start()
+        self.addCleanup(enabled.stop)
+        self.stats = {}
+        self.load_stats = backends.backend_stats
+        for patcher in (
+            mock.patch.object(backends.random, "random", return_value=0.5),
+            mock.patch.object(backends, "backend_stats", side_effect=lambda: self.stats),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _route(self, stats=None):
+        self.stats = stats or {}
+        return [b.name for b in backends.route(self.job)]
+
+    def test_local_backends_first_ranked_by_expected_time(self):
+        self.assertEqual(self._route(), ["fast", "slow", "vision"])
+
+    def test_local_backend_slower_than_the_remote_call_is_skipped(self):
+        stats = {("slow", "design"): {"mean_seconds": 3.0, "success_rate": 0.1}}
+        self.assertEqual(self._route(stats), ["fast", "vision"])
+
+    def test_inaccurate_local_backend_is_skipped_unless_exploring(self):
+        stats = {("fast", "design"): {"success_rate": 0.9, "accuracy": 0.5}}
+        self.assertEqual(self._route(stats), ["slow", "vision"])
+        with mock.patch.object(backends.random, "random", return_value=0.01):
+            self.assertEqual(self._route(stats), ["fast", "slow", "vision"])
+
+    def test_template_rule_pins_a_backend(self):
+        self.job.rule = mock.Mock(backend="vision")
+        with mock.patch.dict(backends.BACKENDS, {"vision": self.vision}):
+            self.assertEqual(self._route(), ["vision"])
+
+    def test_stats_turn_agreement_into_accuracy(self):
+        ExtractorBackendStat.objects.create(backend="fast", kind="design", calls=10, successes=8, checked=6, agreed=2)
+        with mock.patch.object(backends, "_stats_cache", {}), mock.patch.object(backends, "_stats_loaded_at", 0.0):
+            stats = self.load_stats(max_age=0)
+        self.assertAlmostEqual(stats[("fast", "design")]["accuracy"], 0.6)
+
+    def test_sampled_local_answer_is_checked_against_the_vision_answer(self):
+        self.vision.answer = {"design": {"shell": {"pressure_mpa": "2.5", "temp_c": 120}}}
+        with mock.patch.object(backends.random, "random", return_value=0.01):
+            data, name = backends.extract_region(self.job)
+
+        self.assertEqual(name, "vision")
+        self.assertEqual(data, self.vision.answer)
+        stat = ExtractorBackendStat.objects.get(backend="fast", kind="design")
+        self.assertEqual((stat.calls, stat.successes, stat.checked, stat.agreed), (1, 1, 1, 0))
+        self.assertEqual(ExtractorBackendStat.objects.get(backend="vision").checked, 0)
+
+    def test_unsampled_local_answer_skips_the_vision_call(self):
+        data, name = backends.extract_region(self.job)
+        self.assertEqual((data, name), (DESIGN_ANSWER, "fast"))
+        self.assertEqual(self.vision.calls, 0)
+        self.assertEqual(ExtractorBackendStat.objects.get(backend="fast").checked, 0)
+
+    def test_agreement(self):
+        close = {"design": {"shell": {"pressure_mpa": "1.505 MPa", "temp_c": 120.0}}, "operating": {}}
+        self.assertTrue(backends.answers_agree("design", DESIGN_ANSWER, close))
+        self.assertFalse(backends.answers_agree("design", DESIGN_ANSWER, {"design": {}}))
+
+        local = {"items": [{"part_label": "Shell", "material_raw": "SA-516 70"}]}
+        same = {"items": [{"part_label": "SHELL", "material_raw": "SA516 70"}]}
+        more = {"items": same["items"] + [{"part_label": "Head", "material_raw": "SA-516 70"}]}
+        self.assertTrue(backends.answers_agree("bom", local, same))
+        self.assertFalse(backends.answers_agree("bom", local, more))
+
+
+class _CropTestCase(SimpleTestCase):
+    PAGE = "analysis/pages/analysis_1_p1.png"
+
+    def setUp(self):
+        self.media_root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=str(self.media_root))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        cropper._page_cache.clear()
+        cropper.reset_crop_cache_stats()
+        self.addCleanup(cropper._page_cache.clear)
+        self._page(self.PAGE)
+
+    def _page(self, name, size=(200, 100), color="white"):
+        path = self.media_root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        Image.new("RGB", size, color).save(path)
+        return path
+
+
+class CropCacheTests(_CropTestCase):
+    def test_same_region_reuses_one_deterministic_file(self):
+        first = cropper.crop_region_from_page(self.PAGE, 0.1, 0.1, 0.5, 0.5)
+        # a slightly different normalised box that lands on the same pixels
+        second = cropper.crop_region_from_page(self.PAGE, 0.1001, 0.1, 0.5, 0.5)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(os.listdir(self.media_root / cropper.CROPS_DIR)), 1)
+        with Image.open(self.media_root / first) as crop:
+            self.assertEqual(crop.size, (80, 40))
+        stats = cropper.crop_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_re_rendered_page_gets_a_new_crop(self):
+        first = cropper.crop_region_from_page(self.PAGE, 0.1, 0.1, 0.5, 0.5)
+        path = self._page(self.PAGE, color="black")
+        os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 1_000_000_000))
+
+        second = cropper.crop_region_from_page(self.PAGE, 0.1, 0.1, 0.5, 0.5)
+        self.assertNotEqual(first, second)
+        with Image.open(self.media_root / second) as crop:
+            self.assertEqual(crop.getpixel((0, 0)), (0, 0, 0))
+
+    def test_empty_region_is_rejected(self):
+        with self.assertRaises(ValueError):
+            cropper.crop_region_from_page(self.PAGE, 0.5, 0.5, 0.5, 0.9)
+
+    def test_etag_follows_the_crop_and_the_width(self):
+        etag = cropper.region_crop_etag(self.PAGE, 0.1, 0.1, 0.5, 0.5)
+        name = cropper.crop_region_from_page(self.PAGE, 0.1, 0.1, 0.5, 0.5)
+        self.assertEqual(etag, Path(name).stem)
+        self.assertEqual(cropper.region_crop_etag(self.PAGE, 0.1, 0.1, 0.5, 0.5, max_width=40), f"{etag}-w40")
+
+
+class PageImageCacheTests(_CropTestCase):
+    def test_page_is_decoded_once_for_several_crops(self):
+        with mock.patch.object(cropper.Image, "open", wraps=Image.open) as opened:
+            for x in (0.0, 0.2, 0.4, 0.6):
+                cropper.crop_region_from_page(self.PAGE, x, 0.0, x + 0.2, 0.5)
+        decodes = cropper.crop_cache_stats()["page_cache"]
+        self.assertEqual((decodes["misses"], decodes["hits"]), (1, 3))
+        # one header read for the size, one full decode
+        self.assertEqual(opened.call_count, 2)
+
+    def test_least_recently_used_page_is_evicted_past_the_budget(self):
+        other = "analysis/pages/analysis_1_p2.png"
+        third = "analysis/pages/analysis_1_p3.png"
+        self._page(other)
+        self._page(third)
+        page_bytes = 200 * 100 * 4
+
+        with override_settings(ANALYSIS_PAGE_CACHE_BYTES=2 * page_bytes):
+            # distinct boxes, so every crop has to go through the page cache
+            for i, name in enumerate((self.PAGE, other, self.PAGE, third)):
+                cropper.crop_region_from_page(name, 0.0, 0.0, 0.2 + 0.1 * i, 0.5)
+            stats = cropper.crop_cache_stats()["page_cache"]
+            self.assertEqual((stats["pages"], stats["bytes"], stats["evictions"]), (2, 2 * page_bytes, 1))
+
+            path = self.media_root / other
+            cache = cropper._page_cache
+            self.assertIsNone(cache.size_of(other, path.stat()))
+            self.assertEqual(cache.size_of(self.PAGE, (self.media_root / self.PAGE).stat()), (200, 100))
+
+    def test_changed_file_is_decoded_again(self):
+        path = self.media_root / self.PAGE
+        cropper._page_cache.get(self.PAGE, path, path.stat())
+        self._page(self.PAGE, size=(100, 50))
+        img = cropper._page_cache.get(self.PAGE, path, path.stat())
+        self.assertEqual(img.size, (100, 50))
+        self.assertEqual(cropper.crop_cache_stats()["page_cache"]["misses"], 2)
+
+
+class CropHandoffTests(_CropTestCase):
+    def test_crops_are_encoded_in_memory_without_writing_files(self):
+        data = cropper.crop_region_to_bytes(self.PAGE, 0.1, 0.1, 0.5, 0.5)
+        with Image.open(io.BytesIO(data)) as crop:
+            self.assertEqual((crop.format, crop.size), ("PNG", (80, 40)))
+        self.assertFalse((self.media_root / cropper.CROPS_DIR).exists())
+
+    def test_crop_already_on_disk_is_read_back(self):
+        name = cropper.crop_region_from_page(self.PAGE, 0.1, 0.1, 0.5, 0.5)
+        data = cropper.crop_region_to_bytes(self.PAGE, 0.1, 0.1, 0.5, 0.5)
+        self.assertEqual(data, (self.media_root / name).read_bytes())
+
+    def test_max_width_scales_the_crop_down(self):
+        data = cropper.crop_region_to_bytes(self.PAGE, 0.0, 0.0, 1.0, 1.0, max_width=50)
+        with Image.open(io.BytesIO(data)) as crop:
+            self.assertEqual(crop.size, (50, 25))
+
+    def test_selections_are_grouped_so_each_page_is_decoded_once(self):
+        other = "analysis/pages/analysis_1_p2.png"
+        self._page(other, size=(100, 100))
+
+        def region(pk, page, box):
+            return SimpleNamespace(id=pk, page=SimpleNamespace(image=SimpleNamespace(name=page)), x1=box[0], y1=box[1], x2=box[2], y2=box[3])
+
+        regions = [
+            region(1, self.PAGE, (0.0, 0.0, 0.5, 0.5)),
+            region(2, other, (0.0, 0.0, 0.5, 0.5)),
+            region(3, self.PAGE, (0.5, 0.5, 1.0, 1.0)),
+        ]
+
+        crops = cropper.crop_region_selections(regions)
+
+        self.assertEqual(sorted(crops), [1, 2, 3])
+        with Image.open(io.BytesIO(crops[2])) as crop:
+            self.assertEqual(crop.size, (50, 50))
+        self.assertEqual(cropper.crop_cache_stats()["page_cache"]["misses"], 2)
+
+
+@override_settings(JWT_SECRET=TEST_JWT_SECRET, JWT_ALGORITHM="HS256")
+class RegionCropEndpointTests(TestCase):
+    def setUp(self):
+        self.media_root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=str(self.media_root))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(cropper._page_cache.clear)
+
+        name = "analysis/pages/analysis_1_p1.png"
+        (self.media_root / "analysis/pages").mkdir(parents=True)
+        Image.new("RGB", (400, 200), "white").save(self.media_root / name)
+        ExternalUser.objects.create(external_id="1")
+        self.analysis = Analysis.objects.create(file="analysis/pdf/a.pdf", original_filename="a.pdf")
+        page = AnalysisPage.objects.create(analysis=self.analysis, page_number=1, image=name)
+        self.region = RegionSelection.objects.create(
+            analysis=self.analysis, page=page, step_type="bom", x1=0, y1=0, x2=0.5, y2=0.5
+        )
+        _log_in(self.client, "1")
+
+    def _get(self, query="", if_none_match=None):
+        url = reverse("analysis_app:region_crop", args=[self.analysis.id, self.region.id])
+        headers = {"If-None-Match": if_none_match} if if_none_match else {}
+        return self.client.get(url + query, headers=headers)
+
+    def test_crop_is_served_with_a_long_lived_validator(self):
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("immutable", response["Cache-Control"])
+        with Image.open(io.BytesIO(response.content)) as crop:
+            self.assertEqual(crop.size, (200, 100))
+
+    def test_matching_etag_gets_304_without_cropping(self):
+        etag = self._get()["ETag"]
+        with mock.patch.object(views, "crop_region_to_bytes") as crop:
+            response = self._get(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        crop.assert_not_called()
+
+    def test_width_gets_its_own_etag_and_scaled_image(self):
+        full = self._get()
+        thumb = self._get("?w=100")
+        self.assertNotEqual(full["ETag"], thumb["ETag"])
+        with Image.open(io.BytesIO(thumb.content)) as crop:
+            self.assertEqual(crop.size, (100, 50))
+        self.assertEqual(self._get("?w=abc").status_code, 400)
+
+    def test_moved_region_changes_the_etag(self):
+        etag = self._get()["ETag"]
+        RegionSelection.objects.filter(pk=self.region.pk).update(x2=0.75)
+        self.assertEqual(self._get(if_none_match=etag).status_code, 200)
+
+    def test_region_of_another_analysis_is_404(self):
+        other = Analysis.objects.create(file="analysis/pdf/b.pdf", original_filename="b.pdf")
+        url = reverse("analysis_app:region_crop", args=[other.id, self.region.id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+def _png(img):
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _ruled_table(size=(600, 300)):
+    img = Image.new("L", size, 255)
+    for y in range(40, size[1] - 40, 30):
+        for x in range(40, size[0] - 40):
+            img.putpixel((x, y), 0)
+    return img
+
+
+class PreprocessTests(SimpleTestCase):
+    def _run(self, img, **config):
+        config = dict(preprocess.DEFAULT_PREPROCESS, **config)
+        out, stats = preprocess.preprocess_for_vision(_png(img), config)
+        return Image.open(io.BytesIO(out)), stats
+
+    def test_trim_keeps_the_ink_plus_padding(self):
+        img = Image.new("RGB", (400, 300), "white")
+        img.paste((0, 0, 0), (100, 50, 200, 150))
+        out, stats = self._run(img, steps=["grayscale", "trim"])
+
+        self.assertEqual((out.mode, out.size), ("L", (116, 116)))
+        self.assertEqual([s["step"] for s in stats], ["input", "grayscale", "trim", "encode"])
+
+    def test_downscale_caps_the_long_edge(self):
+        out, _ = self._run(Image.new("L", (3200, 800), 255), steps=["downscale"])
+        self.assertEqual(out.size, (1600, 400))
+
+    def test_deskew_finds_a_small_rotation_and_leaves_level_tables_alone(self):
+        level = _ruled_table()
+        self.assertIs(preprocess._deskew(level, preprocess.DEFAULT_PREPROCESS), level)
+
+        skewed = level.rotate(2, resample=Image.BICUBIC, expand=True, fillcolor=255)
+        angle = preprocess._skew_angle(skewed, 3.0, 0.25)
+        self.assertAlmostEqual(angle, -2.0, delta=0.5)
+
+    def test_binarize_is_bilevel(self):
+        out, _ = self._run(_ruled_table(), steps=["binarize"])
+        self.assertEqual(out.mode, "1")
+
+    def test_disabled_or_unknown_steps(self):
+        data = _png(_ruled_table())
+        self.assertEqual(preprocess.preprocess_for_vision(data, {"enabled": False}), (data, []))
+        with self.assertRaises(ValueError):
+            preprocess.preprocess_for_vision(data, dict(preprocess.DEFAULT_PREPROCESS, steps=["sharpen"]))
+
+
+class ConcurrentExtractionTests(SimpleTestCase):
+    def setUp(self):
+        # every call waits for all the others: a sequential run would break the barrier
+        self.barrier = threading.Barrier(4, timeout=5)
+
+        def design(crop, **kwargs):
+            self.barrier.wait()
+            return {"crop": crop}
+
+        def bom(crop, **kwargs):
+            self.barrier.wait()
+            if crop == "bad":
+                raise RuntimeError("vision call failed")
+            return [{"part_label": crop}]
+
+        for name, fn in (("extract_design_metadata", design), ("extract_bom_materials", bom)):
+            patcher = mock.patch.object(extraction, name, side_effect=fn)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_calls_run_together_and_items_keep_region_order(self):
+        design, items = extraction.extract_design_and_bom(
+            ("design", None), [("shell", None), ("bad", None), ("head", None)], max_workers=4, mode="split"
+        )
+        self.assertEqual(design, {"crop": "design"})
+        # the failed region contributes nothing; the others are unaffected
+        self.assertEqual([i["part_label"] for i in items], ["shell", "head"])
+
+    def test_single_worker_runs_in_order_on_the_calling_thread(self):
+        self.barrier = threading.Barrier(1)
+        events = []
+        progress = extraction.ExtractionProgress(events.append)
+        _, items = extraction.extract_design_and_bom(
+            ("design", None), [("shell", None)], max_workers=1, mode="split", progress=progress
+        )
+        self.assertEqual(items, [{"part_label": "shell"}])
+        self.assertEqual(
+            [(e["region"], e["status"]) for e in events],
+            [("design", "started"), ("design", "done"), ("bom-0", "started"), ("bom-0", "done")],
+        )
+
+
+class GroqStandinTests(SimpleTestCase):
+    def _serve(self, **config):
+        server = groq_standin.make_server("127.0.0.1", 0, dict({"latency_ms": 0, "jitter_ms": 0}, **config))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _post(self, server, prompt):
+        body = {"model": "m", "messages": [{"role": "user", "content": [{"type": "text", "text": prompt}]}]}
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{server.server_address[1]}/openai/v1/chat/completions",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return json.loads(response.read())
+
+    def test_extractor_prompts_get_the_canned_answer_for_their_kind(self):
+        server = self._serve()
+        for prompt, kind in ((ai_extractor.DESIGN_INSTRUCTION, "design"), (ai_extractor.BOM_INSTRUCTION, "bom")):
+            completion = self._post(server, prompt)
+            content = json.loads(completion["choices"][0]["message"]["content"])
+            self.assertEqual(content, groq_standin.CANNED_RESPONSES[kind])
+        self.assertEqual(server.counts, {"design": 1, "bom": 1})
+
+    def test_rate_limited_requests_carry_retry_after(self):
+        server = self._serve(rate_limit_rate=1.0, retry_after=7)
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self._post(server, ai_extractor.BOM_INSTRUCTION)
+        self.assertEqual(raised.exception.code, 429)
+        self.assertEqual(raised.exception.headers["retry-after"], "7")
+        raised.exception.close()
+
+    def test_same_seed_replays_the_same_latencies_and_failures(self):
+        config = dict(groq_standin.DEFAULT_STANDIN, error_rate=0.3, rate_limit_rate=0.2, seed=42)
+        runs = []
+        for _ in range(2):
+            server = groq_standin.StandinServer(("127.0.0.1", 0), config)
+            runs.append([server.draw() for _ in range(20)])
+            server.server_close()
+        self.assertEqual(runs[0], runs[1])
+        self.assertEqual({outcome for _, outcome in runs[0]}, {"ok", "error", "rate_limited"})
+
+
+class TelemetryTests(TestCase):
+    def _log(self, pmt_no, latency_ms, outcome="ok", retries=0, queued_ms=0):
+        VisionCallLog.objects.create(
+            step_type="bom", pmt_no=pmt_no, equipment_no="E-1", model="m",
+            latency_ms=latency_ms, queued_ms=queued_ms, retries=retries, outcome=outcome,
+        )
+
+    def test_percentile_interpolates(self):
+        self.assertIsNone(telemetry.percentile([], 50))
+        self.assertEqual(telemetry.percentile([10], 95), 10)
+        self.assertEqual(telemetry.percentile([40, 10, 30, 20], 50), 25)
+        self.assertAlmostEqual(telemetry.percentile(range(1, 101), 95), 95.05)
+
+    def test_summary_per_template_slowest_first(self):
+        for latency in (100, 200, 300):
+            self._log("P-1", latency)
+        self._log("P-1", 0, outcome="circuit_open")
+        self._log("P-1", 500, outcome="repaired", retries=2, queued_ms=1000)
+        self._log("P-2", 900, outcome="request_failed")
+
+        summary = telemetry.template_summary()
+
+        self.assertEqual([s["pmt_no"] for s in summary], ["P-2", "P-1"])
+        p1 = summary[1]
+        self.assertEqual((p1["calls"], p1["failures"], p1["repaired"]), (5, 1, 1))
+        self.assertAlmostEqual(p1["failure_rate"], 0.2)
+        # the skipped call is left out of the latencies
+        self.assertEqual(p1["p50_ms"], 250)
+        self.assertAlmostEqual(p1["avg_retries"], 0.4)
+        self.assertEqual(p1["avg_queued_ms"], 200)
+
+    @override_settings(ANALYSIS_VISION_CACHE_ENABLED=False, ANALYSIS_VISION_PREPROCESS={"enabled": False})
+    def test_each_vision_request_is_logged_with_its_outcome(self):
+        message = SimpleNamespace(content='{"items": []}')
+        usage = SimpleNamespace(prompt_tokens=900, completion_tokens=12)
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = [
+            SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage),
+            _ApiError(400),
+        ]
+        info = ai_extractor._call_info(None, "bom", "P-1", "E-1")
+        with mock.patch.object(ai_extractor, "get_groq_client", return_value=client):
+            ai_extractor._call_groq_vision_json(b"crop", "instruction", schema=BOM_SCHEMA, call_info=info)
+            ai_extractor._call_groq_vision_json(b"crop", "instruction", schema=BOM_SCHEMA, call_info=info)
+
+        failed, ok = VisionCallLog.objects.order_by("-id")
+        self.assertEqual((ok.outcome, ok.step_type, ok.pmt_no, ok.image_bytes), ("ok", "bom", "P-1", 4))
+        self.assertEqual((ok.prompt_tokens, ok.completion_tokens), (900, 12))
+        self.assertEqual((failed.outcome, failed.prompt_tokens), ("request_failed", None))
+
+    @override_settings(ANALYSIS_VISION_CALL_LOG=False)
+    def test_disabled_telemetry_records_nothing(self):
+        telemetry.record_vision_call(step_type="bom", model="m", outcome="ok")
+        self.assertFalse(VisionCallLog.objects.exists())
+
+
+class PooledClientTests(SimpleTestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch.object(ai_extractor, "_client", None),
+            mock.patch.object(ai_extractor, "Groq", side_effect=lambda **kwargs: mock.Mock(kwargs=kwargs)),
+            mock.patch.object(ai_extractor, "_http_client", return_value="pool"),
+            mock.patch.dict(os.environ, {"GROQ_API_KEY": "key-1"}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_one_client_is_shared_across_threads(self):
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(ai_extractor.get_groq_client())) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len({id(c) for c in clients}), 1)
+        self.assertEqual(ai_extractor.Groq.call_count, 1)
+        # retries belong to groq_scheduler, not the SDK
+        self.assertEqual(clients[0].kwargs["max_retries"], 0)
+        self.assertEqual(clients[0].kwargs["http_client"], "pool")
+
+    def test_new_client_after_key_change_or_fork(self):
+        first = ai_extractor.get_groq_client()
+        with mock.patch.dict(os.environ, {"GROQ_API_KEY": "key-2"}):
+            self.assertIsNot(ai_extractor.get_groq_client(), first)
+        second = ai_extractor.get_groq_client()
+        with mock.patch.object(ai_extractor.os, "getpid", return_value=os.getpid() + 1):
+            self.assertIsNot(ai_extractor.get_groq_client(), second)
+
+    @override_settings(GROQ_BASE_URL="http://127.0.0.1:8765/openai/v1")
+    def test_stand_in_needs_no_api_key(self):
+        with mock.patch.dict(os.environ, {"GROQ_API_KEY": ""}):
+            client = ai_extractor.get_groq_client()
+        self.assertEqual(client.kwargs["api_key"], "standin")
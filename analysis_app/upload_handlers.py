@@ -0,0 +1,49 @@
+# analysis_app/upload_handlers.py
+import hashlib
+from typing import Optional
+
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class Sha256UploadHandler(FileUploadHandler):
+    """
+    Hash every uploaded file while it streams in.
+
+    Sits in front of Django's memory/temporary-file handlers: it passes each
+    chunk through untouched and, once a file is complete, stores the hex
+    digest on request.upload_sha256[field_name] (one entry per file, in
+    upload order). It never produces the file object itself.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._hasher.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        hashes = getattr(self.request, "upload_sha256", None)
+        if hashes is None:
+            hashes = {}
+            self.request.upload_sha256 = hashes
+        hashes.setdefault(self.field_name, []).append(self._hasher.hexdigest())
+        return None
+
+
+def sha256_of_file(file_obj) -> str:
+    hasher = hashlib.sha256()
+    for chunk in file_obj.chunks():
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_upload_sha256(request, field_name: str, file_obj=None, index: int = 0) -> Optional[str]:
+    """Digest recorded by Sha256UploadHandler, or computed from file_obj if the handler is not installed."""
+    hashes = (getattr(request, "upload_sha256", None) or {}).get(field_name) or []
+    if index < len(hashes):
+        return hashes[index]
+    if file_obj is not None:
+        return sha256_of_file(file_obj)
+    return None
@@ -5,6 +5,18 @@ app_name = "analysis_app"
 
 urlpatterns = [
     path("upload/", views.upload_analysis, name="upload"),
+    path("upload/<int:analysis_id>/processing/", views.upload_progress, name="upload_progress"),
+    path("analysis/<int:analysis_id>/status/", views.analysis_status, name="analysis_status"),
+    path("upload/batch/", views.upload_batch, name="upload_batch"),
+    path("upload/batch/<int:batch_id>/", views.batch_progress, name="batch_progress"),
+    path("upload/batch/<int:batch_id>/status/", views.batch_status, name="batch_status"),
+    path(
+        "analysis/<int:analysis_id>/region/<int:region_id>.png",
+        views.region_crop,
+        name="region_crop",
+    ),
+    path("analysis/crops/stats/", views.crop_cache_status, name="crop_cache_status"),
+    path("analysis/vision/stats/", views.vision_parse_status, name="vision_parse_status"),
     path("analysis/history/", views.analysis_history, name="history"),
     path("analysis/<int:analysis_id>/detail/", views.analysis_detail, name="analysis_detail"),
 
@@ -23,6 +35,16 @@ urlpatterns = [
         views.generate_analysis,
         name="generate_analysis",
     ),
+    path(
+        "analysis/<int:analysis_id>/generate/stream/start/",
+        views.generate_stream_start,
+        name="generate_stream_start",
+    ),
+    path(
+        "analysis/<int:analysis_id>/generate/stream/",
+        views.generate_stream,
+        name="generate_stream",
+    ),
 
     path( "analysis/<int:analysis_id>/edit-masterfile/",views.edit_masterfile, name="edit_masterfile",),
     path("analysis/<int:analysis_id>/save-masterfile/", views.save_masterfile,name="save_masterfile",),
@@ -1,43 +1,75 @@
 from __future__ import annotations
 
+from datetime import timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional
 
+import asyncio
 import json
+import logging
+import queue
+import secrets
+import threading
+import zipfile
 import openpyxl
 from openpyxl import load_workbook
 from openpyxl.cell.cell import MergedCell
 
 from django.conf import settings
 from django.contrib import messages
+from django.core import signing
+from django.core.handlers.asgi import ASGIRequest
 from django.core.paginator import Paginator
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Count
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    HttpResponseNotModified,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag, urlencode
 from django.views.decorators.http import require_POST
 
-from .models import Analysis, AnalysisPage, RegionSelection
-from .services.cropper import crop_region_from_page
-from .services.ai_extractor import extract_design_metadata, extract_bom_materials
-from .services.masterfile_builder import (
-    append_equipment_to_masterfile,
-    parse_filename,
+from .models import Analysis, GenerateStreamNonce, RegionSelection, UploadBatch
+from .upload_handlers import get_upload_sha256
+from .services.backends import ExtractionCancelled
+from .services.cropper import (
+    crop_cache_stats,
+    crop_region_to_bytes,
+    region_crop_etag,
 )
 from .services.ppt_builder import sync_all_slides_from_masterfile
+from .services.batch_upload import create_batch, iter_uploaded_pdfs
+from .services.extraction import ExtractionProgress
+from .services.generate import analysis_user_key as _user_key, run_generate
+from .services.dedupe import create_linked_analysis, find_processed_duplicate
+from .services.raster_queue import enqueue_rasterization
+from .services.rasterizer import ensure_page, get_page_count
+from .services.vision_schema import parse_stats
 
 from core_app.decorators import rbi_login_required
 import jwt
 
+logger = logging.getLogger(__name__)
+
+
+CROP_MIN_WIDTH = 32
+CROP_MAX_WIDTH = 4096
+PREVIEW_WIDTH = 800
+THUMB_WIDTH = 480
 
 STEP_LABEL = {
     "design_data": "Select Design Data Region",
     "bom": "Select Bill Of Material Region",
     "slide_image": "Select Slide Image Region",
 }
-def _user_key(analysis: Analysis) -> str:
-    
-    if analysis.created_by:
-        return analysis.created_by.staff_id or analysis.created_by.external_id or "anon"
-    return "anon"
 
 
 @rbi_login_required
@@ -54,43 +86,59 @@ def upload_analysis(request):
             messages.error(request, "Session expired. Please log in again.")
             return redirect("login")
 
+        file_sha256 = get_upload_sha256(request, "pdf_file", pdf_file)
+
+        source = find_processed_duplicate(file_sha256, ext_user)
+        if source:
+            reuse_regions = request.POST.get("reuse_regions") == "on"
+            analysis = create_linked_analysis(
+                source,
+                created_by=ext_user,
+                original_filename=pdf_file.name,
+                inherit_regions=reuse_regions,
+            )
+            messages.info(
+                request,
+                f"This PDF was processed before ({source.original_filename}); "
+                "its page images were reused.",
+            )
+            if reuse_regions and analysis.regions.exists():
+                return redirect("analysis_app:review_analysis", analysis_id=analysis.id)
+            return redirect(
+                "analysis_app:select_region",
+                analysis_id=analysis.id,
+                step_type="design_data",
+                page_number=1,
+            )
+
         analysis = Analysis.objects.create(
             created_by=ext_user,
             file=pdf_file,
+            file_sha256=file_sha256,
             original_filename=pdf_file.name,
-            status="awaiting_regions",
+            status="pending",
         )
 
-        pdf_path = analysis.file.path
-
-        from pdf2image import convert_from_path
-        POPPLER_PATH = r"C:\Users\nazrisaidon\Desktop\poppler-25.11.0\Library\bin"
+        if not getattr(settings, "ANALYSIS_LAZY_PAGES", True):
+            # pages are rendered by run_raster_worker; uploading.html polls analysis_status
+            enqueue_rasterization(analysis)
+            return redirect("analysis_app:upload_progress", analysis_id=analysis.id)
 
+        # lazy mode: only count pages here, select_region renders each page on first visit
         try:
-            pages = convert_from_path(pdf_path, dpi=200, poppler_path=POPPLER_PATH)
-
-            for idx, page_img in enumerate(pages, start=1):
-                out_dir = Path(settings.MEDIA_ROOT) / "analysis/pages/"
-                out_dir.mkdir(parents=True, exist_ok=True)
-
-                filename = f"analysis_{analysis.id}_p{idx}.png"
-                out_path = out_dir / filename
-                page_img.save(out_path, "PNG")
-
-                rel_path = str(out_path.relative_to(settings.MEDIA_ROOT))
-
-                AnalysisPage.objects.create(
-                    analysis=analysis,
-                    page_number=idx,
-                    image=rel_path,
-                )
-
+            page_count = get_page_count(analysis.file.path)
+            if page_count < 1:
+                raise ValueError("PDF has no pages")
         except Exception as e:
             analysis.delete()
-            print(f"Error converting PDF: {e}")
+            print(f"Error reading PDF: {e}")
             messages.error(request, f"Error processing PDF: {e}")
             return redirect("analysis_app:upload")
 
+        analysis.page_count = page_count
+        analysis.status = "awaiting_regions"
+        analysis.save(update_fields=["page_count", "status"])
+
         return redirect(
             "analysis_app:select_region",
             analysis_id=analysis.id,
@@ -101,6 +149,186 @@ def upload_analysis(request):
     return render(request, "uploading.html")
 
 
+def _region_crop_url(region: RegionSelection, width: Optional[int] = None) -> str:
+    # v changes whenever the region is re-selected, so the long-lived cache never goes stale
+    url = reverse(
+        "analysis_app:region_crop",
+        kwargs={"analysis_id": region.analysis_id, "region_id": region.id},
+    )
+    url += f"?v={int(region.updated_at.timestamp() * 1000)}"
+    if width:
+        url += f"&w={width}"
+    return url
+
+
+@rbi_login_required
+def upload_progress(request, analysis_id):
+    analysis = get_object_or_404(Analysis, pk=analysis_id)
+    return render(request, "uploading.html", {"analysis": analysis})
+
+
+@rbi_login_required
+def analysis_status(request, analysis_id):
+    analysis = get_object_or_404(Analysis, pk=analysis_id)
+    pages_ready = analysis.pages.count()
+    first_page_ready = analysis.pages.filter(page_number=1).exists()
+
+    job = analysis.raster_jobs.order_by("-created_at").first()
+
+    data: Dict[str, Any] = {
+        "status": analysis.status,
+        "page_count": analysis.page_count,
+        "pages_ready": pages_ready,
+        "first_page_ready": first_page_ready,
+        "job_status": job.status if job else None,
+        "error": job.error if job and job.status == "failed" else None,
+        "redirect_url": None,
+    }
+    if first_page_ready:
+        data["redirect_url"] = reverse(
+            "analysis_app:select_region",
+            kwargs={
+                "analysis_id": analysis.id,
+                "step_type": "design_data",
+                "page_number": 1,
+            },
+        )
+    return JsonResponse(data)
+
+
+@rbi_login_required
+def region_crop(request, analysis_id, region_id):
+    region = get_object_or_404(
+        RegionSelection.objects.select_related("page"), pk=region_id, analysis_id=analysis_id
+    )
+
+    width = None
+    if request.GET.get("w"):
+        try:
+            width = int(request.GET["w"])
+        except ValueError:
+            return HttpResponseBadRequest("w must be an integer")
+        width = max(CROP_MIN_WIDTH, min(width, CROP_MAX_WIDTH))
+
+    coords = (region.x1, region.y1, region.x2, region.y2)
+    try:
+        etag = quote_etag(region_crop_etag(region.page.image.name, *coords, max_width=width))
+    except FileNotFoundError:
+        raise Http404("Page image not found")
+    except ValueError:
+        raise Http404("Invalid crop region")
+
+    cache_control = getattr(settings, "ANALYSIS_CROP_CACHE_CONTROL", "private, max-age=31536000, immutable")
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(
+            crop_region_to_bytes(region.page.image.name, *coords, max_width=width),
+            content_type="image/png",
+        )
+    response["ETag"] = etag
+    response["Cache-Control"] = cache_control
+    return response
+
+
+@rbi_login_required
+def crop_cache_status(request):
+    return JsonResponse(crop_cache_stats())
+
+
+@rbi_login_required
+def vision_parse_status(request):
+    return JsonResponse(parse_stats())
+
+
+@rbi_login_required
+def upload_batch(request):
+    if request.method == "POST":
+        files = request.FILES.getlist("pdf_files")
+        if not files:
+            messages.error(request, "Please select PDF or ZIP files.")
+            return redirect("analysis_app:upload_batch")
+
+        ext_user = getattr(request, "external_user", None)
+        if not ext_user:
+            messages.error(request, "Session expired. Please log in again.")
+            return redirect("login")
+
+        hashes = (getattr(request, "upload_sha256", None) or {}).get("pdf_files")
+        try:
+            batch, errors = create_batch(ext_user, iter_uploaded_pdfs(files, hashes))
+        except (zipfile.BadZipFile, ValueError) as e:
+            logger.warning("Error reading batch upload from %s: %s", ext_user, e)
+            messages.error(request, f"Error reading upload: {e}")
+            return redirect("analysis_app:upload_batch")
+
+        for err in errors:
+            messages.error(request, f"Error processing PDF {err}")
+
+        if not batch.analyses.exists():
+            batch.delete()
+            messages.error(request, "No PDF files were found in the upload.")
+            return redirect("analysis_app:upload_batch")
+
+        return redirect("analysis_app:batch_progress", batch_id=batch.id)
+
+    return render(request, "batch_upload.html")
+
+
+def _user_batch(request, batch_id) -> UploadBatch:
+    # a batch lists its file names and status; only its uploader may see it
+    return get_object_or_404(UploadBatch, pk=batch_id, created_by=request.external_user)
+
+
+@rbi_login_required
+def batch_progress(request, batch_id):
+    batch = _user_batch(request, batch_id)
+    return render(request, "batch_progress.html", {"batch": batch})
+
+
+@rbi_login_required
+def batch_status(request, batch_id):
+    batch = _user_batch(request, batch_id)
+    analyses = batch.analyses.annotate(pages_ready=Count("pages")).order_by("original_filename", "id")
+
+    items: List[Dict[str, Any]] = []
+    total_pages = ready_pages = 0
+    for a in analyses:
+        page_count = a.page_count or 0
+        if a.status != "failed":
+            total_pages += page_count
+            ready_pages += min(a.pages_ready, page_count)
+        select_url = None
+        if a.status != "failed" and page_count:
+            select_url = reverse(
+                "analysis_app:select_region",
+                kwargs={"analysis_id": a.id, "step_type": "design_data", "page_number": 1},
+            )
+        items.append(
+            {
+                "id": a.id,
+                "filename": a.original_filename,
+                "status": a.status,
+                "status_label": a.get_status_display(),
+                "page_count": a.page_count,
+                "pages_ready": a.pages_ready,
+                "select_url": select_url,
+            }
+        )
+
+    pending = sum(1 for i in items if i["status"] == "pending")
+    return JsonResponse(
+        {
+            "total_files": len(items),
+            "pending_files": pending,
+            "total_pages": total_pages,
+            "pages_ready": ready_pages,
+            "done": pending == 0,
+            "analyses": items,
+        }
+    )
+
+
 @rbi_login_required
 def select_region(request, analysis_id, step_type, page_number):
  
@@ -109,15 +337,28 @@ def select_region(request, analysis_id, step_type, page_number):
         return redirect("analysis_app:history")
 
     analysis = get_object_or_404(Analysis, pk=analysis_id)
-    page = get_object_or_404(AnalysisPage, analysis=analysis, page_number=page_number)
+
+    if analysis.page_count:
+        page_numbers = list(range(1, analysis.page_count + 1))
+    else:
+        # analyses uploaded before page_count existed have every page rendered already
+        page_numbers = list(analysis.pages.values_list("page_number", flat=True))
+
+    if page_number not in page_numbers:
+        raise Http404("Page not found.")
+
+    try:
+        page = ensure_page(analysis, page_number)
+    except Exception as e:
+        print(f"Error rendering page {page_number} of analysis {analysis.id}: {e}")
+        messages.error(request, f"Error rendering page {page_number}: {e}")
+        return redirect("analysis_app:history")
 
 
     original_name = analysis.original_filename or ""
     is_h004 = "H-004" in original_name
 
 
-    all_pages = list(analysis.pages.all())
-    page_numbers = [p.page_number for p in all_pages]
     idx = page_numbers.index(page_number)
 
     prev_page_url = None
@@ -295,45 +536,27 @@ def review_analysis(request, analysis_id):
     slide_previews: List[Dict[str, Any]] = []
 
  
+    # crops are served (and browser-cached) by region_crop; nothing is cropped here
+    design_full_url = None
     if design_data_region:
-        design_rel = crop_region_from_page(
-            page_image_name=design_data_region.page.image.name,
-            x1=design_data_region.x1,
-            y1=design_data_region.y1,
-            x2=design_data_region.x2,
-            y2=design_data_region.y2,
-        )
-        design_preview_url = settings.MEDIA_URL + design_rel
+        design_preview_url = _region_crop_url(design_data_region, PREVIEW_WIDTH)
+        design_full_url = _region_crop_url(design_data_region)
 
-   
     for r in bom_regions[:3]:
-        bom_rel = crop_region_from_page(
-            page_image_name=r.page.image.name,
-            x1=r.x1,
-            y1=r.y1,
-            x2=r.x2,
-            y2=r.y2,
-        )
         bom_previews.append(
             {
                 "page": r.page.page_number,
-                "url": settings.MEDIA_URL + bom_rel,
+                "url": _region_crop_url(r, PREVIEW_WIDTH),
+                "full_url": _region_crop_url(r),
             }
         )
 
-   
     for r in slide_regions[:3]:
-        rel = crop_region_from_page(
-            page_image_name=r.page.image.name,
-            x1=r.x1,
-            y1=r.y1,
-            x2=r.x2,
-            y2=r.y2,
-        )
         slide_previews.append(
             {
                 "page": r.page.page_number,
-                "url": settings.MEDIA_URL + rel,
+                "url": _region_crop_url(r, PREVIEW_WIDTH),
+                "full_url": _region_crop_url(r),
             }
         )
 
@@ -343,6 +566,7 @@ def review_analysis(request, analysis_id):
         "bom_regions": bom_regions,
         "slide_regions": slide_regions,
         "design_preview_url": design_preview_url,
+        "design_full_url": design_full_url,
         "bom_previews": bom_previews,
         "slide_previews": slide_previews,
     }
@@ -368,31 +592,8 @@ def analysis_detail(request, analysis_id):
     design_rows_preview: List[Dict[str, Any]] = []
     bom_rows_preview: List[Dict[str, Any]] = []
 
-    try:
-        if design_data_region:
-            _ = crop_region_from_page(
-                design_data_region.page.image.name,
-                design_data_region.x1,
-                design_data_region.y1,
-                design_data_region.x2,
-                design_data_region.y2,
-            )
-         
-    except Exception as e:
-        print("Design data preview error:", e)
-
-    try:
-        if bom_region:
-            _ = crop_region_from_page(
-                bom_region.page.image.name,
-                bom_region.x1,
-                bom_region.y1,
-                bom_region.x2,
-                bom_region.y2,
-            )
-         
-    except Exception as e:
-        print("BOM preview error:", e)
+    design_thumb_url = _region_crop_url(design_data_region, THUMB_WIDTH) if design_data_region else None
+    bom_thumb_url = _region_crop_url(bom_region, THUMB_WIDTH) if bom_region else None
 
     context = {
         "analysis": analysis,
@@ -402,125 +603,182 @@ def analysis_detail(request, analysis_id):
         "workbook_url": workbook_url,
         "design_rows_preview": design_rows_preview,
         "bom_rows_preview": bom_rows_preview,
+        "design_thumb_url": design_thumb_url,
+        "bom_thumb_url": bom_thumb_url,
     }
     return render(request, "detail.html", context)
 
 
 
+def _has_generate_regions(analysis: Analysis) -> bool:
+    regions = analysis.regions
+    return regions.filter(step_type="design_data").exists() and regions.filter(step_type="bom").exists()
+
+
 @rbi_login_required
 @require_POST
 def generate_analysis(request, analysis_id):
     analysis = get_object_or_404(Analysis, pk=analysis_id)
-    regions = analysis.regions.select_related("page").all()
-
-    design_region = regions.filter(step_type="design_data").first()
-    bom_regions = list(regions.filter(step_type="bom"))
-    slide_regions = list(regions.filter(step_type="slide_image"))
-
-    if not design_region or not bom_regions:
+    if not _has_generate_regions(analysis):
         messages.error(request, "Design Data and BOM regions are required.")
         return redirect("analysis_app:review_analysis", analysis_id=analysis.id)
 
-    analysis.status = "in_progress"
-    analysis.save(update_fields=["status"])
+    run_generate(analysis, use_cache=not request.POST.get("force_refresh"))
 
-    user_key = _user_key(analysis)
+    messages.success(
+        request,
+        "Draft Excel Masterfile and PowerPoint have been updated from the latest data. "
+        "Please review/edit the Excel online.",
+    )
+    return redirect("analysis_app:analysis_detail", analysis_id=analysis.id)
 
-    if not analysis.workbook_path:
-        analysis.workbook_path = f"analysis/workbooks/{user_key}_IPETRO_Masterfile.xlsx"
-        analysis.save(update_fields=["workbook_path"])
 
-    if not analysis.pptx_path:
-        analysis.pptx_path = f"analysis/ppt/{user_key}_InspectionPlan.pptx"
-        analysis.save(update_fields=["pptx_path"])
+# --- Generate with streamed progress (Server-Sent Events) ---------------------------
+
+GENERATE_STREAM_SALT = "analysis_app.generate_stream"
+SSE_KEEPALIVE_SECONDS = 15
 
-    pmt_no, equipment_no = parse_filename(analysis.original_filename)
 
-    design_crop_rel = crop_region_from_page(
-        design_region.page.image.name,
-        design_region.x1,
-        design_region.y1,
-        design_region.x2,
-        design_region.y2,
+@rbi_login_required
+@require_POST
+def generate_stream_start(request, analysis_id):
+    """
+    EventSource can only GET and sends no CSRF token, so the page POSTs
+    here first and gets a short-lived signed URL for generate_stream.
+    """
+    analysis = get_object_or_404(Analysis, pk=analysis_id)
+    if not _has_generate_regions(analysis):
+        return JsonResponse({"error": "Design Data and BOM regions are required."}, status=400)
+    token = signing.dumps(
+        {
+            "analysis_id": analysis.id,
+            "force_refresh": bool(request.POST.get("force_refresh")),
+            "user": request.external_user.id,
+            "nonce": secrets.token_hex(8),
+        },
+        salt=GENERATE_STREAM_SALT,
     )
+    url = reverse("analysis_app:generate_stream", kwargs={"analysis_id": analysis.id})
+    return JsonResponse({"stream_url": f"{url}?{urlencode({'token': token})}"})
 
-    bom_items: List[Dict[str, Any]] = []
-    for bom_region in bom_regions:
-        bom_crop_rel = crop_region_from_page(
-            bom_region.page.image.name,
-            bom_region.x1,
-            bom_region.y1,
-            bom_region.x2,
-            bom_region.y2,
-        )
+
+def _sse_frame(event: Dict[str, Any]) -> str:
+    data = {k: v for k, v in event.items() if k != "event"}
+    return f"event: {event['event']}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def _start_generate_thread(analysis: Analysis, use_cache: bool, put) -> threading.Event:
+    """Run the generate pipeline on its own thread, feeding events to `put`; None marks the end."""
+    progress = ExtractionProgress(put)
+
+    def work():
         try:
-            items = extract_bom_materials(
-                bom_crop_rel,
-                pmt_no=pmt_no,
-                equipment_no=equipment_no,
-            ) or []
-            bom_items.extend(items)
+            run_generate(analysis, use_cache=use_cache, progress=progress)
+            detail_url = reverse("analysis_app:analysis_detail", kwargs={"analysis_id": analysis.id})
+            put({"event": "done", "redirect_url": detail_url})
+        except ExtractionCancelled:
+            print(f"Generate for analysis {analysis.id} cancelled by the client")
+            put({"event": "cancelled"})
         except Exception as e:
-            print("BOM materials extraction failed for one region:", e)
+            print("Generate failed:", e)
+            put({"event": "error", "message": str(e)})
+        finally:
+            connections.close_all()
+            put(None)
+
+    threading.Thread(target=work, name=f"generate-{analysis.id}", daemon=True).start()
+    return progress.cancel
 
-    design_meta: Dict[str, Any] = {}
+
+def _sse_events_sync(analysis: Analysis, use_cache: bool):
+    # WSGI (runserver): a plain generator, the server writes each chunk as it comes
+    events: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+    cancel = _start_generate_thread(analysis, use_cache, events.put)
     try:
-        design_meta = extract_design_metadata(
-            design_crop_rel,
-            pmt_no=pmt_no,
-            equipment_no=equipment_no,
-        ) or {}
-    except Exception as e:
-        print("Design metadata extraction failed:", e)
-
-    slide_image_paths: List[str] = []
-    for r in slide_regions:
-        crop_rel = crop_region_from_page(
-            page_image_name=r.page.image.name,
-            x1=r.x1,
-            y1=r.y1,
-            x2=r.x2,
-            y2=r.y2,
-        )
-        slide_image_paths.append(crop_rel)
+        while True:
+            try:
+                event = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            yield _sse_frame(event)
+    finally:
+        # generator closed early = the client went away
+        cancel.set()
 
-    image_map: Dict[Tuple[str, str], str] = {}
-    if slide_image_paths:
-        image_map[(pmt_no, equipment_no)] = slide_image_paths[0]
 
+async def _sse_events_async(analysis: Analysis, use_cache: bool):
+    # ASGI: no worker thread is held while waiting; a client disconnect cancels this generator
+    loop = asyncio.get_running_loop()
+    events: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+
+    def put(event):
+        try:
+            loop.call_soon_threadsafe(events.put_nowait, event)
+        except RuntimeError:
+            pass  # loop already closed
+
+    cancel = _start_generate_thread(analysis, use_cache, put)
     try:
-        append_equipment_to_masterfile(
-            workbook_rel_path=analysis.workbook_path,
-            original_filename=analysis.original_filename,
-            design_meta=design_meta,
-            bom_items=bom_items,
-        )
-        sync_all_slides_from_masterfile(
-            pptx_rel_path=analysis.pptx_path,
-            workbook_rel_path=analysis.workbook_path,
-            image_map=image_map or None,
-        )
-    except Exception as e:
-        print("Append to Masterfile failed:", e)
+        while True:
+            try:
+                event = await asyncio.wait_for(events.get(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            yield _sse_frame(event)
+    finally:
+        cancel.set()
+
 
+def _claim_stream_nonce(nonce: str, max_age: int) -> bool:
+    """False if the nonce was used before, by any worker process."""
+    # a row older than max_age belongs to a token signing.loads already rejects
+    GenerateStreamNonce.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=max_age)).delete()
     try:
-        sync_all_slides_from_masterfile(
-            pptx_rel_path=analysis.pptx_path,
-            workbook_rel_path=analysis.workbook_path,
-            image_map=image_map or None,
-        )
-    except Exception as e:
-        print("PPT sync failed:", e)
+        with transaction.atomic():
+            GenerateStreamNonce.objects.create(nonce=nonce)
+    except IntegrityError:
+        return False
+    return True
 
-    analysis.status = "awaiting_excel_review"
-    analysis.save(update_fields=["status"])
 
-    messages.success(
-        request,
-        "Draft Excel Masterfile and PowerPoint have been updated from the latest data. "
-        "Please review/edit the Excel online.",
-    )
-    return redirect("analysis_app:analysis_detail", analysis_id=analysis.id)
+@rbi_login_required
+def generate_stream(request, analysis_id):
+    """
+    Server-Sent Events for one generate run: "stage", "region", "token"
+    and "rows" events while it works, then "done" (with redirect_url),
+    "cancelled" or "error". Closing the stream cancels the run unless it
+    is already writing the masterfile. Needs the signed token that
+    generate_stream_start gave the same user; it is good for one run.
+    """
+    max_age = int(getattr(settings, "ANALYSIS_GENERATE_STREAM_TOKEN_AGE", 60))
+    try:
+        payload = signing.loads(request.GET.get("token", ""), salt=GENERATE_STREAM_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return HttpResponseForbidden("Stream link expired or invalid.")
+    if payload.get("analysis_id") != analysis_id:
+        return HttpResponseForbidden("Stream link is for another analysis.")
+    if payload.get("user") != request.external_user.id:
+        return HttpResponseForbidden("Stream link is for another user.")
+    # EventSource reconnects on its own; a used token must not start a second run (204 stops it)
+    if not _claim_stream_nonce(payload["nonce"], max_age):
+        return HttpResponse(status=204)
+
+    analysis = get_object_or_404(Analysis, pk=analysis_id)
+    use_cache = not payload.get("force_refresh")
+    if isinstance(request, ASGIRequest):
+        events = _sse_events_async(analysis, use_cache)
+    else:
+        events = _sse_events_sync(analysis, use_cache)
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # nginx: don't buffer the stream
+    return response
 
 
 @rbi_login_required
@@ -45,6 +45,152 @@ ALLOWED_HOSTS = []
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are SHA-256 hashed as they stream in (used to dedupe identical PDFs)
+FILE_UPLOAD_HANDLERS = [
+    'analysis_app.upload_handlers.Sha256UploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# PDF rasterization (pdf2image / poppler)
+POPPLER_PATH = os.getenv("POPPLER_PATH", r"C:\Users\nazrisaidon\Desktop\poppler-25.11.0\Library\bin")
+ANALYSIS_RASTER_DPI = 200
+ANALYSIS_RASTER_BATCH_SIZE = 1  # pages decoded per poppler call; keeps peak memory flat
+ANALYSIS_RASTER_PROCESSES = 1  # processes per raster job (pages 2..N); raise on multi-core hosts
+
+# How page images are stored: "png" (RGB, as before), or opt in to a compact one: "png-gray",
+# "png-1bit", "png-palette" or "webp" (lossless). Slide images are cropped from these pages,
+# so gray/1-bit formats also make the PPT pictures gray.
+# Convert existing pages with `python manage.py convert_page_images --format <name>`.
+ANALYSIS_PAGE_FORMAT = "png"
+
+# True: upload only counts pages and select_region renders each page on first visit.
+# False: every page is rendered up front by the raster worker queue.
+ANALYSIS_LAZY_PAGES = True
+
+# Read design/BOM tables from the PDF text layer when present; vision model is the fallback
+ANALYSIS_TEXT_LAYER_ENABLED = True
+
+# Extractor backends the router may use per region (services/backends.py). Local ones
+# ("text_layer", "tesseract") are tried first when their recorded hit rate and latency say
+# they beat calling "groq"; a template rule can pin one with backend="...".
+# Tesseract needs `pip install pytesseract` plus the tesseract binary (ANALYSIS_TESSERACT_CMD).
+ANALYSIS_EXTRACTOR_BACKENDS = ["text_layer", "tesseract", "groq"]
+ANALYSIS_TESSERACT_CMD = None
+ANALYSIS_TESSERACT_CONFIG = "--psm 6"
+ANALYSIS_TESSERACT_MIN_CONF = 30
+ANALYSIS_OCR_MIN_EDGE = 150  # px; smaller crops go straight to the vision model
+ANALYSIS_OCR_MAX_PIXELS = 12_000_000
+# extra seconds charged per call when ranking, to prefer free local backends over paid API calls
+ANALYSIS_BACKEND_CALL_COST = {"groq": 2.0}
+# share of calls that still try a local backend the stats say to skip, so its stats can recover
+ANALYSIS_ROUTER_EXPLORE_RATE = 0.05
+# share of local answers also sent to the vision backend to measure their accuracy
+ANALYSIS_ROUTER_VERIFY_RATE = 0.05
+# local backends agreeing with the vision answer less often than this are skipped
+ANALYSIS_ROUTER_MIN_ACCURACY = 0.8
+
+# Raster job queue: pages are rendered by `python manage.py run_raster_worker`
+# A job that crashes its worker this many times is marked failed instead of requeued.
+RASTER_JOB_MAX_ATTEMPTS = 3
+# Workers refresh a running job after every page; one silent for this many seconds is
+# considered abandoned and requeued.
+RASTER_JOB_STALE_AFTER = 15 * 60
+
+# Batch upload (/analysis/upload/batch/): largest PDF accepted from inside a ZIP
+ANALYSIS_BATCH_MAX_PDF_BYTES = 100 * 1024 * 1024
+
+# Crops are shrunk before they are sent to the vision model; add "log": True to print each
+# step's size/mode/latency.
+# Steps: "grayscale", "binarize", "deskew", "trim", "downscale" (see services/preprocess.py)
+ANALYSIS_VISION_PREPROCESS = {
+    "enabled": True,
+    "steps": ["grayscale", "deskew", "trim", "downscale"],
+    "max_long_edge": 1600,
+}
+
+# Groq vision model used for design/BOM extraction
+GROQ_VISION_MODEL = os.getenv("GROQ_VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
+GROQ_VISION_TEMPERATURE = 0.0
+
+# Send Groq calls elsewhere, e.g. the local stand-in (`manage.py groq_standin`) for offline
+# runs and load tests: GROQ_BASE_URL=http://127.0.0.1:8765. Empty = the real API.
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL") or None
+
+# Ask for response_format=json_object. Turned off automatically (per process) for a model
+# that rejects it. Answers are still repaired locally and checked against vision_schema.
+GROQ_JSON_MODE = True
+
+# Every Groq call goes through one rate limit shared by all workers (a row in the DB):
+# at most GROQ_REQUESTS_PER_MINUTE on average with bursts of GROQ_BURST. A caller that would
+# wait longer than GROQ_MAX_QUEUE_WAIT seconds gives up. Retryable errors (429/5xx/timeouts)
+# are retried GROQ_MAX_RETRIES times with jittered backoff or the server's Retry-After;
+# GROQ_BREAKER_THRESHOLD failures in a row stop all calls for GROQ_BREAKER_COOLDOWN seconds.
+GROQ_REQUESTS_PER_MINUTE = 30
+GROQ_BURST = 5
+GROQ_MAX_QUEUE_WAIT = 120
+GROQ_MAX_RETRIES = 4
+GROQ_BACKOFF_BASE = 1.0
+GROQ_BACKOFF_MAX = 30.0
+GROQ_BREAKER_THRESHOLD = 5
+GROQ_BREAKER_COOLDOWN = 30
+
+# One Groq client per process shares a keep-alive connection pool across extraction threads.
+# GROQ_TIMEOUT is the read/write timeout in seconds for one request (a vision answer can
+# take a while); connections idle longer than GROQ_HTTP_KEEPALIVE_EXPIRY are closed.
+GROQ_TIMEOUT = 60.0
+GROQ_CONNECT_TIMEOUT = 5.0
+GROQ_HTTP_MAX_CONNECTIONS = 20
+GROQ_HTTP_MAX_KEEPALIVE = 10
+GROQ_HTTP_KEEPALIVE_EXPIRY = 60.0
+
+# Bulk jobs (manage.py reextract --mode queue) only send when a slot is free right now and
+# leave this many burst slots for interactive generates.
+GROQ_BULK_HEADROOM = 2
+
+# manage.py reextract: batch API completion window, max size of one batch input file,
+# and how many times a region is resubmitted before it is marked failed.
+GROQ_BATCH_COMPLETION_WINDOW = "24h"
+GROQ_BATCH_MAX_BYTES = 90 * 1024 * 1024
+REEXTRACT_MAX_ATTEMPTS = 3
+
+# Record every Groq vision request (size, tokens, latency, retries, outcome) in VisionCallLog;
+# admin shows p50/p95 latency and failure rate per equipment template.
+ANALYSIS_VISION_CALL_LOG = True
+
+# "Generate" on the review page streams progress over Server-Sent Events. The stream URL
+# carries a signed, single-use token that expires after this many seconds if never opened.
+ANALYSIS_GENERATE_STREAM_TOKEN_AGE = 60
+
+# Vision answers cached on disk by (crop, prompt, model, temperature); regenerate with
+# unchanged regions makes no API calls. "Force refresh" on the generate form bypasses it.
+ANALYSIS_VISION_CACHE_ENABLED = True
+ANALYSIS_VISION_CACHE_DIR = BASE_DIR / "cache" / "vision"
+ANALYSIS_VISION_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# "split": one vision request per region, run concurrently.
+# "combined": design + all BOM crops in one request (up to 5 images); compare with `manage.py bench_extraction`.
+ANALYSIS_EXTRACTION_MODE = "split"
+
+# Vision calls made at the same time by one generate (design + each BOM region)
+ANALYSIS_EXTRACT_WORKERS = 6
+
+# Decoded page bitmaps kept in memory (per process) so several regions of a page share one decode
+ANALYSIS_PAGE_CACHE_BYTES = 256 * 1024 * 1024
+
+# Region crops served by /analysis/analysis/<id>/region/<region_id>.png carry a strong ETag and
+# a versioned URL, so they can be cached "forever". Use "public, ..." to let a reverse proxy cache them too.
+ANALYSIS_CROP_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+# `python manage.py gc_media` deletes unreferenced media older than these ages (seconds)
+ANALYSIS_MEDIA_RETENTION = {
+    "analysis/crops": 7 * 24 * 3600,  # crop cache, recreated on demand
+    "analysis/pages": 24 * 3600,
+    "analysis/pdf": 24 * 3600,
+    "analysis/ppt": 30 * 24 * 3600,
+    "analysis/workbooks": 30 * 24 * 3600,
+}
+
 # Application definition
 
 INSTALLED_APPS = [